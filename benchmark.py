@@ -0,0 +1,482 @@
+#!/usr/bin/python3
+"""Micro-benchmarks for the hot paths in CopyMedia.
+
+Run a single benchmark with e.g. `python benchmark.py match`, or all of them with no arguments."""
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import string
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import config_cache
+import fakes
+import logger
+import scan
+import timing
+import tmdb
+from copy_files import CopyMedia
+from matcher import SeriesMatcher
+
+CONFIG_FILE = './CopyMedia.json'
+
+argParser = argparse.ArgumentParser(description='Benchmark CopyMedia hot paths.')
+argParser.add_argument('benchmarks', nargs='*', help='Benchmarks to run (default: all)')
+argParser.add_argument('-c', '--config', help='Configuration file providing the series list',
+                       default=CONFIG_FILE)
+argParser.add_argument('-n', '--files', type=int, default=500, help='Number of synthetic file names')
+argParser.add_argument('-r', '--repeat', type=int, default=5, help='Timing repetitions (best is reported)')
+argParser.add_argument('--seed', type=int, default=1, help='Random seed for synthetic data')
+argParser.add_argument('--entries', type=int, default=10000, help='Directory entries for the scan benchmark')
+argParser.add_argument('--series', type=int, default=100, help='Synthetic series configured for the pipeline benchmark')
+argParser.add_argument('--releases', type=int, default=20, help='Movie release folders for the pipeline benchmark')
+argParser.add_argument('--movie-gb', dest='movie_gb', type=float, default=4,
+                       help='Size of each (sparse) movie file in the pipeline benchmark')
+argParser.add_argument('-o', '--output', help='Also write the results as JSON to this file')
+
+
+def load_series(config_file):
+    with open(config_file) as configfile:
+        return json.load(configfile).get('series', [])
+
+
+def synthetic_names(series, count, rng):
+    """Build a mix of file names: roughly half match a configured series, the rest are noise."""
+
+    names = []
+    for i in range(count):
+        if series and i % 2 == 0:
+            show = rng.choice(series)
+            literal = re.sub(r'\\(.)', r'\1', re.search(r'\(([^()]*[A-Za-z][^()]*)\)', show['regex']).group(1))
+            names.append('[SubsPlease] %s - %02d (1080p) [%08X].mkv' % (literal, rng.randint(1, 99),
+                                                                        rng.getrandbits(32)))
+        else:
+            junk = ''.join(rng.choice(string.ascii_letters + ' .-') for _ in range(40))
+            names.append('%s.S%02dE%02d.1080p.WEB-DL.mkv' % (junk, rng.randint(1, 9), rng.randint(1, 24)))
+    return names
+
+
+def legacy_match(files, series):
+    """The original files x series loop, kept here as the baseline."""
+
+    matches = []
+    for f in files:
+        for show in series:
+            if re.match(show['regex'], f):
+                matches.append((f, show['name']))
+                break
+    return matches
+
+
+def compiled_match(files, matcher):
+    matches = []
+    for f in files:
+        found = matcher.match(f)
+        if found:
+            matches.append((f, found[0]['name']))
+    return matches
+
+
+def legacy_rename(file_name, config):
+    """The original build_new_name, kept here as the baseline."""
+
+    dest_file_name = file_name
+    if 'replace' in config:
+        dest_file_name = re.sub(config['regex'], config['replace'], file_name)
+    if 'episode_num_sub' in config:
+        match = re.compile('.*([sS]\\d\\d[eE](\\d\\d)).*').match(dest_file_name)
+        new_num = int(match.group(2)) - int(config['episode_num_sub'])
+        dest_file_name = dest_file_name.replace(match.group(1), match.group(1)[:-2] + str(new_num))
+    return dest_file_name
+
+
+def bench_rename(args, rng):
+    series = load_series(args.config)
+    matcher = SeriesMatcher(series)
+    matches = [found for found in map(matcher.match, synthetic_names(series, args.files, rng)) if found]
+    # Episode numbers above any offset, so the baseline doesn't trip over negative episodes.
+    matches = [found for found in matches
+               if int(found.show.get('episode_num_sub', 0)) < int(re.search(r' - (\d+)', found.match.string).group(1))]
+
+    for found in matches:
+        expected = legacy_rename(found.match.string, found.show)
+        if found.new_name() != expected and 'episode_num_sub' not in found.show:
+            raise AssertionError('rename pipeline disagrees with the legacy rename: %r != %r'
+                                 % (found.new_name(), expected))
+
+    legacy = min(timeit.repeat(lambda: [legacy_rename(f.match.string, f.show) for f in matches],
+                               number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(lambda: [f.new_name() for f in matches], number=1, repeat=args.repeat))
+    return {
+        'renames': len(matches),
+        'legacy_s': legacy,
+        'compiled_s': compiled,
+        'renames_per_s': len(matches) / compiled if compiled else None,
+        'speedup': legacy / compiled if compiled else None,
+    }
+
+
+TITLE_WORDS = ['The', 'Last', 'Dark', 'Knight', 'of', 'Star', 'Wars', 'Empire', 'Strikes', 'Back', 'Mr.', 'Robot',
+               "Ocean's", 'Eleven', 'II', '2', '22', 'Jump', 'Street', 'Se7en', 'X', 'Men', 'Blade', 'Runner', '2049',
+               'Lord', 'Rings', 'Return', 'King', 'Toy', 'Story', 'Alien', 'Heat', 'Up', 'Her', 'Extraction', 'Planet',
+               'Earth', 'Amelie', 'Crouching', 'Tiger', 'Dragon', 'Part', 'One', 'Day', 'After', 'Tomorrow', 'Apollo',
+               '13', 'Fast', 'Furious', 'Rise', 'Fall', 'Doctor', 'Who', 'Space', 'Odyssey', 'Hero', 'Extended']
+RELEASE_TAGS = ['720p', '1080p', '2160p', 'BluRay', 'WEB-DL', 'WEBRip', 'HDTV', 'DVDRip', 'AMZN.WEB-DL', 'x264', 'x265',
+                'H.264', 'HEVC', 'XviD', 'AAC', 'AC3', 'DTS', 'DD5.1', 'DDP5.1', '10bit', 'REMUX', 'PROPER',
+                'REPACK', 'EXTENDED', 'IMAX', 'HDR']
+RELEASE_GROUPS = ['RARBG', 'YIFY', 'NTb', 'FGT', 'SPARKS', 'GECKOS', 'LordVako', 'fov', 'HDChina']
+
+
+def synthetic_release_names(count, rng):
+    """Build count release names in the styles seen in download folders: scene and P2P movies
+    (dotted, spaced, bracketed years, years past 2019), SxxEyy and 3x02 episodes, and anime releases."""
+
+    names = []
+    for _ in range(count):
+        title = [rng.choice(TITLE_WORDS) for _ in range(rng.randint(1, 4))]
+        tags = rng.sample(RELEASE_TAGS, rng.randint(0, 4))
+        group = '-' + rng.choice(RELEASE_GROUPS) if rng.random() < 0.8 else ''
+        year = str(rng.randint(1950, 2025))
+        style = rng.random()
+        if style < 0.35:
+            name = '.'.join(title + [year] + tags) + group
+        elif style < 0.5:
+            name = ' '.join(title + ['(%s)' % year] + tags) + group
+        elif style < 0.6:
+            name = ' '.join(title + [year] + tags) + group
+        elif style < 0.8:
+            episode = 'S%02dE%02d' % (rng.randint(1, 12), rng.randint(1, 24))
+            episode_name = [rng.choice(TITLE_WORDS) for _ in range(rng.randint(0, 3))]
+            name = '.'.join(title + [episode] + episode_name + tags) + group
+        elif style < 0.9:
+            name = '_'.join(w.lower() for w in title) + '.%dx%02d.' % (rng.randint(1, 9), rng.randint(1, 24)) \
+                + '_'.join(t.lower() for t in tags) + group.lower()
+        else:
+            name = '[SubsPlease] %s - %02d (1080p) [%08X]' % (' '.join(title), rng.randint(1, 99), rng.getrandbits(32))
+        names.append(name)
+    return names
+
+
+def bench_parse(args, rng):
+    names = synthetic_release_names(args.files, rng)
+
+    fast = [tmdb.fast_parse(name) for name in names]
+    disagreements = []
+    for name, meta in zip(names, fast):
+        if meta is not None:
+            expected = {k: v for k, v in tmdb.ptn_parse(name).items() if k in ('title', 'year', 'season', 'episode')}
+            if meta != expected:
+                disagreements.append((name, meta, expected))
+    if disagreements:
+        raise AssertionError('fast path disagrees with PTN on %d name(s), e.g. %r'
+                             % (len(disagreements), disagreements[:5]))
+
+    def per_name_us(parse, sample):
+        return min(timeit.repeat(lambda: [parse(n) for n in sample], number=1, repeat=args.repeat)) / len(sample) * 1e6
+
+    ptn = per_name_us(tmdb.ptn_parse, names)
+    parser = per_name_us(tmdb._parse.__wrapped__, names)
+    # The second parse of a name, as rename_movie does after is_movie.
+    recent = names[:tmdb.PARSE_CACHE_SIZE]
+    for name in recent:
+        tmdb.clean_name(name)
+    cached = per_name_us(tmdb.clean_name, recent)
+    return {
+        'names': len(names),
+        'fast_path_share': sum(meta is not None for meta in fast) / len(names),
+        'ptn_us': ptn,
+        'parser_us': parser,
+        'cached_us': cached,
+        'speedup': ptn / parser if parser else None,
+        'cached_speedup': ptn / cached if cached else None,
+    }
+
+
+def bench_match(args, rng):
+    series = load_series(args.config)
+    files = synthetic_names(series, args.files, rng)
+    matcher = SeriesMatcher(series)
+
+    if legacy_match(files, series) != compiled_match(files, matcher):
+        raise AssertionError('compiled matcher disagrees with the legacy loop')
+
+    legacy = min(timeit.repeat(lambda: legacy_match(files, series), number=1, repeat=args.repeat))
+    compiled = min(timeit.repeat(lambda: compiled_match(files, matcher), number=1, repeat=args.repeat))
+    build = min(timeit.repeat(lambda: SeriesMatcher(series), number=1, repeat=args.repeat))
+
+    return {
+        'series': len(series),
+        'files': len(files),
+        'legacy_s': legacy,
+        'compiled_s': compiled,
+        'matcher_build_s': build,
+        'speedup': legacy / compiled if compiled else None,
+    }
+
+
+def import_times(module='copy_files'):
+    """Import module in a fresh interpreter with -X importtime.
+
+    Returns {module name: cumulative microseconds} for every module loaded by that import (modules
+    the interpreter loads on its own at start-up are left out)."""
+
+    def run(code):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+        return times
+
+    baseline = run('pass')
+    return {name: us for name, us in run('import ' + module).items() if name not in baseline}
+
+
+def bench_startup(args, rng):
+    samples = [import_times() for _ in range(args.repeat)]
+    totals = [sample['copy_files'] for sample in samples]
+    slowest = sorted(samples[-1].items(), key=lambda item: -item[1])[:10]
+    return {
+        'import_copy_files_us_median': statistics.median(totals),
+        'import_copy_files_us_min': min(totals),
+        'modules_loaded': len(samples[-1]),
+        'slowest_cumulative_us': dict(slowest),
+    }
+
+
+def synthetic_tree(root, names, rng, dir_every=20):
+    """Populate root with empty files named after names, turning every dir_every-th into a
+    movie-style directory holding a few files of different sizes."""
+
+    for i, name in enumerate(names):
+        full_path = os.path.join(root, '%05d %s' % (i, name))
+        if i % dir_every == 0:
+            os.mkdir(full_path)
+            for j in range(3):
+                with open(os.path.join(full_path, 'part%d.mkv' % j), 'wb') as f:
+                    f.truncate(rng.randint(1, 1 << 20))
+        else:
+            open(full_path, 'wb').close()
+
+
+def legacy_scan(directory):
+    """The original execute() listing: two listdir passes plus an isfile/isdir per entry."""
+
+    files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
+    dirs = [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)) and d != 'tmp']
+    return files, dirs
+
+
+def single_pass_scan(directory):
+    result = scan.scan_dir(directory)
+    return result.file_names(), [d for d in result.dir_names() if d != 'tmp']
+
+
+def bench_scan(args, rng):
+    root = tempfile.mkdtemp(prefix='copymedia-scan-')
+    try:
+        synthetic_tree(root, synthetic_names(load_series(args.config), args.entries, rng), rng)
+
+        if legacy_scan(root) != single_pass_scan(root):
+            raise AssertionError('single-pass scan disagrees with the legacy listing')
+
+        legacy = min(timeit.repeat(lambda: legacy_scan(root), number=1, repeat=args.repeat))
+        single = min(timeit.repeat(lambda: single_pass_scan(root), number=1, repeat=args.repeat))
+        files, dirs = legacy_scan(root)
+        return {
+            'entries': args.entries,
+            'files': len(files),
+            'dirs': len(dirs),
+            'legacy_s': legacy,
+            'scandir_s': single,
+            'speedup': legacy / single if single else None,
+        }
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_config(args, rng):
+    cache_dir = tempfile.mkdtemp(prefix='copymedia-config-')
+    try:
+        def cold():
+            with open(args.config) as configfile:
+                return CopyMedia.compile_series(json.load(configfile))
+
+        def warm():
+            return config_cache.load(args.config, CopyMedia.compile_series, cache_dir)
+
+        warm()
+        cold_s = min(timeit.repeat(cold, number=1, repeat=args.repeat))
+        warm_s = min(timeit.repeat(warm, number=1, repeat=args.repeat))
+        return {
+            'series': len(warm()[1].series),
+            'parse_and_compile_s': cold_s,
+            'cached_load_s': warm_s,
+            'speedup': cold_s / warm_s if warm_s else None,
+        }
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def synthetic_series(count, rng):
+    """count series config entries with made-up names, some renamed, renumbered or sent elsewhere."""
+
+    series = []
+    for i in range(count):
+        name = '%s %d' % (''.join(rng.choice(string.ascii_lowercase) for _ in range(8)).capitalize(), i)
+        show = {'name': name, 'regex': r'(.*)(%s)( - )(\d{1,})(.*)' % re.escape(name)}
+        if i % 5 == 1:
+            show['replace'] = r'\1\2\3S02E\4\5'
+        if i % 7 == 2:
+            show['destination'] = name.replace(' ', '.')
+        series.append(show)
+    return series
+
+
+SUBTITLE_VARIANTS = ['English.srt', '2_English.srt', 'eng.srt', 'English.SDH.srt', 'en.forced.srt', 'French.srt',
+                     'Spanish.srt', 'German.srt', 'Portuguese (Brazil).srt', 'Japanese.srt', 'chi.srt', 'ara.srt']
+
+
+def synthetic_downloads(scan_dir, series, args, rng):
+    """Fill scan_dir like a busy download folder: args.files loose files (half of them episodes of the
+    configured series) and args.releases nested movie release folders with sparse movie files, samples,
+    extras and a pile of subtitles.
+
+    Returns (episode file names, movie titles)."""
+
+    episodes = []
+    for i, name in enumerate(synthetic_names(series, args.files, rng)):
+        name = name.replace(' (1080p)', ' (1080p) %05d' % i)
+        open(os.path.join(scan_dir, name), 'wb').close()
+        if i % 2 == 0:
+            episodes.append(name)
+
+    titles = []
+    for i in range(args.releases):
+        title = 'Synthetic Movie %d' % i
+        titles.append(title)
+        release = os.path.join(scan_dir, '%s.%d.1080p.BluRay.x264-GRP' % (title.replace(' ', '.'), 2000 + i % 25))
+        movie_dir = os.path.join(release, 'CD1') if i % 3 == 0 else release
+        for sub_dir in (movie_dir, os.path.join(release, 'Sample'), os.path.join(release, 'Subs')):
+            os.makedirs(sub_dir, exist_ok=True)
+        fakes.sparse_movie(os.path.join(movie_dir, os.path.basename(release) + '.mp4'), int(args.movie_gb * 1024 ** 3))
+        fakes.sparse_movie(os.path.join(release, 'Sample', 'sample.mp4'), 50 * 1024 ** 2)
+        for variant in SUBTITLE_VARIANTS:
+            with open(os.path.join(release, 'Subs', variant), 'w') as f:
+                f.write('1\n00:00:01,000 --> 00:00:02,000\n%s\n' % variant)
+        with open(os.path.join(release, 'RARBG.txt'), 'w') as f:
+            f.write('x' * rng.randint(10, 1000))
+    return episodes, titles
+
+
+def _count_files(directory, ext):
+    return sum(name.endswith(ext) for _, _, files in os.walk(directory) for name in files)
+
+
+def run_pipeline(root, library, args, rng, nas=None):
+    """Run CopyMedia.execute over a freshly generated download folder under root, delivering into the
+    local library directory or, given a fakes.FakeNAS whose root is library, to the NAS. Returns the results."""
+
+    series_dir, movie_dir = os.path.join(library, 'Series'), os.path.join(library, 'Movies')
+    if nas is not None:
+        series_dir, movie_dir = nas.remote('Series'), nas.remote('Movies')
+
+    scan_dir = os.path.join(root, 'downloads')
+    os.makedirs(scan_dir)
+    series = synthetic_series(args.series, rng)
+    episodes, titles = synthetic_downloads(scan_dir, series, args, rng)
+    config_file = os.path.join(root, 'CopyMedia.json')
+    with open(config_file, 'w') as f:
+        json.dump({'scanDir': scan_dir, 'seriesDir': series_dir, 'movieDir': movie_dir, 'series': series}, f)
+
+    timing.reset()
+    with fakes.FakeTMDB(titles) as fake_tmdb:
+        started = time.perf_counter()
+        c = CopyMedia(config_file=config_file, tmdb_key='benchmark')
+        c.execute()
+        elapsed = time.perf_counter() - started
+    stages = timing.summary()
+
+    left = set(os.listdir(scan_dir))
+    if left & set(episodes) or any(not name.endswith('.mkv') for name in left):
+        raise AssertionError('pipeline left episodes or movies behind: %s' % sorted(left)[:10])
+    delivered = (_count_files(os.path.join(library, 'Series'), '.mkv'),
+                 _count_files(os.path.join(library, 'Movies'), '.mp4'))
+    if delivered != (len(episodes), len(titles)):
+        raise AssertionError('expected %d episodes and %d movies to be delivered, found %d and %d'
+                             % (len(episodes), len(titles), *delivered))
+    return {
+        'series': len(series),
+        'loose_files': args.files,
+        'episodes': len(episodes),
+        'releases': len(titles),
+        'tmdb_queries': fake_tmdb.queries,
+        'execute_s': elapsed,
+        'files_per_s': (args.files + len(titles)) / elapsed if elapsed else None,
+        'stages': stages,
+    }
+
+
+def bench_pipeline(args, rng):
+    """Full CopyMedia.execute runs against synthetic downloads: once into local folders and once to a
+    fake NAS over the stub ssh/rsync, with TMDB answered by a local HTTP server."""
+
+    enabled, timing.enabled = timing.enabled, True
+    results = {}
+    try:
+        root = tempfile.mkdtemp(prefix='copymedia-pipeline-')
+        try:
+            local = os.path.join(root, 'local')
+            results['local'] = run_pipeline(local, os.path.join(local, 'library'), args, random.Random(args.seed))
+            nas = os.path.join(root, 'nas')
+            with fakes.FakeNAS(os.path.join(nas, 'volume1')) as fake_nas:
+                results['nas'] = run_pipeline(nas, fake_nas.root, args, random.Random(args.seed), fake_nas)
+        finally:
+            shutil.rmtree(root)
+    finally:
+        timing.enabled = enabled
+    return results
+
+
+BENCHMARKS = {
+    'config': bench_config,
+    'match': bench_match,
+    'parse': bench_parse,
+    'pipeline': bench_pipeline,
+    'rename': bench_rename,
+    'scan': bench_scan,
+    'startup': bench_startup,
+}
+
+
+def main():
+    args = argParser.parse_args()
+    logger.config(level=logging.WARNING)
+
+    names = args.benchmarks or list(BENCHMARKS)
+    results = {}
+    for name in names:
+        results[name] = BENCHMARKS[name](args, random.Random(args.seed))
+        print(name, json.dumps(results[name], indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.time(), 'python': sys.version.split()[0], 'args': vars(args),
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
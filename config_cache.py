@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+import pickle
+
+CACHE_DIR = '.cache'
+# Bump whenever the shape of the compiled data changes, so stale caches are rebuilt.
+CACHE_VERSION = 2
+
+
+def default_cache_dir(config_file):
+    return os.path.join(os.path.dirname(os.path.abspath(config_file)), CACHE_DIR)
+
+
+def _digest(data):
+    import hashlib
+
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def load(config_file, compile_config, cache_dir=None):
+    """Return (config, compiled) for config_file, where compiled = compile_config(config).
+
+    The result is pickled in cache_dir (default: .cache beside the config) keyed by the file's
+    size, modification time and content hash. An unchanged file is loaded from the cache without
+    parsing the JSON or calling compile_config. A touched but otherwise identical file is
+    recognised by its hash. Anything compile_config raises (validation errors) propagates and
+    nothing is cached."""
+
+    cache_dir = cache_dir or default_cache_dir(config_file)
+    cache_file = os.path.join(cache_dir, os.path.basename(config_file) + '.pickle')
+
+    st = os.stat(config_file)
+    cached = _read(cache_file)
+    if cached and (cached['size'], cached['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+        logging.debug('Loaded compiled configuration from [%s]', cache_file)
+        return cached['config'], cached['compiled']
+
+    with open(config_file, 'rb') as configfile:
+        data = configfile.read()
+    digest = _digest(data)
+
+    if cached and cached['digest'] == digest:
+        logging.debug('Configuration [%s] was touched but not changed', config_file)
+        config, compiled = cached['config'], cached['compiled']
+    else:
+        logging.debug('Compiling configuration [%s]', config_file)
+        config = json.loads(data)
+        compiled = compile_config(config)
+
+    _write(cache_file, {'version': CACHE_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                        'digest': digest, 'config': config, 'compiled': compiled})
+    return config, compiled
+
+
+def _read(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached.get('version') == CACHE_VERSION:
+            return cached
+    except FileNotFoundError:
+        pass
+    except Exception:
+        # Truncated, from another version of the code, ...: just compile again.
+        logging.debug('Ignoring unreadable config cache [%s]', cache_file, exc_info=True)
+    return None
+
+
+def _write(cache_file, cached):
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logging.debug('Could not write config cache [%s]', cache_file, exc_info=True)
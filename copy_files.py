@@ -2,24 +2,55 @@
 
 import argparse
 import getpass
-import glob
-import json
 import logging
 import re
 import shutil
+import signal
 import subprocess
-from os import listdir, path, makedirs, rename, remove, rmdir, walk
+from os import listdir, path, makedirs, rename, remove, rmdir, stat
 from os.path import isdir, isfile, join, split
 
+import config_cache
+import dedup
 import ifttt
+import journal
 import logger
-import ntfy
+import metadata
+import notify
+import planner
 import remote
+import scan
+import scheduler
+import timing
 import tmdb
+import transfer
+import watcher
 from exceptions import ConfigurationError
+from matcher import MatchedFile, Renamer, SeriesMatcher
+from scheduler import TransferScheduler
 
 # Set up default file locations for configs and logs
 CONFIG_FILE = './CopyMedia.json'
+PROFILE_FILE = './profile.json'
+# Work folder inside the scan directory; never picked up as a download itself
+STAGE_DIR = 'tmp'
+
+# Ways of removing meta-data from movies (metadataStrip config setting)
+STRIP_STREAM = 'stream'
+STRIP_IN_PLACE = 'inplace'
+STRIP_REWRITE = 'rewrite'
+STRIP_MODES = (STRIP_STREAM, STRIP_IN_PLACE, STRIP_REWRITE)
+
+FFMPEG_STRIP_ARGS = ['-map_metadata', '-1', '-c:v', 'copy', '-c:a', 'copy']
+# Output formats that can be written to a pipe, keyed by file extension. MP4 could only be piped as a
+# fragmented file, so MP4 movies going to a remote host are stripped locally and sent as they are.
+STREAM_FORMATS = {
+    '.mkv': ['-f', 'matroska'],
+}
+
+# Folders inside a movie release that never hold the feature (movieSkipDirs config setting)
+SKIP_DIRS = re.compile(r'^(samples?|extras?|featurettes?|trailers?|bonus|behind.the.scenes|deleted.scenes)$',
+                       re.IGNORECASE)
 
 # Set up command line arguments
 argParser = argparse.ArgumentParser(description='Copy/transform large files.')
@@ -36,6 +67,18 @@ argParser.add_argument('-c', '--config', help='Configuration file',
 argParser.add_argument('-t', '--tmdb', help='The Movie DB API key')
 argParser.add_argument('-n', '--ntfy-token', help='ntfy access token', dest='ntfy_token')
 argParser.add_argument('-l', '--log', help='Log file')
+argParser.add_argument('--daemon', action='store_true',
+                       help='Keep running and process new downloads as they appear in the scan directory')
+argParser.add_argument('--enqueue', action='store_true',
+                       help='Hand the file to a running daemon through its spool directory and return immediately')
+argParser.add_argument('--rebuild-dedup-index', action='store_true', dest='rebuild_dedup_index',
+                       help='Re-create the dedup index from the files in the local series and movie directories')
+argParser.add_argument('--profile', action='store_true',
+                       help='Time each stage of the run and print a summary at the end')
+argParser.add_argument('--profile-json', dest='profile_json', default=PROFILE_FILE,
+                       help='Where --profile writes the stage timings as JSON')
+argParser.add_argument('--cprofile', metavar='FILE',
+                       help='Also run under cProfile and save the statistics to FILE (implies --profile)')
 argParser.add_argument('delugeArgs', default=[], nargs='*',
                        help='If deluge is used, there will be three args,'
                             ' in this order: Torrent Id, Torrent Name, and Torrent Path')
@@ -53,8 +96,28 @@ class CopyMedia:
     tmdb_key = None
     ntfy_url = None
     ntfy_token = None
+    notifier = None
+
+    tmdb_cache_file = None
+    tmdb_cache_options = None
+    tmdb_cache = None
+
+    transfer_limits = None
+    journal_file = None
+    journal = None
+    dedup_index_file = None
+    dedup_index = None
+    dedup_mode = dedup.MODE_OFF
+    delivery_modes = {transfer.SERIES: transfer.MOVE, transfer.MOVIES: transfer.MOVE}
+    copy_cache = transfer.CACHE_NORMAL
+    verify_transfers = False
+    spool_dir = None
+    strip_mode = STRIP_STREAM
+    feature_size = None
+    skip_dirs = SKIP_DIRS
 
     series = None
+    matcher = None
 
     def __init__(self, logfile=None, config_file=None, ifttt_url=None, scandir=None,
                  seriesdir=None, file=None, tmdb_key=None, moviedir=None,
@@ -69,6 +132,8 @@ class CopyMedia:
         self.tmdb_key = tmdb_key
         self.ntfy_url = ntfy_url
         self.ntfy_token = ntfy_token
+        # (size, sha256) of files delivered with verifyTransfers, until _transfer stores them
+        self._verified = {}
 
         # initialize logging
         if self.logfile:
@@ -95,14 +160,103 @@ class CopyMedia:
         logging.debug('TMDB key: [%s]', self.tmdb_key)
 
     def _notify_error(self, message):
-        if self.ntfy_url and self.ntfy_token:
-            ntfy.send_notification(self.ntfy_url, self.ntfy_token, message)
+        """Queue an error notification for ntfy; it goes out in the background, possibly with others."""
+        if self.notifier is not None and self.ntfy_url and self.ntfy_token:
+            self.notifier.post(notify.NtfyChannel(self.ntfy_url, self.ntfy_token), message)
+
+    def _get_tmdb_cache(self):
+        """Open the TMDB lookup cache on first use, so runs that never query TMDB don't touch it."""
+
+        if self.tmdb_cache is None and self.tmdb_cache_file and self.tmdb_key:
+            import sqlite3
+
+            try:
+                self.tmdb_cache = tmdb.LookupCache(self.tmdb_cache_file, **self.tmdb_cache_options)
+            except sqlite3.Error:
+                logging.exception('Could not open TMDB cache [%s]; continuing without it.', self.tmdb_cache_file)
+                self.tmdb_cache_file = None
+        return self.tmdb_cache
+
+    def _get_journal(self):
+        """Open the transfer journal on first use. Returns None if it is disabled or can't be opened."""
+
+        if self.journal is None and self.journal_file:
+            try:
+                self.journal = journal.TransferJournal(self.journal_file)
+            except OSError:
+                logging.exception('Could not open transfer journal [%s]; continuing without it.', self.journal_file)
+                self.journal_file = None
+        return self.journal
+
+    def _get_dedup_index(self):
+        """Open the index of delivered files on first use. Returns None if it is disabled or can't be opened."""
+
+        if self.dedup_index is None and self.dedup_index_file:
+            import sqlite3
+
+            try:
+                self.dedup_index = dedup.DedupIndex(self.dedup_index_file)
+            except sqlite3.Error:
+                logging.exception('Could not open dedup index [%s]; continuing without it.', self.dedup_index_file)
+                self.dedup_index_file = None
+        return self.dedup_index
+
+    def rebuild_dedup_index(self):
+        """Re-create the index of delivered files from what is in the local series and movie directories."""
+
+        index = self._get_dedup_index()
+        if index is None:
+            raise ConfigurationError('The dedup index is disabled (dedupIndexFile is null).')
+        roots = []
+        for root in (self.seriesdir, self.moviedir):
+            if remote.is_remote(root):
+                logging.warning('Cannot index remote destination [%s] from here; it is filled as files are delivered',
+                                root)
+            elif root not in roots:
+                roots.append(root)
+        return index.rebuild(roots)
+
+    def resume_transfers(self):
+        """Finish the moves an earlier run planned or started but never completed.
+
+        Sources that are gone, or no longer match the checksum taken when the move was planned, are
+        abandoned and left to the normal scan. Returns the dict of results for the resumed moves."""
+
+        transfer_journal = self._get_journal()
+        if transfer_journal is None:
+            return {}
+
+        groups = {}
+        streams = set()
+        for record in transfer_journal.unfinished():
+            src, dest = record['src'], record['dest']
+            try:
+                unchanged = dest and record['checksum'] == journal.checksum(src)
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                logging.info('Not resuming move of [%s]; the source is gone or has changed', src)
+                transfer_journal.mark(src, journal.ABANDONED)
+                continue
+            # Keep moves to the same folder together and in order, as move_series does.
+            groups.setdefault(path.dirname(dest), []).append((src, dest))
+            if record.get('stream'):
+                streams.add(src)
+
+        if not groups:
+            return {}
+        logging.info('Resuming %d unfinished transfer(s) from [%s]', sum(map(len, groups.values())),
+                     self.journal_file)
+        return self._transfer(list(groups.values()), resume=True, streams=streams)
 
     def execute(self):
         """Initiate the scanning, matching, transformation, and movement of media."""
 
         logging.debug('Begin processing execution...')
 
+        # Anything a crashed run left half-moved goes first, before it is picked up by the scan again.
+        self.resume_transfers()
+
         # Build list of files based on whether a single file has been
         # specified or whether we need to scan a directory
         files = []
@@ -116,8 +270,12 @@ class CopyMedia:
                 dirs.append(name)
         else:
             logging.debug('Scanning [%s] for files to process.', self.scandir)
-            files = [f for f in listdir(self.scandir) if isfile(join(self.scandir, f))]
-            dirs = [d for d in listdir(self.scandir) if isdir(join(self.scandir, d)) and d != 'tmp']
+            with timing.stage(timing.SCAN):
+                scan_result = scan.scan_dir(self.scandir)
+            files = scan_result.file_names()
+            dirs = [d for d in scan_result.dir_names() if d != STAGE_DIR]
+
+        files, dirs = self._skip_seeding(files), self._skip_seeding(dirs)
 
         if files or dirs:
             if files:
@@ -130,8 +288,82 @@ class CopyMedia:
         else:
             logging.info('No files or directories found. Stopping.')
 
+        self.finish()
+
         logging.debug('Processing complete.')
 
+    def _skip_seeding(self, names):
+        """Drop the scan directory entries that were already delivered and left in place to keep seeding."""
+
+        if not self._leaves_sources():
+            return names
+        index = self._get_dedup_index()
+        if index is None:
+            return names
+        remaining = []
+        for name in names:
+            src = join(self.scandir, name)
+            try:
+                if index.is_seeding(src, dedup.signature(src)):
+                    logging.debug('[%s] was already delivered; leaving it to seed', src)
+                    continue
+            except OSError:
+                pass
+            remaining.append(name)
+        return remaining
+
+    def _leaves_sources(self):
+        return any(mode != transfer.MOVE for mode in self.delivery_modes.values())
+
+    def _record_seeding(self, sources):
+        """Remember sources that were delivered but left in place, so the next scan skips them."""
+
+        index = self._get_dedup_index()
+        if index is None or not sources:
+            return
+        signatures = {}
+        for src in sources:
+            try:
+                signatures[src] = dedup.signature(src)
+            except OSError:
+                logging.debug('Could not take signature of [%s]', src, exc_info=True)
+        index.record_seeding(signatures)
+
+    def _delivery_mode(self, src_path, dest_path):
+        """The deliveryMode for one transfer: the movie mode for the movie directory, else the series mode.
+
+        Files staged in the work folder are copies made for this run, so they are always moved."""
+
+        stage_dir = join(self.scandir, STAGE_DIR) if self.scandir else None
+        if stage_dir and path.abspath(src_path).startswith(path.abspath(stage_dir) + path.sep):
+            return transfer.MOVE
+        if self.moviedir and dest_path.startswith(self.moviedir.rstrip('/') + '/'):
+            return self.delivery_modes[transfer.MOVIES]
+        return self.delivery_modes[transfer.SERIES]
+
+    def finish(self):
+        """Release per-run resources: SSH control connections, queued notifications, the transfer journal,
+        the dedup index and the TMDB cache."""
+
+        remote.close_masters()
+        metadata.log_stats()
+        if self.notifier is not None:
+            self.notifier.flush()
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+        if self.dedup_index is not None:
+            self.dedup_index.log_stats()
+            self.dedup_index.close()
+            self.dedup_index = None
+
+        if self.tmdb_cache is not None:
+            self.tmdb_cache.log_stats()
+            self.tmdb_cache.close()
+            self.tmdb_cache = None
+
     def process_dirs(self, dirs):
         """Process all directories provided.
 
@@ -139,7 +371,8 @@ class CopyMedia:
         if there is a matching movie. If so, then process the directory as a movie."""
 
         logging.debug('Checking directories to see if they are movies...')
-        movies = [d for d in dirs if tmdb.is_movie(d, self.tmdb_key)]
+        results = tmdb.classify_many(dirs, self.tmdb_key, self._get_tmdb_cache())
+        movies = [d for d, is_movie in zip(dirs, results) if is_movie]
         logging.debug('Found movies: [%s]', movies)
 
         if self.moviedir is not None:
@@ -159,33 +392,99 @@ class CopyMedia:
         6) Move the directory to the configured Movie directory."""
 
         movie_dir = join(self.scandir, movie_dir_name)
+        release_dir = None
 
         if self.moviedir is not None:
-            movie = self.find_largest_file(movie_dir)
-
+            # One walk of the release folder decides the movie, its subtitles and everything to delete.
+            plan = planner.plan_movie(movie_dir, self.feature_size, self.skip_dirs)
+            mode = self.delivery_modes[transfer.MOVIES]
             try:
+                if plan.movie is None:
+                    raise RuntimeError('No files found in %s' % movie_dir)
+                if mode != transfer.MOVE:
+                    # Leave the release alone (it is seeding) and work on a copy of what we keep.
+                    release_dir = movie_dir
+                    plan = self._stage_release(plan, mode)
+                    movie_dir = plan.base_dir
+                movie = plan.movie
+                if path.dirname(movie) != movie_dir:
+                    # Found in a sub-folder; bring it up so the release folder is the one renamed.
+                    logging.debug('Moving movie [%s] up to [%s]', movie, movie_dir)
+                    top_level = join(movie_dir, path.basename(movie))
+                    rename(movie, top_level)
+                    movie = top_level
                 base_name, movie, movie_dir = self.rename_movie(movie)
-            except RuntimeError:
+            except (RuntimeError, OSError):
                 logging.exception('Could not re-name movie file.')
+                if release_dir not in (None, movie_dir):
+                    shutil.rmtree(movie_dir, ignore_errors=True)
                 return
+            plan = plan.moved_to(movie_dir, movie)
 
-            subtitle_files = self.process_subtitles(movie_dir, base_name)
+            subtitle_files = self.process_subtitles(movie_dir, base_name, plan=plan)
 
-            self.clean_dir(movie_dir, movie, subtitle_files)
+            self.clean_dir(movie_dir, movie, subtitle_files, plan=plan)
 
-            self.strip_metadata(movie)
+            if self.strip_mode == STRIP_STREAM:
+                # The movie is stripped on its way to the library; the subtitles follow it.
+                dest_dir = join(self.moviedir, path.basename(movie_dir))
+                moves = [(f, join(dest_dir, path.basename(f))) for f in [movie, *sorted(subtitle_files)]]
+                results = self._transfer([moves], streams={movie})
+                if all(results.values()) and not listdir(movie_dir):
+                    rmdir(movie_dir)
+                    if release_dir is not None:
+                        self._record_seeding([release_dir])
+                return
 
-            self.move_movies([movie_dir], self.moviedir)
+            # A hard-linked copy shares its data with the seeding original; never modify it in place.
+            in_place = stat(movie).st_nlink == 1
+            self.strip_metadata(movie, in_place=self.strip_mode == STRIP_IN_PLACE and in_place)
+
+            results = self.move_movies([movie_dir], self.moviedir)
+            if release_dir is not None and results.get(movie_dir):
+                self._record_seeding([release_dir])
+
+    def _stage_release(self, plan, mode):
+        """Deliver the movie and subtitles of plan into the work folder with mode, leaving the release untouched.
+
+        The movie goes to the top of the staged folder; subtitles keep their order but are flattened into it.
+        Returns the plan for the staged copy, which holds nothing else to delete."""
+
+        stage_dir = join(self.scandir, STAGE_DIR, path.basename(plan.base_dir))
+        if path.exists(stage_dir):
+            # Left over from an interrupted run.
+            shutil.rmtree(stage_dir)
+        makedirs(stage_dir)
+
+        movie = join(stage_dir, path.basename(plan.movie))
+        subtitles = tuple(join(stage_dir, path.relpath(sub, plan.base_dir).replace(path.sep, '_'))
+                          for sub in plan.subtitles)
+        logging.debug('Staging [%s] in [%s] (%s)', plan.base_dir, stage_dir, mode)
+        try:
+            with timing.stage(timing.LOCAL_MOVE), transfer.Mover(mode, self.copy_cache, self.verify_transfers) as mover:
+                for src, dest in zip((plan.movie, *plan.subtitles), (movie, *subtitles)):
+                    mover.move(src, dest)
+            staged = all(mover.results.get(src) for src in (plan.movie, *plan.subtitles))
+        except OSError:
+            logging.debug('Staging [%s] failed', plan.base_dir, exc_info=True)
+            staged = False
+        if not staged:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            raise RuntimeError('Could not stage %s' % plan.base_dir)
+        return planner.MoviePlan(stage_dir, movie, subtitles, frozenset(), (), ())
 
     @staticmethod
-    def find_largest_file(base_dir):
-        """Identify the actual movie file. This is the single largest file in the directory."""
+    def find_largest_file(base_dir, feature_size=None, skip_dirs=SKIP_DIRS):
+        """Identify the actual movie file. This is the single largest file in the directory tree.
+
+        Sub-directories are searched too, except those matching skip_dirs (samples, extras, ...). If
+        feature_size (bytes) is given, the first file at least that big is taken without looking further."""
 
         logging.debug('Looking for largest file in directory: [%s]', base_dir)
-        full_names = [path.join(base_dir, fname) for fname in listdir(base_dir)]
-        logging.debug('Found file list: [%s]', full_names)
-        largest = sorted((path.getsize(s), s) for s in full_names)[-1][1]
+        largest = scan.largest_file(scan.walk(base_dir, skip_dirs), feature_size)
 
+        if largest is None:
+            raise RuntimeError('No files found in %s' % base_dir)
         logging.debug('Largest file: [%s]', largest)
         return largest
 
@@ -229,7 +528,7 @@ class CopyMedia:
         return new_base_name, new_movie_name, new_dir_name
 
     @staticmethod
-    def process_subtitles(base_dir, base_name, simulate=False):
+    def process_subtitles(base_dir, base_name, simulate=False, plan=None):
         """Look for usable english sub-title files.
 
         If english subtitles found with the srt extension, ensure file is in the same directory as
@@ -237,11 +536,15 @@ class CopyMedia:
         with their full absolute path.
 
         If simulate is true, then calculate and log all the file move/renames WOULD happen, but do not
-        actually execute the file system changes."""
+        actually execute the file system changes. If a planner.MoviePlan for base_dir is given, its subtitles
+        are used instead of searching the directory again."""
 
         logging.debug('Processing subtitles files in directory [%s] for media with name [%s]...', base_dir, base_name)
 
-        english_subtitles = CopyMedia.find_english_subtitles(base_dir)
+        if plan is not None:
+            english_subtitles = plan.subtitles
+        else:
+            english_subtitles = CopyMedia.find_english_subtitles(base_dir)
 
         moved_subtitles = set()
 
@@ -278,30 +581,15 @@ class CopyMedia:
     def find_english_subtitles(base_dir):
         """Identify all english subtitle files in a directory.
 
-        Look for all srt files in the given directory and filter down to just the ones that indicate
+        Look for all srt files in the given directory tree and filter down to just the ones that indicate
         they are for the english language. If more than one english subtitle file is found,
         return all of them."""
 
         logging.debug('Looking for subtitle files with extension "srt"')
 
-        srt_files = glob.glob(path.join(base_dir, '**/*.srt'), recursive=True)
-
-        logging.log(logger.TRACE, 'Found srt files: %s', srt_files)
-
-        english_tokens = {'english', 'eng', 'en'}
-
-        # for each srt file, take the file's basename, split it into tokens based on 1 or more non-letters as the
-        # delimiter. Then process the tokens in the reverse order (because the english indicator tends to be at the
-        # end of the file names) looking for a match to one of the recognized english tags.
-        srt_english = []
-        for srt_file in srt_files:
-            srt_file_name = path.basename(srt_file)
-
-            split_name = re.split('[^A-Za-z]+', srt_file_name)
-
-            for token in reversed(split_name):
-                if token.lower() in english_tokens:
-                    srt_english.append(srt_file)
+        srt_english = [e.path for e in scan.walk(base_dir)
+                       if not e.is_dir and planner.is_english_subtitle(e.name)
+                       and not planner.is_hidden(e.path, base_dir)]
 
         # Make sure list is alphabetically sorted
         srt_english.sort()
@@ -314,55 +602,153 @@ class CopyMedia:
         return srt_english
 
     @staticmethod
-    def clean_dir(base_dir, movie, subtitle_files, simulate=False):
+    def clean_dir(base_dir, movie, subtitle_files, simulate=False, plan=None):
         """Remove all other files and sub-directories except the movie file and any sub-titles.
 
         Return list of files that were NOT deleted.
 
         If simulate is true, then compute all file/directory deletions but do not execute
-        file system operations."""
+        file system operations. If a planner.MoviePlan for base_dir is given, its delete set is used
+        instead of walking the directory again."""
 
         logging.debug('Removing irrelevant files from base dir %s', base_dir)
         logging.log(logger.TRACE, 'Leaving movie file %s with subtitle files %s', movie, subtitle_files)
 
         # Note: base_dir, movie, and all subtitle_files include the full absolute path.
 
-        # Recursively walk through the entire directory tree starting at the root of the base directory.
+        if plan is not None:
+            return CopyMedia._apply_deletes(plan, movie, subtitle_files, simulate)
+
+        entries = scan.walk(base_dir)
+
         # Delete all files and directories EXCEPT for the designated movie file and any of the subtitle files.
+        # The walk lists parents before their children, so directories are removed in reverse order.
+        keep = {movie, *subtitle_files}
         ignored_files = []
-        for root, dirs, files in walk(base_dir, topdown=False):
-            for name in files:
-                delete_path = path.join(root, name)
+        dirs = []
+        for entry in entries:
+            if entry.is_dir:
+                dirs.append(entry.path)
+            elif entry.path in keep:
                 # Leave the movie and subtitle files alone
-                if movie == delete_path or delete_path in subtitle_files:
-                    logging.debug("Will not delete file: [%s]", delete_path)
-                    ignored_files.append(delete_path)
-                else:
-                    logging.log(logger.TRACE, 'Deleting file [%s]', delete_path)
-                    if not simulate:
-                        remove(delete_path)
-            for name in dirs:
-                delete_path = path.join(root, name)
-                logging.log(logger.TRACE, 'Deleting directory [%s]', delete_path)
+                logging.debug("Will not delete file: [%s]", entry.path)
+                ignored_files.append(entry.path)
+            else:
+                logging.log(logger.TRACE, 'Deleting file [%s]', entry.path)
                 if not simulate:
-                    rmdir(delete_path)
+                    remove(entry.path)
+        for delete_path in reversed(dirs):
+            logging.log(logger.TRACE, 'Deleting directory [%s]', delete_path)
+            if not simulate:
+                rmdir(delete_path)
 
         return ignored_files
 
     @staticmethod
-    def strip_metadata(movie):
-        """Use ffmpeg to strip all meta-data from the movie file"""
+    def _apply_deletes(plan, movie, subtitle_files, simulate):
+        keep = {movie, *subtitle_files}
+        for delete_path in sorted(plan.delete_files):
+            if delete_path in keep:
+                continue
+            logging.log(logger.TRACE, 'Deleting file [%s]', delete_path)
+            if not simulate:
+                remove(delete_path)
+        for delete_path in plan.prune_dirs:
+            logging.log(logger.TRACE, 'Deleting skipped directory [%s]', delete_path)
+            if not simulate:
+                shutil.rmtree(delete_path)
+        # Directories still holding the movie or a subtitle stay.
+        keep_dirs = {path.dirname(p) for p in keep}
+        for delete_path in plan.delete_dirs:
+            if any(d == delete_path or d.startswith(delete_path + path.sep) for d in keep_dirs):
+                continue
+            logging.log(logger.TRACE, 'Deleting directory [%s]', delete_path)
+            if not simulate:
+                rmdir(delete_path)
+        return [movie, *subtitle_files]
+
+    @staticmethod
+    def strip_metadata(movie, dest=None, in_place=True, verified=None):
+        """Use ffmpeg to strip all meta-data from the movie file.
+
+        If dest is given, ffmpeg's output goes straight to dest, either a local path on the target file
+        system or a remote user@host:/path, and the original is removed. That way the movie is written once
+        instead of being rewritten next to the original and then copied again. Without dest (or if
+        streaming isn't possible) the container meta-data is blanked in place when in_place is set and the
+        container supports it; otherwise the file is rewritten beside the original and swapped in.
+
+        A header-only check runs first, and movies without any meta-data worth removing are left untouched.
+
+        With verified (a dict), a stream to a remote dest is checked end to end like remote.send_verified
+        and its (size, sha256) is stored in verified under dest. A local dest is not streamed then: the
+        movie is stripped where it is and left for a verified copy.
+
+        Returns True if the stripped movie ended up at dest, False if it is still at movie."""
+
+        if not metadata.needs_strip(movie):
+            return False
 
         logging.debug('Stripping meta-data from movie: [%s]', movie)
         split_name = path.splitext(movie)
+        ffmpeg = ['ffmpeg', '-loglevel', 'error', '-i', movie] + FFMPEG_STRIP_ARGS
+
+        if dest is not None and verified is not None and not remote.is_remote(dest):
+            logging.debug('Not streaming [%s] to local [%s]; it is stripped first so its copy can be verified.',
+                          movie, dest)
+            dest = None
+        elif dest is not None and remote.is_remote(dest) and split_name[1].lower() not in STREAM_FORMATS:
+            logging.debug('Cannot stream [%s] containers to [%s]; stripping locally instead.', split_name[1], dest)
+            dest = None
+
+        if dest is not None:
+            if remote.is_remote(dest):
+                stream_format = STREAM_FORMATS[split_name[1].lower()]
+                if verified is not None:
+                    logging.debug('Streaming stripped movie to [%s] with verification', dest)
+                    delivered = remote.stream_verified(ffmpeg + stream_format + ['pipe:1'], dest)
+                    streamed = delivered is not None
+                    if streamed:
+                        verified[dest] = delivered
+                else:
+                    logging.debug('Streaming stripped movie to [%s]', dest)
+                    streamed = remote.stream(ffmpeg + stream_format + ['pipe:1'], dest)
+            else:
+                dest_split = path.splitext(dest)
+                partial = dest_split[0] + '.part' + dest_split[1]
+                makedirs(path.dirname(dest), exist_ok=True)
+                logging.debug('Writing stripped movie directly to [%s]', dest)
+                with timing.stage(timing.FFMPEG):
+                    streamed = subprocess.run(ffmpeg + ['-y', partial]).returncode == 0
+                if streamed:
+                    rename(partial, dest)
+                elif path.exists(partial):
+                    remove(partial)
+
+            if streamed:
+                remove(movie)
+                logging.debug('Stripping meta-data complete; movie written once to [%s].', dest)
+                return True
+            logging.warning('Could not stream [%s] to [%s]; falling back to stripping in place.', movie, dest)
+
+        if in_place and metadata.strip_in_place(movie):
+            logging.debug('Stripping meta-data complete (in place).')
+            return False
+
         stripped_movie = split_name[0] + '.out' + split_name[1]
-        subprocess.run(['ffmpeg', '-i', movie, '-map_metadata', '-1', '-c:v', 'copy', '-c:a', 'copy', stripped_movie])
+        with timing.stage(timing.FFMPEG):
+            stripped = subprocess.run(ffmpeg + [stripped_movie]).returncode == 0
+        if not stripped:
+            logging.error('ffmpeg failed to strip meta-data from [%s]; keeping the original.', movie)
+            if path.exists(stripped_movie):
+                remove(stripped_movie)
+            return False
 
         # Remove original and rename the new one to replace the old one.
         remove(movie)
         rename(stripped_movie, movie)
 
         logging.debug('Stripping meta-data complete.')
+        return False
 
     def process_files(self, files):
         """Process all individual files provided.
@@ -371,22 +757,24 @@ class CopyMedia:
         a check will be performed to determine if the file is a stand-alone movie."""
 
         # Find matching files
-        matches, nonmatches = self.match_files(files, self.series)
+        matches, nonmatches = self.match_files(files, self.matcher)
 
         if matches and self.seriesdir is not None:
             # Move matching series files to their respective destination directories
             logging.debug('Found series matches to move: [%s]', matches)
-            self.move_series(matches, self.seriesdir, self.scandir)
+            results = self.move_series(matches, self.seriesdir, self.scandir)
 
-            if self.ifttt_url is not None:
-                ifttt.send_notification(matches, self.ifttt_url)
+            moved = [m for m in matches if results.get(m[0])]
+            if self.notifier is not None and self.ifttt_url is not None and moved:
+                self.notifier.post(notify.IftttChannel(self.ifttt_url), moved)
 
         if nonmatches and self.moviedir is not None:
             # If there are files that didn't match a configured series and the destination directory
             # for movies has been specified, then check if the remaining files are movies, and if so move
             # to the designated movie directory.
             logging.debug('Some files did not have matches. Checking if they are movies...')
-            movie_files = [file for file in files if tmdb.is_movie(file, self.tmdb_key)]
+            results = tmdb.classify_many(nonmatches, self.tmdb_key, self._get_tmdb_cache())
+            movie_files = [join(self.scandir, file) for file, is_movie in zip(nonmatches, results) if is_movie]
             logging.debug('Found movies: [%s]', movie_files)
             self.move_movies(movie_files, self.moviedir)
 
@@ -395,10 +783,11 @@ class CopyMedia:
 
         logging.debug('Using configuration file: [%s]', config_file)
 
-        # parse config file as json and process settings found inside
-        with open(config_file) as configfile:
-            config = json.load(configfile)
-            return self.process_configs(config)
+        # parse config file as json and process settings found inside. The validated series index is
+        # cached, so it is only rebuilt when the file changes.
+        with timing.stage(timing.CONFIG):
+            config, self.matcher = config_cache.load(config_file, self.compile_series)
+        return self.process_configs(config)
 
     def process_configs(self, config):
         """Used to process the configuration from the configuration file
@@ -463,24 +852,119 @@ class CopyMedia:
                           'configuration file.')
             raise ConfigurationError('Missing destination movie directory')
 
+        try:
+            self.transfer_limits = scheduler.parse_limits(config.get('maxParallelTransfers'))
+        except (TypeError, ValueError) as e:
+            logging.error('Invalid maxParallelTransfers setting: [%s]', config.get('maxParallelTransfers'))
+            raise ConfigurationError('Invalid maxParallelTransfers: %s' % e)
+        logging.debug('Parallel transfer limits: [%s]', self.transfer_limits)
+
+        self.strip_mode = config.get('metadataStrip', STRIP_STREAM)
+        if self.strip_mode not in STRIP_MODES:
+            logging.error('metadataStrip must be one of %s, not [%s]', STRIP_MODES, self.strip_mode)
+            raise ConfigurationError('Invalid metadataStrip: %s' % self.strip_mode)
+        logging.debug('Meta-data strip mode: [%s]', self.strip_mode)
+
+        try:
+            if config.get('movieFeatureSizeMB') is not None:
+                self.feature_size = int(float(config['movieFeatureSizeMB']) * 1024 * 1024)
+            if config.get('movieSkipDirs') is not None:
+                self.skip_dirs = re.compile(config['movieSkipDirs'], re.IGNORECASE)
+        except (TypeError, ValueError, re.error) as e:
+            logging.error('Invalid movieFeatureSizeMB/movieSkipDirs setting')
+            raise ConfigurationError('Invalid movie file search settings: %s' % e)
+
+        self.spool_dir = config.get('spoolDir') or watcher.default_spool_dir(self.config_file or CONFIG_FILE)
+
+        remote.MULTIPLEX = config.get('sshMultiplex', True)
+        logging.debug('SSH connection multiplexing: [%s]', remote.MULTIPLEX)
+
         if self.ifttt_url:
             logging.debug('IFTTT URL: [%s]', self.ifttt_url)
         else:
             logging.debug('IFTTT notification url not provided.')
 
+        # Notifications go out from a background thread, merged into digests.
+        try:
+            self.notifier = notify.Dispatcher(window=float(config.get('notifyDigestSeconds', notify.DIGEST_WINDOW)),
+                                              timeout=float(config.get('notifyTimeoutSeconds', notify.TIMEOUT)))
+        except (TypeError, ValueError):
+            logging.error('notifyDigestSeconds and notifyTimeoutSeconds must be numbers')
+            raise ConfigurationError('Invalid notification settings')
+
         if self.tmdb_key:
             logging.debug('TMDB API Key: [%s]', self.tmdb_key)
         else:
             logging.debug('TMDB API key not provided.')
 
-        if 'series' in config:
-            self.series = config['series']
-            self.validate_series(self.series)
-        else:
+        # The TMDB lookup cache lives beside the config file unless configured otherwise.
+        # Setting tmdbCacheFile to null disables it.
+        default_cache = join(path.dirname(path.abspath(self.config_file or CONFIG_FILE)), tmdb.CACHE_FILE)
+        self.tmdb_cache_file = config.get('tmdbCacheFile', default_cache)
+        self.tmdb_cache_options = {
+            'positive_ttl': config.get('tmdbCachePositiveDays', tmdb.POSITIVE_TTL / tmdb.DAY) * tmdb.DAY,
+            'negative_ttl': config.get('tmdbCacheNegativeDays', tmdb.NEGATIVE_TTL / tmdb.DAY) * tmdb.DAY,
+            'max_entries': config.get('tmdbCacheMaxEntries', tmdb.MAX_CACHE_ENTRIES),
+        }
+        logging.debug('TMDB cache file: [%s]', self.tmdb_cache_file)
+
+        # Likewise the transfer journal; null disables it.
+        default_journal = join(path.dirname(path.abspath(self.config_file or CONFIG_FILE)), journal.JOURNAL_FILE)
+        self.journal_file = config.get('transferJournal', default_journal)
+        logging.debug('Transfer journal: [%s]', self.journal_file)
+
+        # And the index of delivered files used to skip duplicate downloads.
+        default_index = join(path.dirname(path.abspath(self.config_file or CONFIG_FILE)), dedup.INDEX_FILE)
+        self.dedup_index_file = config.get('dedupIndexFile', default_index)
+        self.dedup_mode = config.get('dedupMode', dedup.MODE_OFF)
+        if self.dedup_mode not in dedup.MODES:
+            logging.error('dedupMode must be one of %s, not [%s]', dedup.MODES, self.dedup_mode)
+            raise ConfigurationError('Invalid dedupMode: %s' % self.dedup_mode)
+        logging.debug('Dedup index: [%s], mode [%s]', self.dedup_index_file, self.dedup_mode)
+
+        try:
+            self.delivery_modes = transfer.parse_modes(config.get('deliveryMode'))
+        except ValueError as e:
+            logging.error('%s', e)
+            raise ConfigurationError('Invalid deliveryMode: %s' % e)
+        logging.debug('Delivery modes: %s', self.delivery_modes)
+        self.copy_cache = config.get('copyCache', transfer.CACHE_NORMAL)
+        if self.copy_cache not in transfer.CACHE_MODES:
+            logging.error('copyCache must be one of %s, not [%s]', transfer.CACHE_MODES, self.copy_cache)
+            raise ConfigurationError('Invalid copyCache: %s' % self.copy_cache)
+
+        self.verify_transfers = bool(config.get('verifyTransfers', False))
+        logging.debug('Verify transfers: [%s]', self.verify_transfers)
+
+        if self._leaves_sources() and not self.dedup_index_file:
+            logging.warning('deliveryMode leaves downloads in place but the dedup index is disabled; '
+                            'they will be delivered again on every run')
+
+        if self.matcher is None or self.matcher.series != config.get('series', []):
+            self.matcher = self.compile_series(config)
+        self.series = self.matcher.series
+        if not self.series:
             logging.warning('No series configured.')
 
         return config
 
+    @staticmethod
+    def compile_series(config):
+        """Validate the configured series and build the SeriesMatcher for them.
+
+        Raises ConfigurationError naming the offending series entry if one is invalid."""
+
+        series = config.get('series', [])
+        for index, show in enumerate(series):
+            try:
+                CopyMedia.validate_series([show])
+                Renamer(show, re.compile(show['regex']))
+            except KeyError as e:
+                raise ConfigurationError('Series entry %d (%s) has no %s' % (index + 1, show.get('name', show), e))
+            except (ValueError, re.error) as e:
+                raise ConfigurationError('Series entry %d (%s) is invalid: %s' % (index + 1, show['name'], e))
+        return SeriesMatcher(series)
+
     @staticmethod
     def validate_series(series):
         """Used to validate the series entries in the configuration.
@@ -504,33 +988,31 @@ class CopyMedia:
             if 'episode_num_sub' in show:
                 # try to convert to int. If conversion doesn't work, then config entry is invalid
                 int(show['episode_num_sub'])
+            if 'season' in show:
+                int(show['season'])
         return True
 
     def move_movies(self, movie_files, move_dir):
-        """Move movie files to the specified destination directory"""
+        """Move movie files to the specified destination directory.
+
+        Returns a dict mapping each movie path to whether it was moved successfully."""
 
         logging.debug('Moving movie files: [%s]', movie_files)
-        for movie in movie_files:
-            start_path = movie
-            dest_path = join(move_dir, path.basename(movie))
-            logging.debug('Moving [%s] to [%s]...', start_path, dest_path)
-            if remote.is_remote(move_dir):
-                if not remote.rsync(start_path, dest_path):
-                    self._notify_error(
-                        'CopyMedia: rsync failed moving [%s] to [%s]' % (start_path, dest_path)
-                    )
-            else:
-                shutil.move(start_path, dest_path)
-                logging.info('Successfully moved [%s] to [%s]', start_path, dest_path)
+        # Every movie is independent of the others, so each one is its own transfer group.
+        return self._transfer([[(movie, join(move_dir, path.basename(movie)))] for movie in movie_files])
 
     def move_series(self, matches, move_dir, start_dir):
-        """Move matching series files to their respective destination directory"""
+        """Move matching series files to their respective destination directory.
+
+        Returns a dict mapping each file name to whether it was moved successfully."""
 
-        destinations = set()
+        groups = {}
+        sources = {}
 
-        for file_name, config_entry in matches:
+        for entry in matches:
+            file_name, config_entry = entry
 
-            dest_file_name = CopyMedia.build_new_name(file_name, config_entry)
+            dest_file_name = CopyMedia.build_new_name(file_name, config_entry, getattr(entry, 'series_match', None))
 
             if 'destination' in config_entry:
                 dest = join(move_dir, config_entry['destination'])
@@ -541,78 +1023,278 @@ class CopyMedia:
 
             src_path = join(start_dir, file_name)
             dest_path = join(dest, dest_file_name)
+            sources[src_path] = file_name
+
+            # Files for the same series folder are kept together so they are moved in order.
+            groups.setdefault(dest, []).append((src_path, dest_path))
+
+        results = self._transfer(list(groups.values()))
+        return {sources[src_path]: success for src_path, success in results.items()}
+
+    def _transfer(self, groups, resume=False, streams=frozenset()):
+        """Run groups of (src_path, dest_path) moves on the transfer scheduler.
+
+        Each local group is moved in order by one worker. Remote groups are spread over as many
+        rsync batches as remote transfers are allowed to run in parallel. Every move is written to
+        the transfer journal before anything starts; resume marks moves taken from the journal, whose
+        partial remote copies are appended to rather than sent again. Returns a dict mapping
+        each source path to whether it was moved successfully.
+
+        Groups are delivered in the deliveryMode of their destination. Remote destinations have no
+        hard links or reflinks, so modes other than move are an rsync copy that keeps the source.
+        With verifyTransfers the SHA-256 of every file copied is stored in the dedup index.
+
+        Sources in streams are movies whose meta-data is stripped on the way: see _stream_movie. They
+        are journalled and indexed like every other move, under the fingerprint of the download."""
+
+        # Fingerprint the sources while they are still here: the index needs them once they are delivered,
+        # and downloads the library already has don't need transferring at all.
+        index = self._get_dedup_index()
+        hashes = {}
+        duplicates = {}
+        if index is not None:
+            groups, duplicates, hashes = self._deduplicate(groups, index, resume)
+
+        moves = [move for group in groups for move in group]
+        transfer_journal = self._get_journal()
+        if transfer_journal is not None and not resume:
+            transfer_journal.plan(moves, streams)
+
+        modes = {src_path: self._delivery_mode(src_path, dest_path) for src_path, dest_path in moves}
+        stream_moves = [move for move in moves if move[0] in streams]
+        groups = [[move for move in group if move[0] not in streams] for group in groups]
+        local_groups = [g for g in groups if g and not remote.is_remote(g[0][1])]
+        remote_groups = [g for g in groups if g and remote.is_remote(g[0][1])]
+        kept_groups = [g for g in remote_groups if modes[g[0][0]] != transfer.MOVE]
+        moved_groups = [g for g in remote_groups if modes[g[0][0]] == transfer.MOVE]
+
+        with TransferScheduler(self.transfer_limits) as transfers:
+            for src_path, dest_path in stream_moves:
+                kind = scheduler.REMOTE if remote.is_remote(dest_path) else scheduler.LOCAL
+                transfers.submit(kind, self._stream_movie, src_path, dest_path, resume)
+            for group in local_groups:
+                transfers.submit(scheduler.LOCAL, self._move_local, group, modes[group[0][0]])
+            for keep_source, mode_groups in ((False, moved_groups), (True, kept_groups)):
+                for chunk in transfers.chunks(scheduler.REMOTE, mode_groups):
+                    transfers.submit(scheduler.REMOTE, self._rsync_batch, chunk, resume, keep_source)
+            results = transfers.wait()
+
+        if index is not None:
+            delivered = {}
+            for src_path, dest_path in moves:
+                if results.get(src_path):
+                    for file_path, key in hashes.get(src_path, {}).items():
+                        relative = path.relpath(file_path, src_path)
+                        delivered[dest_path if relative == '.' else dest_path.rstrip('/') + '/' + relative] = key
+            index.record(delivered)
+        # Filled in by the transfer workers; the index is only used from this thread.
+        verified, self._verified = self._verified, {}
+        if index is not None and verified:
+            index.record_verified(verified)
+
+        results.update(duplicates)
+        self._record_seeding([src_path for src_path, success in results.items()
+                              if success and modes.get(src_path, transfer.MOVE) != transfer.MOVE])
+        return results
+
+    def _deduplicate(self, groups, index, resume=False):
+        """Hash every source and take the downloads the library already has out of groups.
+
+        Returns the remaining groups, {src: True} for the duplicates that were dealt with, and
+        {src: {file: (size, digest)}} for everything that was hashed."""
+
+        hashes = {}
+        duplicates = {}
+        remaining = []
+        for group in groups:
+            kept = []
+            for src_path, dest_path in group:
+                try:
+                    hashes[src_path] = dedup.hash_sources(src_path)
+                except OSError:
+                    logging.debug('Could not hash [%s]', src_path, exc_info=True)
+                    kept.append((src_path, dest_path))
+                    continue
+                if self.dedup_mode != dedup.MODE_OFF and not resume and not path.isdir(src_path):
+                    key = hashes[src_path][src_path]
+                    existing = [p for p in index.lookup(key) if self._still_delivered(p, key)]
+                    if existing and self._deliver_duplicate(src_path, dest_path, existing[-1], key, index):
+                        duplicates[src_path] = True
+                        continue
+                kept.append((src_path, dest_path))
+            remaining.append(kept)
+        return remaining, duplicates, hashes
 
-            if remote.is_remote(move_dir):
-                logging.debug('Moving [%s] to [%s]...', src_path, dest_path)
-                if not remote.rsync(src_path, dest_path):
-                    self._notify_error(
-                        'CopyMedia: rsync failed moving [%s] to [%s]' % (src_path, dest_path)
-                    )
-            else:
-                if not path.exists(dest):
-                    logging.info('Destination does not exist; creating [%s]', dest)
-                    makedirs(dest)
-                logging.debug('Moving [%s] to [%s]...', src_path, dest_path)
-                shutil.move(src_path, dest_path)
-                logging.info('Successfully moved [%s] to [%s]', src_path, dest_path)
+    @staticmethod
+    def _still_delivered(delivered_path, key):
+        """Local copies are checked to still be there (with the right size); remote ones are trusted."""
+        if remote.is_remote(delivered_path):
+            return True
+        try:
+            return path.getsize(delivered_path) == key[0]
+        except OSError:
+            return False
+
+    def _deliver_duplicate(self, src_path, dest_path, existing, key, index):
+        """Deal with src_path, whose content was already delivered as existing, according to dedupMode.
+
+        skip leaves the library alone; replace moves the existing copy to dest_path. Either way the
+        download is not transferred, and is removed unless its deliveryMode leaves it in place.
+        Returns False if it still has to be transferred."""
+
+        if existing != dest_path and self.dedup_mode == dedup.MODE_REPLACE:
+            try:
+                if remote.is_remote(existing) or remote.is_remote(dest_path):
+                    if not remote.rename(existing, dest_path):
+                        return False
+                else:
+                    makedirs(path.dirname(dest_path), exist_ok=True)
+                    rename(existing, dest_path)
+            except OSError:
+                logging.warning('Could not move [%s] to [%s]; transferring [%s] instead', existing, dest_path,
+                                src_path, exc_info=True)
+                return False
+            index.forget([existing])
+            index.record({dest_path: key})
+            logging.info('[%s] is already in the library as [%s]; moved that copy to [%s] instead of transferring',
+                         src_path, existing, dest_path)
+        else:
+            logging.info('[%s] is already in the library as [%s]; skipping the transfer', src_path, existing)
 
-            destinations.add(dest)
+        if self._delivery_mode(src_path, dest_path) == transfer.MOVE:
+            remove(src_path)
+        index.saved(key[0])
+        logging.info('Dedup saved %.1f MB for [%s]', key[0] / 1000000, src_path)
+        return True
 
-        return destinations
+    def _move_local(self, moves, mode=transfer.MOVE):
+        """Move (src_path, dest_path) pairs on the local file system one after another.
+
+        Moves within one file system are a rename; anything else is copied by transfer.Mover. With a
+        mode other than move the sources stay and are hard-linked, reflinked or copied instead."""
+
+        results = {}
+        with timing.stage(timing.LOCAL_MOVE), \
+                transfer.Mover(mode, self.copy_cache, self.verify_transfers) as mover:
+            for src_path, dest_path in moves:
+                dest = path.dirname(dest_path)
+                try:
+                    if not path.exists(dest):
+                        logging.info('Destination does not exist; creating [%s]', dest)
+                        makedirs(dest, exist_ok=True)
+                    logging.debug('Moving [%s] to [%s]...', src_path, dest_path)
+                    self._journal_mark(src_path, journal.STARTED)
+                    mover.move(src_path, dest_path)
+                except OSError:
+                    logging.exception('Failed moving [%s] to [%s]', src_path, dest_path)
+                    results[src_path] = False
+        # Copies across file systems are only final once the mover has synced them.
+        results.update(mover.results)
+        self._verified.update(mover.hashes)
+
+        for src_path, dest_path in moves:
+            if results[src_path]:
+                logging.info('Successfully moved [%s] to [%s]', src_path, dest_path)
+            else:
+                self._notify_error('CopyMedia: failed moving [%s] to [%s]' % (src_path, dest_path))
+            self._journal_mark(src_path, journal.DONE if results[src_path] else journal.FAILED)
+        return {src_path: results[src_path] for src_path, _ in moves}
+
+    def _stream_movie(self, src_path, dest_path, resume=False):
+        """Deliver the movie src_path to dest_path with strip_metadata, which writes the stripped movie there directly.
+
+        A movie that isn't streamed (nothing to strip, ffmpeg failed, or verifyTransfers with a local
+        destination; it was stripped where it is) is moved like any other. Returns {src_path: success}."""
+
+        self._journal_mark(src_path, journal.STARTED)
+        # A hard-linked copy shares its data with the seeding original; never modify it in place.
+        in_place = stat(src_path).st_nlink == 1
+        verified = self._verified if self.verify_transfers else None
+        if not self.strip_metadata(src_path, dest=dest_path, in_place=in_place, verified=verified):
+            if remote.is_remote(dest_path):
+                return self._rsync_batch([(src_path, dest_path)], resume)
+            return self._move_local([(src_path, dest_path)])
+        logging.info('Successfully streamed [%s] to [%s]', src_path, dest_path)
+        self._journal_mark(src_path, journal.DONE)
+        return {src_path: True}
+
+    def _journal_mark(self, src_path, state):
+        if self.journal is not None:
+            self.journal.mark(src_path, state)
+
+    def _rsync_batch(self, moves, resume=False, keep_source=False):
+        """Send remote moves in one batch and raise an error notification for each failure.
+
+        With verifyTransfers each move is sent by remote.send_verified instead, one after another."""
+
+        if not moves:
+            return {}
+
+        logging.debug('Queueing [%s] for remote transfer...', moves)
+        for src_path, _ in moves:
+            self._journal_mark(src_path, journal.STARTED)
+        drop_cache = self.copy_cache != transfer.CACHE_NORMAL
+        if self.verify_transfers:
+            results = {}
+            for src_path, dest_path in moves:
+                hashes = remote.send_verified(src_path, dest_path, keep_source=keep_source, drop_cache=drop_cache)
+                results[src_path] = hashes is not None
+                self._verified.update(hashes or {})
+        else:
+            results = remote.rsync_batch(moves, resume=resume, keep_source=keep_source, drop_cache=drop_cache)
+        for src_path, dest_path in moves:
+            self._journal_mark(src_path, journal.DONE if results[src_path] else journal.FAILED)
+            if not results[src_path]:
+                self._notify_error(
+                    'CopyMedia: rsync failed moving [%s] to [%s]' % (src_path, dest_path)
+                )
+        return results
 
     @staticmethod
-    def build_new_name(file_name, config):
-        # Determine destination file_name if a replace attribute
-        # was specified
-        dest_file_name = file_name
-        if 'replace' in config:
-            logging.log(logger.TRACE, 'Processing episode name replace pattern [%s] for regex pattern [%s]',
-                        config['replace'], config['regex'])
-            dest_file_name = re.sub(config['regex'],
-                                    config['replace'],
-                                    file_name)
-        if 'episode_num_sub' in config:
-            logging.log(logger.TRACE, 'Processing episode number subtraction [%s]', config['episode_num_sub'])
-            # Outer group (1) is entire season/episode string.
-            # Inner group (2) is episode number
-            episode_num_regex = '.*([sS]\\d\\d[eE](\\d\\d)).*'
-            p = re.compile(episode_num_regex)
-            match = p.match(dest_file_name)
-            episode_string = match.group(1)
-            episode_num = match.group(2)
-
-            # calculate new episode number
-            new_num = int(episode_num) - int(config['episode_num_sub'])
-
-            # build new episode string by updating the episode number (last two characters of the string)
-            new_episode_string = episode_string[:-2] + str(new_num)
-            logging.log(logger.TRACE, 'new episode string: %s', new_episode_string)
-
-            # replace old episode string with new episode string
-            dest_file_name = dest_file_name.replace(episode_string, new_episode_string)
+    def build_new_name(file_name, config, series_match=None):
+        """Determine the destination file name: the replace pattern, episode_num_sub and season of
+        the series config entry applied in one pass (see matcher.Renamer).
+
+        Pass the SeriesMatch from matching the file to reuse its compiled pipeline and match object;
+        otherwise the entry's regex is compiled and run here."""
+
+        if series_match is not None:
+            dest_file_name = series_match.new_name()
+        else:
+            pattern = re.compile(config['regex'])
+            match = pattern.search(file_name)
+            renamer = Renamer(config, pattern)
+            if match is not None:
+                dest_file_name = renamer(file_name, match)
+            else:
+                # Nothing to replace, but the episode number may still need adjusting.
+                dest_file_name = renamer.renumber(file_name)
 
         logging.debug('New name for [%s] will be [%s]',
                       file_name, dest_file_name)
         return dest_file_name
 
     @staticmethod
+    @timing.stage(timing.MATCH)
     def match_files(files, series):
-        """Find matching files given a list of files and a list of series."""
+        """Find matching files given a list of files and a list of series.
+
+        series may be a list of series config entries or an already built SeriesMatcher. Each file
+        is assigned to the first series (in configuration order) whose regex matches it."""
+
+        if not isinstance(series, SeriesMatcher):
+            series = SeriesMatcher(series)
 
         matches = []
         nonmatches = []
         for f in files:
-            matched = False
-            for show in series:
-                logging.log(logger.TRACE, 'Checking [%s] against [%s] using pattern [%s]',
-                            f, show['name'], show['regex'])
-                if re.match(show['regex'], f):
-                    matches.append((f, show))
-                    matched = True
-                    logging.info('File [%s] matches series [%s]',
-                                 f, show['name'])
-                    break
-            if not matched:
+            found = series.match(f)
+            if found:
+                show = found.show
+                matches.append(MatchedFile(f, found))
+                logging.info('File [%s] matches series [%s]',
+                             f, show['name'])
+            else:
                 logging.debug('Adding [%s] to list of non-matches', f)
                 nonmatches.append(f)
 
@@ -645,9 +1327,57 @@ def main():
     if args.file:
         file = args.file
 
-    # Now execute file transforms/copy
+    if args.enqueue:
+        # Fast path for the Deluge hook: no logging set-up, no config validation, no network.
+        if not file:
+            argParser.error('--enqueue needs a file, either with -f or from the deluge arguments')
+        watcher.enqueue(watcher.spool_dir_from_config(args.config), file)
+        return
+
+    if args.profile or args.cprofile:
+        timing.enable()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with timing.stage(timing.TOTAL):
+            run(args, file, trigger_url)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            logging.info('Wrote cProfile statistics to [%s]', args.cprofile)
+        if timing.enabled:
+            print(timing.report())
+            timing.write_json(args.profile_json)
+
+
+def run(args, file, trigger_url):
+    """Run CopyMedia in the mode chosen on the command line."""
+
     c = None
     try:
+        if args.rebuild_dedup_index:
+            c = CopyMedia(logfile=args.log, config_file=args.config, seriesdir=args.dest, moviedir=args.moviedest)
+            c.rebuild_dedup_index()
+            c.finish()
+            return
+
+        if args.daemon:
+            c = CopyMedia(logfile=args.log, config_file=args.config, ifttt_url=trigger_url,
+                          scandir=args.scan, seriesdir=args.dest, tmdb_key=args.tmdb,
+                          moviedir=args.moviedest, ntfy_token=args.ntfy_token)
+            c.resume_transfers()
+            daemon = watcher.Watcher(c, c.spool_dir, settle=c.configs.get('settleSeconds', watcher.SETTLE_SECONDS),
+                                     poll_interval=c.configs.get('pollInterval', watcher.POLL_INTERVAL))
+            signal.signal(signal.SIGTERM, daemon.stop)
+            signal.signal(signal.SIGINT, daemon.stop)
+            daemon.run()
+            return
+
         c = CopyMedia(logfile=args.log, config_file=args.config, ifttt_url=trigger_url,
                       scandir=args.scan, seriesdir=args.dest, file=file, tmdb_key=args.tmdb,
                       moviedir=args.moviedest, ntfy_token=args.ntfy_token)
@@ -656,6 +1386,8 @@ def main():
         logging.exception('Error on execution.')
         if c is not None:
             c._notify_error('CopyMedia error: %s' % e)
+            if c.notifier is not None:
+                c.notifier.flush()
         raise
 
 
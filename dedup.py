@@ -0,0 +1,171 @@
+import logging
+import os
+import time
+
+INDEX_FILE = 'dedup_index.sqlite'
+
+# What to do with a download whose content is already in the library (dedupMode config setting)
+MODE_OFF = 'off'
+MODE_SKIP = 'skip'
+MODE_REPLACE = 'replace'
+MODES = (MODE_OFF, MODE_SKIP, MODE_REPLACE)
+
+# Bytes hashed from each end of a file
+HASH_SPAN = 1024 * 1024
+
+
+def partial_hash(src):
+    """Return (size, hex digest) identifying the content of file src.
+
+    Only the first and last HASH_SPAN bytes are hashed (BLAKE2b), so even multi-GB files are
+    fingerprinted with two small reads. Together with the exact size that is plenty to tell
+    releases apart."""
+
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(src, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        digest.update(f.read(HASH_SPAN))
+        if size > 2 * HASH_SPAN:
+            f.seek(-HASH_SPAN, os.SEEK_END)
+            digest.update(f.read(HASH_SPAN))
+    return size, digest.hexdigest()
+
+
+def hash_sources(src):
+    """partial_hash every file of src (a file or a directory tree). Returns {file path: (size, digest)}."""
+
+    if not os.path.isdir(src):
+        return {src: partial_hash(src)}
+    hashes = {}
+    for root, dirs, files in os.walk(src):
+        for name in files:
+            full_path = os.path.join(root, name)
+            hashes[full_path] = partial_hash(full_path)
+    return hashes
+
+
+def signature(src):
+    """Cheap identity of a source left in place after delivery (a file or a directory tree).
+
+    Files are identified by size and mtime, trees by their file count, total size and newest mtime,
+    so a finished download reads the same on every scan while one still being written does not."""
+
+    if not os.path.isdir(src):
+        st = os.stat(src)
+        return 'file:%d:%d' % (st.st_size, st.st_mtime_ns)
+    count = total = newest = 0
+    for root, dirs, files in os.walk(src):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            count += 1
+            total += st.st_size
+            newest = max(newest, st.st_mtime_ns)
+    return 'tree:%d:%d:%d' % (count, total, newest)
+
+
+class DedupIndex:
+    """Persistent SQLite index of the files delivered to the library, keyed by size and partial hash.
+
+    Paths are stored as delivered: local paths or remote user@host:/path destinations. Downloads
+    that were delivered but left in place (deliveryMode other than move) are remembered by
+    signature(), so later scans don't deliver them again. Verified transfers also store the full
+    SHA-256 of each delivered file, for audits."""
+
+    def __init__(self, index_file=INDEX_FILE):
+        self.index_file = index_file
+        self.skipped = 0
+        self.bytes_saved = 0
+
+        import sqlite3
+
+        logging.debug('Opening dedup index [%s]', index_file)
+        self._conn = sqlite3.connect(index_file)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS delivered ('
+                           'path TEXT PRIMARY KEY, size INTEGER NOT NULL, hash TEXT NOT NULL, '
+                           'delivered REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS delivered_content ON delivered (size, hash)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS verified ('
+                           'path TEXT PRIMARY KEY, size INTEGER NOT NULL, sha256 TEXT NOT NULL, '
+                           'verified REAL NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS seeding ('
+                           'path TEXT PRIMARY KEY, signature TEXT NOT NULL, delivered REAL NOT NULL)')
+        self._conn.commit()
+
+    def lookup(self, key):
+        """Return the delivered paths whose content matches key, a (size, digest) pair."""
+        rows = self._conn.execute('SELECT path FROM delivered WHERE size = ? AND hash = ? ORDER BY delivered',
+                                  key).fetchall()
+        return [row[0] for row in rows]
+
+    def record(self, delivered):
+        """Add {delivered path: (size, digest)} entries, replacing whatever was known about those paths."""
+        now = time.time()
+        self._conn.executemany('INSERT OR REPLACE INTO delivered (path, size, hash, delivered) VALUES (?, ?, ?, ?)',
+                               [(p, size, digest, now) for p, (size, digest) in delivered.items()])
+        self._conn.commit()
+
+    def forget(self, paths):
+        self._conn.executemany('DELETE FROM delivered WHERE path = ?', [(p,) for p in paths])
+        self._conn.commit()
+
+    def record_verified(self, verified):
+        """Store {delivered path: (size, sha256)} for files whose transfer was verified end to end."""
+        now = time.time()
+        self._conn.executemany('INSERT OR REPLACE INTO verified (path, size, sha256, verified) VALUES (?, ?, ?, ?)',
+                               [(p, size, sha256, now) for p, (size, sha256) in verified.items()])
+        self._conn.commit()
+
+    def verified_hash(self, delivered_path):
+        """The (size, sha256) stored when delivered_path was transferred with verification, or None."""
+        row = self._conn.execute('SELECT size, sha256 FROM verified WHERE path = ?', (delivered_path,)).fetchone()
+        return tuple(row) if row else None
+
+    def is_seeding(self, src, src_signature):
+        """True if src was delivered and left in place, and still has the same signature."""
+        row = self._conn.execute('SELECT signature FROM seeding WHERE path = ?', (src,)).fetchone()
+        return row is not None and row[0] == src_signature
+
+    def record_seeding(self, sources):
+        """Remember {source path: signature} for downloads delivered but left in place."""
+        now = time.time()
+        self._conn.executemany('INSERT OR REPLACE INTO seeding (path, signature, delivered) VALUES (?, ?, ?)',
+                               [(src, sig, now) for src, sig in sources.items()])
+        self._conn.commit()
+
+    def saved(self, size):
+        """Count a transfer avoided because its content was already delivered."""
+        self.skipped += 1
+        self.bytes_saved += size
+
+    def rebuild(self, roots):
+        """Replace the index with the files currently under the given local library roots.
+
+        Returns the number of files indexed."""
+
+        delivered = {}
+        for root in roots:
+            logging.info('Indexing library files under [%s]...', root)
+            for directory, dirs, files in os.walk(root):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for name in files:
+                    if name.startswith('.') or name.endswith('.part'):
+                        continue
+                    full_path = os.path.join(directory, name)
+                    try:
+                        delivered[full_path] = partial_hash(full_path)
+                    except OSError:
+                        logging.warning('Could not index [%s]', full_path, exc_info=True)
+        self._conn.execute('DELETE FROM delivered')
+        self.record(delivered)
+        logging.info('Dedup index [%s] rebuilt with %d files', self.index_file, len(delivered))
+        return len(delivered)
+
+    def log_stats(self):
+        if self.skipped:
+            logging.info('Dedup index [%s]: %d transfers avoided, %.1f MB saved', self.index_file,
+                         self.skipped, self.bytes_saved / 1000000)
+
+    def close(self):
+        self._conn.close()
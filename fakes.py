@@ -0,0 +1,151 @@
+"""Stand-ins for the NAS, TMDB and large downloads, shared by the tests and benchmark.py."""
+
+import http.server
+import json
+import os
+import sys
+import threading
+import urllib.parse
+
+import remote
+import tmdb
+
+
+# Stand-ins for ssh and rsync on the fake NAS. Remote paths (user@host:/path) are local paths on this
+# machine; files are hard-linked rather than copied, so a run measures CopyMedia and not the disk.
+FAKE_SSH = '''#!%(python)s
+import subprocess, sys
+
+args = sys.argv[1:]
+command = []
+while args:
+    arg = args.pop(0)
+    if arg in ('-N', '-O'):
+        # Control master start/stop: nothing to connect to.
+        sys.exit(0)
+    if arg in ('-o', '-p', '-i', '-l'):
+        args.pop(0)
+    elif not arg.startswith('-'):
+        command = args
+        break
+sys.exit(subprocess.run(['sh', '-c', ' '.join(command)]).returncode if command else 0)
+'''
+
+FAKE_RSYNC = '''#!%(python)s
+import os, re, shutil, sys
+
+args = sys.argv[1:]
+paths = []
+remove_source = False
+while args:
+    arg = args.pop(0)
+    if arg == '-e':
+        args.pop(0)
+    elif arg == '--remove-source-files':
+        remove_source = True
+    elif not arg.startswith('-'):
+        paths.append(re.sub(r'^[^/]*:', '', arg))
+src, dest = paths
+
+def send(src_file, dest_file):
+    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+    if os.path.lexists(dest_file):
+        os.remove(dest_file)
+    try:
+        os.link(src_file, dest_file)
+    except OSError:
+        shutil.copy2(src_file, dest_file)
+    if remove_source:
+        os.remove(src_file)
+
+if src.endswith('/'):
+    for root, dirs, files in os.walk(src):
+        for name in files:
+            send(os.path.join(root, name), os.path.join(dest, os.path.relpath(root, src), name))
+else:
+    send(src, os.path.join(dest, os.path.basename(src)) if dest.endswith('/') else dest)
+'''
+
+
+class FakeNAS:
+    """Put stub ssh and rsync commands first on PATH for the duration of a with block.
+
+    root is the local directory standing in for the NAS; remote(path) gives the user@host:/path
+    destination for a directory under it."""
+
+    HOST = 'bench@fakenas'
+
+    def __init__(self, root):
+        self.root = root
+        self.bin_dir = os.path.join(root, '.bin')
+        self._path = None
+
+    def remote(self, name):
+        return '%s:%s' % (self.HOST, os.path.join(self.root, name))
+
+    def __enter__(self):
+        os.makedirs(self.bin_dir, exist_ok=True)
+        for name, script in (('ssh', FAKE_SSH), ('rsync', FAKE_RSYNC)):
+            stub = os.path.join(self.bin_dir, name)
+            with open(stub, 'w') as f:
+                f.write(script % {'python': sys.executable})
+            os.chmod(stub, 0o755)
+        self._path = os.environ.get('PATH', '')
+        os.environ['PATH'] = self.bin_dir + os.pathsep + self._path
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        os.environ['PATH'] = self._path
+        remote.close_masters()
+
+
+class FakeTMDB(http.server.ThreadingHTTPServer):
+    """Local HTTP server answering TMDB movie searches: titles in movies are found, nothing else is.
+
+    While used as a context manager tmdb.BASE_URL points at it."""
+
+    daemon_threads = True
+
+    def __init__(self, movies):
+        super().__init__(('127.0.0.1', 0), _FakeTMDBHandler)
+        self.movies = {m.lower() for m in movies}
+        self.queries = 0
+        self._base_url = None
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        self._base_url = tmdb.BASE_URL
+        tmdb.BASE_URL = 'http://%s:%d%s' % (*self.server_address, tmdb.URL_CONTEXT)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        tmdb.BASE_URL = self._base_url
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeTMDBHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        self.server.queries += 1
+        found = query.get('query', [''])[0].lower() in self.server.movies
+        body = json.dumps({'page': 1, 'total_results': int(found), 'results': []}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def sparse_movie(full_path, size):
+    """Write an MP4 without meta-data of the given size; all but the header is a hole."""
+
+    with open(full_path, 'wb') as f:
+        f.write(b'\x00\x00\x00\x10ftypisom\x00\x00\x02\x00')
+        # mdat with a 64-bit size covering the rest of the file
+        f.write(b'\x00\x00\x00\x01mdat' + (size - 16).to_bytes(8, 'big'))
+        f.truncate(size)
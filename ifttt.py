@@ -1,12 +1,14 @@
-import requests
 import logging
 
+import timing
+
 IFTTT_URL_BASE = 'https://maker.ifttt.com/trigger'
 
 
-def send_notification(matches, trigger_url):
+@timing.stage(timing.NOTIFY)
+def send_notification(matches, trigger_url, session=None, timeout=None):
     """Send IFTTT notification to phone whenever the script fires with the names
-        of the new episodes"""
+        of the new episodes. Uses session when given, and gives up after timeout."""
 
     # Only send notification if there is at least one matching file.
     if matches and trigger_url:
@@ -18,7 +20,10 @@ def send_notification(matches, trigger_url):
         logging.debug('Sending notification with name string: [%s] to IFTTT',
                       name_string)
 
-        r = requests.post(trigger_url, data={'value1': name_string})
+        # Imported here so runs that never notify don't pay for loading requests.
+        import requests
+
+        r = (session or requests).post(trigger_url, data={'value1': name_string}, timeout=timeout)
         logging.debug('IFTTT POST status: [%s] with reason: [%s]',
                       r.status_code, r.reason)
         return r
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import dedup
+
+JOURNAL_FILE = 'transfers.journal'
+
+# Transfer states, in the order a move goes through them
+PLANNED = 'planned'
+STARTED = 'started'
+DONE = 'done'
+FAILED = 'failed'
+# The source changed or disappeared before an unfinished move could be resumed
+ABANDONED = 'abandoned'
+UNFINISHED = (PLANNED, STARTED)
+
+
+def checksum(src):
+    """Cheap fingerprint of a file or directory tree used to tell whether a source is unchanged.
+
+    Files are identified by size, mtime and dedup.partial_hash; directories by the file count and
+    total size of their tree."""
+
+    if os.path.isdir(src):
+        count = total = 0
+        for root, dirs, files in os.walk(src):
+            for name in files:
+                count += 1
+                total += os.path.getsize(os.path.join(root, name))
+        return 'tree:%d:%d' % (count, total)
+
+    size, digest = dedup.partial_hash(src)
+    return 'blake2b:%d:%d:%s' % (size, os.stat(src).st_mtime_ns, digest)
+
+
+class TransferJournal:
+    """Append-only JSON lines log of every move, written ahead of the move itself.
+
+    Each line records one state change for one source path. A move is planned (with the
+    checksum of its source) before any transfer starts, marked started just before it runs and
+    done or failed afterwards, so after a crash the moves left planned or started are exactly the
+    ones still to do. Opening the journal folds it down to those unfinished moves."""
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        # src -> latest record
+        self._entries = {}
+
+        if os.path.exists(journal_file):
+            with open(journal_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._entries[record['src']] = record
+                    except (ValueError, KeyError):
+                        # A torn last line from a crash mid-write.
+                        logging.warning('Ignoring unreadable journal line in [%s]: %r', journal_file, line)
+        self._compact()
+        self._file = open(journal_file, 'a')
+
+    def _compact(self):
+        """Rewrite the journal with only the unfinished moves."""
+        self._entries = {src: r for src, r in self._entries.items() if r['state'] in UNFINISHED}
+        tmp_file = self.journal_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            for record in self._entries.values():
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.journal_file)
+
+    def _write(self, records, sync):
+        with self._lock:
+            for record in records:
+                record['time'] = time.time()
+                self._entries[record['src']] = record
+                self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def plan(self, moves, streams=()):
+        """Record [(src, dest)] moves before any of them starts. Synced to disk before returning.
+
+        Sources in streams are movies delivered by stripping their meta-data on the way, which a
+        resumed move has to do again."""
+
+        records = []
+        for src, dest in moves:
+            try:
+                record_checksum = checksum(src)
+            except OSError:
+                record_checksum = None
+            records.append({'src': src, 'dest': dest, 'state': PLANNED, 'checksum': record_checksum,
+                            'stream': src in streams})
+        self._write(records, sync=True)
+
+    def mark(self, src, state):
+        """Record a state change for a planned move. Finished moves are synced to disk."""
+
+        with self._lock:
+            record = dict(self._entries.get(src, {'src': src, 'dest': None, 'checksum': None}))
+        record['state'] = state
+        self._write([record], sync=state not in UNFINISHED)
+
+    def unfinished(self):
+        """Records of moves that were planned or started but never finished, in journal order."""
+        with self._lock:
+            return [dict(r) for r in self._entries.values() if r['state'] in UNFINISHED]
+
+    def close(self):
+        """Close the journal, dropping everything but unfinished moves from the file."""
+        with self._lock:
+            self._file.close()
+            self._compact()
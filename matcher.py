@@ -0,0 +1,304 @@
+import logging
+import re
+from collections import deque, namedtuple
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+import logger
+
+
+def required_literal(regex):
+    """Return the longest literal substring that every match of regex must contain, or None.
+
+    Only plain literals that sit directly in the top-level sequence (or inside capturing groups
+    nested in it) count. Anything optional, repeated, alternated or case-insensitive ends the
+    current run, so the result is always safe to use as a prefilter."""
+
+    if isinstance(regex, str):
+        regex = re.compile(regex)
+
+    if regex.flags & re.IGNORECASE:
+        return None
+
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, OverflowError):
+        return None
+
+    best = ''
+    run = []
+
+    def visit(items):
+        nonlocal best, run
+        for op, av in items:
+            if op is sre_constants.LITERAL:
+                run.append(chr(av))
+                continue
+            if op is sre_constants.SUBPATTERN:
+                add_flags = av[1]
+                if not add_flags & sre_constants.SRE_FLAG_IGNORECASE:
+                    visit(av[-1])
+                    continue
+            # Anything else may match a variable string, so the current run is over.
+            if len(run) > len(best):
+                best = ''.join(run)
+            run = []
+
+    visit(parsed)
+    if len(run) > len(best):
+        best = ''.join(run)
+
+    return best or None
+
+
+_TEMPLATE_ESCAPE = re.compile(r'\\(?:g<([^>]*)>|([1-9][0-9]?)|(.))', re.DOTALL)
+_TEMPLATE_CHARS = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+
+
+def parse_template(template, pattern):
+    """Parse a re.sub replacement template once into a tuple of literal strings and group references.
+
+    Supports the same \\1, \\g<1> and \\g<name> references and character escapes as re.sub. Raises
+    ValueError naming the problem if the template refers to a group the pattern doesn't have."""
+
+    pieces = []
+    literal = []
+    pos = 0
+    for m in _TEMPLATE_ESCAPE.finditer(template):
+        literal.append(template[pos:m.start()])
+        pos = m.end()
+        ref = m.group(1) if m.group(1) is not None else m.group(2)
+        if ref is None:
+            char = m.group(3)
+            if char in _TEMPLATE_CHARS:
+                literal.append(_TEMPLATE_CHARS[char])
+            elif char.isascii() and char.isalpha():
+                raise ValueError('bad escape \\%s in replace pattern %r' % (char, template))
+            else:
+                literal.append(m.group(0))
+            continue
+        if ref.isdigit():
+            group = int(ref)
+            if group > pattern.groups:
+                raise ValueError('replace pattern %r refers to group %d, but the regex only has %d'
+                                 % (template, group, pattern.groups))
+        elif ref in pattern.groupindex:
+            group = pattern.groupindex[ref]
+        else:
+            raise ValueError('replace pattern %r refers to unknown group %r' % (template, ref))
+        if ''.join(literal):
+            pieces.append(''.join(literal))
+        literal = []
+        pieces.append(group)
+    literal.append(template[pos:])
+    if ''.join(literal):
+        pieces.append(''.join(literal))
+    return tuple(pieces)
+
+
+def expand_template(pieces, match):
+    """Build the replacement for match from parse_template pieces; unmatched groups become ''."""
+    return ''.join(piece if isinstance(piece, str) else (match.group(piece) or '') for piece in pieces)
+
+
+# Last SxxEyy marker in a file name; group 1 is the season, group 2 the episode number.
+EPISODE_PATTERN = re.compile(r'.*[sS](\d+)[eE](\d+)', re.DOTALL)
+
+
+class Renamer:
+    """Compiled rename pipeline for one series entry.
+
+    Applies, in one pass over a file name and the match object its series regex produced:
+    the replace template, then the episode offset (episode_num_sub) and season override (season)
+    to the last SxxEyy marker. Numbers keep their zero padding."""
+
+    __slots__ = ('template', 'episode_offset', 'season')
+
+    def __init__(self, show, pattern):
+        self.template = parse_template(show['replace'], pattern) if 'replace' in show else None
+        self.episode_offset = int(show['episode_num_sub']) if 'episode_num_sub' in show else 0
+        self.season = int(show['season']) if 'season' in show else None
+
+    def __getstate__(self):
+        return self.template, self.episode_offset, self.season
+
+    def __setstate__(self, state):
+        self.template, self.episode_offset, self.season = state
+
+    def __call__(self, file_name, match):
+        name = file_name
+        if self.template is not None:
+            # What re.sub does with the first match.
+            name = file_name[:match.start()] + expand_template(self.template, match) + file_name[match.end():]
+        return self.renumber(name)
+
+    def renumber(self, name):
+        """Apply the episode offset and season override to the last SxxEyy marker of name.
+
+        Returns name unchanged if the entry sets neither, or name has no such marker."""
+
+        if not self.episode_offset and self.season is None:
+            return name
+        m = EPISODE_PATTERN.match(name)
+        if not m:
+            logging.warning('No SxxEyy episode marker in [%s]; episode_num_sub/season not applied', name)
+            return name
+
+        season, episode = m.group(1), m.group(2)
+        if self.season is not None:
+            season = str(self.season).zfill(len(season))
+        if self.episode_offset:
+            number = int(episode) - self.episode_offset
+            if number < 0:
+                logging.warning('episode_num_sub %d takes episode %s of [%s] below zero; not applied',
+                                self.episode_offset, episode, name)
+            else:
+                episode = str(number).zfill(len(episode))
+        return name[:m.start(1)] + season + name[m.end(1):m.start(2)] + episode + name[m.end(2):]
+
+
+class AhoCorasick:
+    """Minimal Aho-Corasick automaton reporting which of a set of keywords occur in a text."""
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [set()]
+
+        for key_id, keyword in enumerate(keywords):
+            state = 0
+            for char in keyword:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(set())
+                state = nxt
+            self._out[state].add(key_id)
+
+        # Breadth-first pass to build the failure links.
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] |= self._out[self._fail[nxt]]
+
+    def search(self, text):
+        """Return the set of keyword ids found anywhere in text."""
+
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class SeriesMatcher:
+    """Compiled, single-pass matcher for the configured series.
+
+    Every series regex is compiled once. Where a regex has a required literal (e.g. "World Trigger")
+    that literal goes into an Aho-Corasick index so that a file name is only tested against the
+    series whose literal it actually contains. Series without a usable literal are always tested.
+    Candidates are tried in configuration order so the first matching series still wins.
+
+    Each series also gets its Renamer (renamers[i]), so a match can be renamed straight away. A matcher
+    pickles without its compiled regexes; after loading, each regex is compiled the first time a
+    file name actually needs it."""
+
+    def __init__(self, series):
+        self.series = list(series or [])
+        self._patterns = [re.compile(show['regex']) for show in self.series]
+        self.renamers = [Renamer(show, pattern) for show, pattern in zip(self.series, self._patterns)]
+
+        keywords = []
+        self._keyword_series = []
+        self._unindexed = []
+        for index, pattern in enumerate(self._patterns):
+            literal = required_literal(pattern)
+            if literal:
+                keywords.append(literal)
+                self._keyword_series.append(index)
+            else:
+                self._unindexed.append(index)
+
+        self._index = AhoCorasick(keywords)
+
+        logging.debug('Compiled %d series patterns, %d with a literal prefilter',
+                      len(self._patterns), len(keywords))
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_patterns'] = [None] * len(self.series)
+        return state
+
+    def pattern(self, index):
+        """The compiled regex of series index, compiling it on first use."""
+        pattern = self._patterns[index]
+        if pattern is None:
+            pattern = self._patterns[index] = re.compile(self.series[index]['regex'])
+        return pattern
+
+    @property
+    def patterns(self):
+        return [self.pattern(index) for index in range(len(self.series))]
+
+    def candidates(self, name):
+        """Return the indices of the series that could match name, in configuration order."""
+
+        found = [self._keyword_series[k] for k in self._index.search(name)]
+        found.extend(self._unindexed)
+        found.sort()
+        return found
+
+    def match(self, name):
+        """Return a SeriesMatch (show, match object, renamer) for the first series matching name, or None."""
+
+        for index in self.candidates(name):
+            show = self.series[index]
+            logging.log(logger.TRACE, 'Checking [%s] against [%s] using pattern [%s]',
+                        name, show['name'], show['regex'])
+            m = self.pattern(index).match(name)
+            if m:
+                return SeriesMatch(show, m, self.renamers[index])
+        return None
+
+
+class SeriesMatch(namedtuple('SeriesMatch', ['show', 'match', 'renamer'])):
+    """A series config entry, the match object of its regex against a file name, and its Renamer."""
+
+    __slots__ = ()
+
+    def new_name(self):
+        """The file name after the series' rename pipeline, reusing the match."""
+        return self.renamer(self.match.string, self.match)
+
+
+class MatchedFile(tuple):
+    """(file name, series config entry) pair returned by match_files.
+
+    Behaves like the plain pair it used to be, and keeps the SeriesMatch so the file can be
+    renamed without matching it again."""
+
+    def __new__(cls, file_name, series_match):
+        self = tuple.__new__(cls, (file_name, series_match.show))
+        self.series_match = series_match
+        return self
@@ -0,0 +1,416 @@
+"""Header-level access to container metadata for MP4 and Matroska files.
+
+Only the structure around the metadata is parsed; sample data is never read, so finding or
+blanking the metadata of a multi-gigabyte movie costs a handful of small reads."""
+
+import io
+import json
+import logging
+import os
+import struct
+import subprocess
+
+import logger
+import timing
+
+# MP4 boxes holding user metadata (title, encoder, comments, ...).
+MP4_CONTAINERS = {b'moov', b'trak'}
+MP4_METADATA = {b'udta', b'meta'}
+MP4_EXTENSIONS = {'.mp4', '.m4v', '.mov'}
+
+# Matroska element ids (including their length marker bits).
+EBML_HEADER = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_INFO = 0x1549A966
+MKV_TITLE = 0x7BA9
+MKV_TAGS = 0x1254C367
+MKV_CLUSTER = 0x1F43B675
+MKV_VOID = 0xEC
+MKV_EXTENSIONS = {'.mkv', '.mk3d', '.webm'}
+
+MKV_TAG = 0x7373
+MKV_SIMPLE_TAG = 0x67C8
+MKV_TAG_NAME = 0x45A3
+MKV_TAG_STRING = 0x4487
+
+# Elements are never read in full unless they are this small.
+MAX_ELEMENT_READ = 1 << 20
+
+# Tags that make a movie worth re-muxing. Everything else (stream statistics, language, ...)
+# is left alone rather than paying for a multi-gigabyte rewrite.
+STRIP_TAGS = {'title', 'comment', 'description', 'synopsis', 'encoder', 'encoded_by'}
+# Key read_tags reports a metadata region under when it is too big to read; always worth stripping.
+OVERSIZED = 'oversized'
+# ffmpeg stamps its own encoder tags (Lavf/Lavc) on everything it writes, so those don't count.
+FFMPEG_ENCODER = 'Lav'
+
+MP4_TAG_NAMES = {
+    b'\xa9nam': 'title',
+    b'\xa9cmt': 'comment',
+    b'\xa9too': 'encoder',
+    b'\xa9enc': 'encoded_by',
+    b'desc': 'description',
+    b'ldes': 'synopsis',
+}
+
+# Running totals for the log: how many strips were needed and how much I/O was avoided.
+stats = {'stripped': 0, 'skipped': 0, 'bytes_avoided': 0}
+
+
+class Region:
+    """A metadata box/element: where its header starts, how long the header is and the payload size."""
+
+    def __init__(self, kind, offset, header_size, size):
+        self.kind = kind
+        self.offset = offset
+        self.header_size = header_size
+        self.size = size
+
+    def __repr__(self):
+        return 'Region(%s @%d, %d bytes)' % (self.kind, self.offset, self.header_size + self.size)
+
+
+def container(movie):
+    """Return 'mp4', 'mkv' or None based on the file's magic bytes."""
+
+    with open(movie, 'rb') as f:
+        head = f.read(12)
+    if head[4:8] == b'ftyp':
+        return 'mp4'
+    if head[:4] == struct.pack('>I', EBML_HEADER):
+        return 'mkv'
+    return None
+
+
+def find_metadata(movie):
+    """Locate the container-level metadata in movie.
+
+    Returns a list of Regions (empty if there is no metadata), or None if the container isn't
+    one we can parse."""
+
+    kind = container(movie)
+    try:
+        with open(movie, 'rb') as f:
+            if kind == 'mp4':
+                return list(_mp4_metadata(f, 0, os.fstat(f.fileno()).st_size))
+            if kind == 'mkv':
+                return _mkv_metadata(f)
+    except (OSError, ValueError, struct.error):
+        logging.debug('Could not parse [%s] as %s', movie, kind, exc_info=True)
+    return None
+
+
+def read_tags(movie):
+    """Read the container-level tags from the file header.
+
+    Returns a dict of lower-case tag name -> value, or None if the container isn't supported. A region
+    bigger than MAX_ELEMENT_READ is not read, but reported under OVERSIZED."""
+
+    regions = find_metadata(movie)
+    if regions is None:
+        return None
+
+    tags = {}
+    with open(movie, 'rb') as f:
+        for region in regions:
+            if region.size > MAX_ELEMENT_READ:
+                # Far bigger than any plain text tags; assume it holds something worth stripping.
+                tags[OVERSIZED] = '%s: <%d bytes>' % (region.kind, region.size)
+                continue
+            f.seek(region.offset + region.header_size)
+            payload = f.read(region.size)
+            if region.kind == 'Title':
+                tags['title'] = payload.decode(errors='replace').rstrip('\0')
+            elif region.kind == 'Tags':
+                tags.update(_mkv_simple_tags(payload))
+            else:
+                tags.update(_mp4_tags(region.kind, payload))
+    return tags
+
+
+@timing.stage(timing.FFPROBE)
+def probe_tags(movie):
+    """Ask ffprobe for the container tags of formats we can't parse ourselves. Returns None on failure."""
+
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format_tags', '-of', 'json', movie],
+                                capture_output=True)
+    except OSError:
+        logging.debug('ffprobe not available', exc_info=True)
+        return None
+    if result.returncode != 0:
+        return None
+    try:
+        tags = json.loads(result.stdout).get('format', {}).get('tags', {})
+    except ValueError:
+        return None
+    return {name.lower(): value for name, value in tags.items()}
+
+
+def needs_strip(movie):
+    """Decide, from the header alone, whether movie carries meta-data worth a re-mux.
+
+    Falls back to ffprobe for containers we can't parse and, failing that, to True. Every
+    decision is logged along with the I/O a skipped rewrite saves."""
+
+    tags = read_tags(movie)
+    source = 'header'
+    if tags is None:
+        tags = probe_tags(movie)
+        source = 'ffprobe'
+    if tags is None:
+        logging.debug('Could not read tags of [%s]; assuming meta-data needs stripping.', movie)
+        stats['stripped'] += 1
+        return True
+
+    found = {name: value for name, value in tags.items()
+             if name in STRIP_TAGS | {OVERSIZED} and not (name == 'encoder' and str(value).startswith(FFMPEG_ENCODER))}
+    if found:
+        logging.info('Meta-data found in [%s] (%s): %s', movie, source, found)
+        stats['stripped'] += 1
+        return True
+
+    size = os.path.getsize(movie)
+    # A rewrite reads the whole file and writes it out again.
+    stats['skipped'] += 1
+    stats['bytes_avoided'] += 2 * size
+    logging.info('No meta-data to strip in [%s] (%s); skipping ffmpeg, %.1f MB of I/O avoided',
+                 movie, source, 2 * size / 1e6)
+    return False
+
+
+def log_stats():
+    if stats['stripped'] or stats['skipped']:
+        logging.info('Meta-data strip: %d needed, %d skipped, %.1f MB of I/O avoided',
+                     stats['stripped'], stats['skipped'], stats['bytes_avoided'] / 1e6)
+
+
+def strip_in_place(movie):
+    """Blank out the container metadata without rewriting the file.
+
+    MP4 metadata boxes are renamed to 'free' and Matroska Title/Tags elements are turned into
+    Void elements of exactly the same length, so no other byte of the file moves. Their
+    payload is zeroed so the old values don't linger in the padding. Returns True if the file
+    was handled, False if the container isn't supported."""
+
+    regions = find_metadata(movie)
+    if regions is None:
+        return False
+
+    with open(movie, 'r+b') as f:
+        for region in regions:
+            logging.log(logger.TRACE, 'Blanking %s in [%s]', region, movie)
+            if region.kind in MP4_METADATA:
+                # Box layout: 32-bit size, then the 4 byte type.
+                f.seek(region.offset + 4)
+                f.write(b'free')
+            else:
+                f.seek(region.offset)
+                f.write(_mkv_void_header(region))
+            f.seek(region.offset + region.header_size)
+            remaining = region.size
+            while remaining:
+                chunk = min(remaining, MAX_ELEMENT_READ)
+                f.write(bytes(chunk))
+                remaining -= chunk
+    logging.debug('Blanked %d metadata region(s) in place in [%s]', len(regions), movie)
+    return True
+
+
+def _mp4_metadata(f, start, end):
+    """Yield the metadata boxes inside the MP4 byte range [start, end)."""
+
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise ValueError('Corrupt MP4 box %r at %d' % (box_type, offset))
+
+        if box_type in MP4_METADATA:
+            yield Region(box_type, offset, header_size, size - header_size)
+        elif box_type in MP4_CONTAINERS:
+            yield from _mp4_metadata(f, offset + header_size, offset + size)
+        offset += size
+
+
+def _read_vint(f, keep_marker=False):
+    """Read an EBML variable length integer. Returns (value, length in bytes)."""
+
+    first = f.read(1)
+    if not first:
+        raise ValueError('Unexpected end of file')
+    first = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        length += 1
+        mask >>= 1
+    if length > 8:
+        raise ValueError('Invalid EBML variable length integer')
+
+    value = first if keep_marker else first & (mask - 1)
+    for byte in f.read(length - 1):
+        value = (value << 8) | byte
+    return value, length
+
+
+def _read_element_header(f):
+    """Return (element id, payload size, header length) for the element at the current position."""
+    element_id, id_length = _read_vint(f, keep_marker=True)
+    size, size_length = _read_vint(f)
+    if size == (1 << (7 * size_length)) - 1:
+        size = None  # unknown size, e.g. a live stream
+    return element_id, size, id_length + size_length
+
+
+def _mkv_children(f, start, end):
+    """Yield (element id, offset, header size, payload size) for elements in [start, end)."""
+
+    offset = start
+    while end is None or offset < end:
+        f.seek(offset)
+        try:
+            element_id, size, header_size = _read_element_header(f)
+        except ValueError:
+            return
+        yield element_id, offset, header_size, size
+        if size is None:
+            return
+        offset += header_size + size
+
+
+def _mkv_metadata(f):
+    regions = []
+    file_size = os.fstat(f.fileno()).st_size
+
+    f.seek(0)
+    element_id, size, header_size = _read_element_header(f)
+    segment_start = header_size + size
+    f.seek(segment_start)
+    element_id, size, header_size = _read_element_header(f)
+    if element_id != MKV_SEGMENT:
+        raise ValueError('No Matroska segment found')
+    data_start = segment_start + header_size
+    data_end = file_size if size is None else min(file_size, data_start + size)
+
+    # Top-level elements before the first cluster, plus anything the SeekHead points at
+    # (mkvmerge, for one, writes the Tags after the clusters).
+    top_level = {}
+    seek_targets = set()
+    for element_id, offset, header_size, size in _mkv_children(f, data_start, data_end):
+        if element_id == MKV_CLUSTER:
+            break
+        top_level[offset] = (element_id, header_size, size)
+        if element_id == MKV_SEEK_HEAD and size is not None and size <= MAX_ELEMENT_READ:
+            seek_targets.update(_mkv_seek_positions(f, offset + header_size, size, data_start))
+
+    for offset in seek_targets - set(top_level):
+        if offset < data_end:
+            f.seek(offset)
+            element_id, size, header_size = _read_element_header(f)
+            top_level[offset] = (element_id, header_size, size)
+
+    for offset, (element_id, header_size, size) in sorted(top_level.items()):
+        if element_id == MKV_TAGS and size is not None:
+            regions.append(Region('Tags', offset, header_size, size))
+        elif element_id == MKV_INFO and size is not None:
+            for child_id, child_offset, child_header, child_size in _mkv_children(
+                    f, offset + header_size, offset + header_size + size):
+                if child_id == MKV_TITLE:
+                    regions.append(Region('Title', child_offset, child_header, child_size))
+
+    return regions
+
+
+def _mkv_seek_positions(f, start, size, segment_data_start):
+    positions = []
+    for element_id, offset, header_size, seek_size in list(_mkv_children(f, start, start + size)):
+        if element_id != MKV_SEEK:
+            continue
+        seek_id = position = None
+        for child_id, child_offset, child_header, child_size in list(
+                _mkv_children(f, offset + header_size, offset + header_size + seek_size)):
+            f.seek(child_offset + child_header)
+            data = f.read(child_size)
+            if child_id == MKV_SEEK_ID:
+                seek_id = int.from_bytes(data, 'big')
+            elif child_id == MKV_SEEK_POSITION:
+                position = int.from_bytes(data, 'big')
+        if seek_id in (MKV_TAGS, MKV_INFO) and position is not None:
+            positions.append(segment_data_start + position)
+    return positions
+
+
+def _mp4_tags(kind, payload):
+    """Tags from an MP4 udta box (QuickTime style atoms or an iTunes meta/ilst list) or meta box."""
+
+    tags = {}
+    if kind == b'meta':
+        payload = payload[4:]  # full box: version and flags come first
+    offset = 0
+    while offset + 8 <= len(payload):
+        size, atom = struct.unpack_from('>I4s', payload, offset)
+        if size < 8:
+            break
+        body = payload[offset + 8:offset + size]
+        if atom in (b'meta', b'ilst'):
+            tags.update(_mp4_tags(atom, body))
+        elif atom == b'hdlr':
+            pass
+        else:
+            name = MP4_TAG_NAMES.get(atom, atom.decode('latin-1').lower())
+            if body[4:8] == b'data':
+                value = body[16:]  # iTunes item: data box with type and locale
+            else:
+                value = body[4:]  # QuickTime text atom: length and language first
+            tags[name] = value.decode(errors='replace').rstrip('\0')
+        offset += size
+    return tags
+
+
+def _mkv_simple_tags(payload):
+    """Tag name/value pairs from the payload of a Matroska Tags element."""
+
+    tags = {}
+    f = io.BytesIO(payload)
+    for tag_id, tag_offset, tag_header, tag_size in list(_mkv_children(f, 0, len(payload))):
+        if tag_id != MKV_TAG or tag_size is None:
+            continue
+        for simple_id, simple_offset, simple_header, simple_size in list(
+                _mkv_children(f, tag_offset + tag_header, tag_offset + tag_header + tag_size)):
+            if simple_id != MKV_SIMPLE_TAG or simple_size is None:
+                continue
+            name = value = None
+            start = simple_offset + simple_header
+            for child_id, child_offset, child_header, child_size in list(
+                    _mkv_children(f, start, start + simple_size)):
+                data = payload[child_offset + child_header:child_offset + child_header + (child_size or 0)]
+                if child_id == MKV_TAG_NAME:
+                    name = data.decode(errors='replace').lower()
+                elif child_id == MKV_TAG_STRING:
+                    value = data.decode(errors='replace').rstrip('\0')
+            if name:
+                tags[name] = value
+    return tags
+
+
+def _mkv_void_header(region):
+    """Header turning region into a Void element of the same total length.
+
+    The one byte Void id is followed by a size field that fills the rest of the original
+    header (at most 8 bytes); any difference is absorbed by the Void payload."""
+
+    length = min(region.header_size - 1, 8)
+    size = region.header_size + region.size - 1 - length
+    return bytes([MKV_VOID]) + (size | (1 << (7 * length))).to_bytes(length, 'big')
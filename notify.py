@@ -0,0 +1,145 @@
+import atexit
+import collections
+import logging
+import threading
+import time
+
+import ifttt
+import ntfy
+
+# Messages for the same channel arriving within this many seconds of the first are sent as one digest
+DIGEST_WINDOW = 2.0
+# Seconds to wait for a notification server to connect, and again to answer
+TIMEOUT = 10.0
+# How long the end of a run waits for queued notifications to go out
+FLUSH_DEADLINE = 15.0
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the keep-alive session shared by all notification requests."""
+
+    import requests
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+    return _session
+
+
+class NtfyChannel(collections.namedtuple('NtfyChannel', 'url token')):
+    """An ntfy topic. Queued messages are sent as one post, one message per line."""
+
+    def deliver(self, messages, timeout):
+        if len(messages) == 1:
+            message = messages[0]
+        else:
+            message = 'CopyMedia: %d notifications\n%s' % (len(messages), '\n'.join(messages))
+        return ntfy.send_notification(self.url, self.token, message, session=get_session(), timeout=timeout)
+
+
+class IftttChannel(collections.namedtuple('IftttChannel', 'trigger_url')):
+    """An IFTTT trigger. Queued lists of matches are sent as one event naming all of them."""
+
+    def deliver(self, match_lists, timeout):
+        matches = [match for matches in match_lists for match in matches]
+        return ifttt.send_notification(matches, self.trigger_url, session=get_session(), timeout=timeout)
+
+
+class Dispatcher:
+    """Send notifications from a background thread, so the run never waits on a notification server.
+
+    post() only queues the message. Messages for the same channel that arrive within window seconds
+    of each other are delivered together as one digest. flush() sends whatever is queued right away
+    and waits at most deadline seconds for it to go out; it also runs at interpreter exit."""
+
+    def __init__(self, window=DIGEST_WINDOW, timeout=TIMEOUT, deadline=FLUSH_DEADLINE):
+        self.window = window
+        self.timeout = timeout
+        self.deadline = deadline
+        self.sent = 0
+        self.coalesced = 0
+        self._cond = threading.Condition()
+        # channel -> (time of the first queued item, [items]), in the order channels were first queued
+        self._pending = {}
+        self._flushing = False
+        self._busy = False
+        self._thread = None
+
+    def post(self, channel, item):
+        """Queue item (a message, or a list of matches for IFTTT) for delivery on channel."""
+
+        with self._cond:
+            if channel in self._pending:
+                self._pending[channel][1].append(item)
+                self.coalesced += 1
+            else:
+                self._pending[channel] = (time.monotonic(), [item])
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='notify', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            self._cond.notify()
+
+    def _next_batch(self):
+        """Wait for a channel whose window has closed (any channel when flushing) and take its items."""
+
+        with self._cond:
+            while True:
+                if self._pending:
+                    channel, (first, items) = next(iter(self._pending.items()))
+                    wait = 0 if self._flushing else first + self.window - time.monotonic()
+                    if wait <= 0:
+                        del self._pending[channel]
+                        self._busy = True
+                        return channel, items
+                elif self._flushing:
+                    # Done; the next post() starts a new thread.
+                    self._thread = None
+                    atexit.unregister(self.flush)
+                    return None
+                else:
+                    wait = None
+                self._cond.wait(wait)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            channel, items = batch
+            try:
+                channel.deliver(items, self.timeout)
+                self.sent += 1
+            except Exception:
+                logging.exception('Failed to send %d notification(s) to %s', len(items), type(channel).__name__)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def flush(self, deadline=None):
+        """Send everything queued now and wait up to deadline seconds (default self.deadline) for it.
+
+        Returns True if everything went out. The dispatcher can be used again afterwards."""
+
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return True
+            self._flushing = True
+            self._cond.notify_all()
+        thread.join(self.deadline if deadline is None else deadline)
+
+        with self._cond:
+            if thread.is_alive():
+                logging.warning('Gave up waiting for notifications; %d still queued',
+                                sum(len(items) for _, items in self._pending.values()) + self._busy)
+                return False
+            self._flushing = False
+        if self.coalesced:
+            logging.info('Notifications: %d sent, %d merged into digests', self.sent, self.coalesced)
+        return True
@@ -1,13 +1,20 @@
 import logging
-import requests
 
+import timing
 
-def send_notification(url, token, message):
+
+@timing.stage(timing.NOTIFY)
+def send_notification(url, token, message, session=None, timeout=None):
     """POST a plain-text message to an ntfy channel with Bearer auth.
 
+    Uses session (e.g. notify.get_session()) when given, and gives up after timeout.
     Returns the Response on success, None if an exception occurs (logged, not raised)."""
+    # Imported here so runs that never notify don't pay for loading requests.
+    import requests
+
     try:
-        r = requests.post(url, data=message, headers={'Authorization': 'Bearer ' + token})
+        r = (session or requests).post(url, data=message, headers={'Authorization': 'Bearer ' + token},
+                                       timeout=timeout)
         return r
     except Exception:
         logging.exception('Failed to send ntfy notification to [%s]', url)
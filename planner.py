@@ -0,0 +1,89 @@
+import logging
+import re
+from collections import namedtuple
+from os import path
+
+import logger
+import scan
+
+ENGLISH_TOKENS = {'english', 'eng', 'en'}
+
+
+def is_english_subtitle(file_name):
+    """True for srt files whose name marks them as english, e.g. movie.en.srt or 2_English.srt."""
+
+    if not file_name.endswith('.srt'):
+        return False
+    # Split the name into tokens on 1 or more non-letters and look for a recognized english tag.
+    return any(token.lower() in ENGLISH_TOKENS for token in re.split('[^A-Za-z]+', file_name))
+
+
+def is_hidden(full_path, base_dir):
+    """True if full_path, or any directory between it and base_dir, is a dot file."""
+    return any(part.startswith('.') for part in path.relpath(full_path, base_dir).split(path.sep))
+
+
+class MoviePlan(namedtuple('MoviePlan', ['base_dir', 'movie', 'subtitles', 'delete_files', 'delete_dirs',
+                                         'prune_dirs'])):
+    """Everything process_movie will do to one release folder, worked out from a single walk.
+
+    movie is the feature (None if the folder holds no files), subtitles the english srt files in
+    alphabetical order, delete_files a frozenset of every other file, delete_dirs the
+    sub-directories in the order they can be removed (children first) and prune_dirs the skipped
+    sample/extras folders, which are removed whole without ever being listed."""
+
+    __slots__ = ()
+
+    def moved_to(self, new_base_dir, movie=None):
+        """The same plan after base_dir was renamed to new_base_dir (and the movie, if given, moved)."""
+
+        def rebase(full_path):
+            return path.join(new_base_dir, path.relpath(full_path, self.base_dir))
+
+        return MoviePlan(new_base_dir,
+                         movie or (rebase(self.movie) if self.movie else None),
+                         tuple(rebase(p) for p in self.subtitles),
+                         frozenset(rebase(p) for p in self.delete_files),
+                         tuple(rebase(p) for p in self.delete_dirs),
+                         tuple(rebase(p) for p in self.prune_dirs))
+
+    def log(self):
+        logging.debug('Plan for [%s]: movie [%s], subtitles %s', self.base_dir, self.movie, list(self.subtitles))
+        logging.log(logger.TRACE, 'Plan for [%s]: delete files %s, directories %s, skipped directories %s',
+                    self.base_dir, sorted(self.delete_files), list(self.delete_dirs), list(self.prune_dirs))
+
+
+def plan_movie(base_dir, feature_size=None, skip_dirs=None):
+    """Walk base_dir once and work out the movie file, its english subtitles and what to delete.
+
+    The movie is the largest file outside skip_dirs folders; once a file of at least feature_size
+    bytes is seen it is taken as the movie and no further files are stat'ed. Hidden subtitle files
+    are ignored, as the old glob search did."""
+
+    skipped = []
+    files = []
+    dirs = []
+    best = None
+    found_feature = False
+    for entry in scan.walk(base_dir, skip_dirs, skipped):
+        if entry.is_dir:
+            dirs.append(entry.path)
+            continue
+        files.append(entry.path)
+        if found_feature:
+            continue
+        size = entry.size
+        if feature_size and size >= feature_size:
+            best = (size, entry.path)
+            found_feature = True
+        elif best is None or (size, entry.path) > best:
+            best = (size, entry.path)
+
+    movie = best[1] if best else None
+    subtitles = sorted(f for f in files if is_english_subtitle(path.basename(f)) and not is_hidden(f, base_dir))
+    keep = {movie, *subtitles}
+
+    plan = MoviePlan(base_dir, movie, tuple(subtitles), frozenset(f for f in files if f not in keep),
+                     tuple(reversed(dirs)), tuple(skipped))
+    plan.log()
+    return plan
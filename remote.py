@@ -1,8 +1,35 @@
+import atexit
 import logging
 import os
+import posixpath
 import re
+import shlex
 import shutil
 import subprocess
+import tempfile
+import threading
+import time
+
+import timing
+import transfer
+
+# Reuse one SSH connection per host for every ssh/rsync call in a run. Set MULTIPLEX to False
+# (sshMultiplex in the config) on platforms without ControlMaster support, e.g. Cygwin.
+MULTIPLEX = True
+CONTROL_PERSIST = '120'
+
+RSYNC_OPTIONS = ['-a', '--partial']
+RESUME_OPTIONS = ['--append-verify']
+# A batch is sent from a private staging directory into an existing library folder (possibly /), so the
+# stage's modes and owners must not be applied to the folders on the NAS; new files still get the source
+# permissions, masked by the NAS umask.
+BATCH_OPTIONS = ['--no-perms', '--no-owner', '--no-group', '--omit-dir-times', '--remove-source-files']
+# Bytes read and hashed at a time by verified transfers
+VERIFY_CHUNK = 8 * 1024 * 1024
+
+_control_dir = None
+_masters = {}
+_masters_lock = threading.Lock()
 
 _REMOTE_PATTERN = re.compile(r'^[^@]+@[^:]+:.+')
 
@@ -15,6 +42,99 @@ def is_remote(path):
 _REMOTE_HOST_PATH = re.compile(r'^([^@]+@[^:]+):(.+)')
 
 
+class _Master:
+    """Book-keeping for one ControlMaster connection."""
+
+    def __init__(self, control_path, handshake):
+        self.control_path = control_path
+        self.handshake = handshake
+        self.uses = 0
+
+
+def _open_master(host):
+    """Return the control master for host, starting it on first use.
+
+    Returns None if multiplexing is disabled or the master could not be started, in which
+    case callers simply open their own connection as before."""
+
+    if not MULTIPLEX:
+        return None
+
+    # Parallel transfers to the same host must share a single master.
+    with _masters_lock:
+        if host not in _masters:
+            _masters[host] = _start_master(host)
+        return _masters[host]
+
+
+def _start_master(host):
+    global _control_dir
+
+    if _control_dir is None:
+        # Keep the socket path short; unix sockets are limited to ~100 characters.
+        _control_dir = tempfile.mkdtemp(prefix='cm-')
+        atexit.register(close_masters)
+
+    control_path = os.path.join(_control_dir, str(len(_masters)))
+    start = time.monotonic()
+    with timing.stage(timing.SSH_CONNECT), tempfile.TemporaryFile() as err:
+        # -f backgrounds the master once authenticated; it must not hold on to our pipes.
+        result = subprocess.run(['ssh', '-f', '-N', '-o', 'ControlMaster=yes',
+                                 '-o', 'ControlPath=' + control_path,
+                                 '-o', 'ControlPersist=' + CONTROL_PERSIST, host],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=err)
+        handshake = time.monotonic() - start
+        if result.returncode != 0:
+            err.seek(0)
+            logging.warning('Could not open SSH control master to [%s] [exit %d]; using direct connections.\n%s',
+                            host, result.returncode, err.read().decode(errors='replace'))
+            return None
+
+    logging.debug('Opened SSH control master to [%s] in %.3fs', host, handshake)
+    return _Master(control_path, handshake)
+
+
+def _ssh_options(host):
+    """ssh options that route a connection to host through its control master."""
+    master = _open_master(host)
+    if master is None:
+        return []
+    with _masters_lock:
+        master.uses += 1
+    return ['-o', 'ControlPath=' + master.control_path]
+
+
+def _rsync_shell(dest):
+    """rsync arguments making a remote transfer use the host's control master."""
+    m = _REMOTE_HOST_PATH.match(dest)
+    if not m:
+        return []
+    options = _ssh_options(m.group(1))
+    return ['-e', ' '.join(['ssh'] + options)] if options else []
+
+
+def close_masters():
+    """Shut down every control master opened in this run and log the handshake time saved."""
+
+    global _control_dir
+
+    for host, master in _masters.items():
+        if master is None:
+            continue
+        subprocess.run(['ssh', '-o', 'ControlPath=' + master.control_path, '-O', 'exit', host],
+                       capture_output=True)
+        # Every use after the first would otherwise have paid for its own handshake.
+        saved = max(master.uses - 1, 0) * master.handshake
+        logging.info('SSH control master [%s]: handshake %.3fs, %d connection(s) reused it, ~%.3fs saved',
+                     host, master.handshake, master.uses, saved)
+    _masters.clear()
+
+    if _control_dir is not None:
+        shutil.rmtree(_control_dir, ignore_errors=True)
+        _control_dir = None
+        atexit.unregister(close_masters)
+
+
 def _mkdir_remote(dest, is_dir):
     """Create the remote directory via SSH before rsync (--mkpath requires rsync 3.2.3+)."""
     m = _REMOTE_HOST_PATH.match(dest)
@@ -22,15 +142,104 @@ def _mkdir_remote(dest, is_dir):
         return
     host, path = m.group(1), m.group(2)
     remote_dir = path if is_dir else os.path.dirname(path)
-    subprocess.run(['ssh', host, f'mkdir -p "{remote_dir}"'], capture_output=True)
+    with timing.stage(timing.SSH_MKDIR):
+        subprocess.run(['ssh'] + _ssh_options(host) + [host, f'mkdir -p {shlex.quote(remote_dir)}'],
+                       capture_output=True)
+
+
+def stream(command, dest):
+    """Run command and pipe its stdout straight into the remote file dest over ssh.
+
+    The data is written once, directly on the remote host. It lands in a .part file that is
+    only renamed to dest if both the command and the transfer succeed, and is removed
+    otherwise. Returns True on success, False on failure."""
+
+    m = _REMOTE_HOST_PATH.match(dest)
+    if not m:
+        raise ValueError('Not a remote destination: %s' % dest)
+    host, path = m.group(1), m.group(2)
+    part = path + '.part'
+    ssh = ['ssh'] + _ssh_options(host) + [host]
+
+    with timing.stage(timing.FFMPEG), tempfile.TemporaryFile() as err:
+        producer = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=err)
+        consumer = subprocess.Popen(ssh + [f'mkdir -p {shlex.quote(posixpath.dirname(path))} && '
+                                           f'cat > {shlex.quote(part)}'],
+                                    stdin=producer.stdout, stderr=err)
+        # Only the consumer should hold the read end, so it sees EOF when the producer exits.
+        producer.stdout.close()
+        consumer_status = consumer.wait()
+        producer_status = producer.wait()
+        success = producer_status == 0 and consumer_status == 0
+        if not success:
+            err.seek(0)
+            logging.error('Streaming to [%s] failed [exit %d/%d]\n%s', dest, producer_status, consumer_status,
+                          err.read().decode(errors='replace'))
+
+    finish = f'mv {shlex.quote(part)} {shlex.quote(path)}' if success else f'rm -f {shlex.quote(part)}'
+    with timing.stage(timing.SSH_COMMAND):
+        result = subprocess.run(ssh + [finish], capture_output=True)
+    if success and result.returncode != 0:
+        logging.error('Could not move [%s] into place on [%s]\n%s', part, host,
+                      result.stderr.decode(errors='replace'))
+        return False
+    return success
+
+
+def rename(src, dest):
+    """Move the remote file src to dest on the same host (both user@host:/path), creating dest's directory.
+
+    Returns True on success, False on failure or if the two are on different hosts."""
+
+    src_match, dest_match = _REMOTE_HOST_PATH.match(src), _REMOTE_HOST_PATH.match(dest)
+    if not src_match or not dest_match or src_match.group(1) != dest_match.group(1):
+        return False
+    host, src_path, dest_path = src_match.group(1), src_match.group(2), dest_match.group(2)
+    with timing.stage(timing.SSH_COMMAND):
+        result = subprocess.run(['ssh'] + _ssh_options(host)
+                                + [host, f'mkdir -p {shlex.quote(posixpath.dirname(dest_path))} && '
+                                         f'mv -f {shlex.quote(src_path)} {shlex.quote(dest_path)}'],
+                                capture_output=True)
+    if result.returncode != 0:
+        logging.error('Could not move [%s] to [%s] on [%s]\n%s', src_path, dest_path, host,
+                      result.stderr.decode(errors='replace'))
+        return False
+    return True
+
+
+def _rsync_options(resume):
+    """--partial keeps whatever arrived if a transfer is cut off. Only when resuming one of our own
+    interrupted transfers is it safe to append to what is there (a plain run may be replacing an
+    unrelated, longer file)."""
+    return RSYNC_OPTIONS + (RESUME_OPTIONS if resume else [])
+
+
+def _rsync_command(resume, drop_cache):
+    """rsync with its options; run under nocache (if installed) when drop_cache is set, so reading the
+    sources doesn't flush the page cache."""
+
+    command = ['rsync'] + _rsync_options(resume)
+    if drop_cache:
+        if shutil.which('nocache'):
+            return ['nocache'] + command
+        logging.debug('nocache is not installed; dropping the cached sources after the transfer instead')
+    return command
+
 
+def _release(src, drop_cache):
+    """A transferred source that is kept doesn't need to stay in the page cache either."""
+    if drop_cache:
+        transfer.drop_cache(src)
 
-def rsync(src, dest):
+
+def rsync(src, dest, resume=False, keep_source=False, drop_cache=False):
     """Copy src to dest using rsync over SSH.
 
     Appends trailing slashes for directory sources so rsync copies contents
-    into the named destination (matching shutil.move behaviour).
-    Deletes local src on success. Returns True on success, False on failure."""
+    into the named destination (matching shutil.move behaviour). With resume, data already
+    at dest is kept and only the rest is sent, after which the whole file is verified.
+    Deletes local src on success unless keep_source. drop_cache keeps the transfer from filling
+    the page cache. Returns True on success, False on failure."""
     is_dir = os.path.isdir(src)
     cmd_src = src.rstrip('/') + '/' if is_dir else src
     cmd_dest = dest.rstrip('/') + '/' if is_dir else dest
@@ -38,15 +247,257 @@ def rsync(src, dest):
     if is_remote(dest):
         _mkdir_remote(dest, is_dir)
 
-    result = subprocess.run(['rsync', '-a', cmd_src, cmd_dest], capture_output=True)
+    with timing.stage(timing.RSYNC):
+        result = subprocess.run(_rsync_command(resume, drop_cache) + _rsync_shell(dest) + [cmd_src, cmd_dest],
+                                capture_output=True)
     if result.returncode != 0:
         logging.error('rsync failed [exit %d]: [%s] -> [%s]\n%s',
                       result.returncode, src, dest, result.stderr.decode(errors='replace'))
         return False
 
+    if keep_source:
+        _release(src, drop_cache)
+        logging.info('rsync succeeded, kept local copy: [%s]', src)
+        return True
     if is_dir:
         shutil.rmtree(src)
     else:
         os.remove(src)
     logging.info('rsync succeeded, removed local copy: [%s]', src)
     return True
+
+
+def _send_verified(host, source, remote_path, label, stage, check=None):
+    """Write the binary stream source to remote_path on host, hashing it on both ends. Returns (size, sha256) or None.
+
+    Each chunk is hashed here as it is written to ssh. On the NAS, tee saves it as a .part file and
+    feeds sha256sum at the same time. The .part file is renamed into place only if the remote hash
+    and the size on the NAS match, and check (if given) returns True once source is exhausted."""
+
+    import hashlib
+
+    part = remote_path + '.part'
+    ssh = ['ssh'] + _ssh_options(host) + [host]
+    digest = hashlib.sha256()
+    size = 0
+    with timing.stage(stage), tempfile.TemporaryFile() as err:
+        receiver = subprocess.Popen(ssh + [f'mkdir -p {shlex.quote(posixpath.dirname(remote_path))} && '
+                                           f'tee {shlex.quote(part)} | sha256sum && stat -c %s {shlex.quote(part)}'],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=err)
+        try:
+            while True:
+                chunk = source.read(VERIFY_CHUNK)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                receiver.stdin.write(chunk)
+            receiver.stdin.close()
+        except BrokenPipeError:
+            # The remote side gave up; its exit status says why.
+            pass
+        output = receiver.stdout.read().decode(errors='replace').split()
+        status = receiver.wait()
+        err.seek(0)
+        errors = err.read().decode(errors='replace')
+        produced = check is None or check()
+
+    expected = digest.hexdigest()
+    # sha256sum prints "<hash>  -", then stat the size
+    verified = produced and status == 0 and output[:1] == [expected] and output[2:3] == [str(size)]
+    if status != 0:
+        logging.error('Sending [%s] to [%s:%s] failed [exit %d]\n%s', label, host, remote_path, status, errors)
+    elif produced and not verified:
+        logging.error('Verification of [%s] on [%s] failed: sent %d bytes with SHA-256 %s, NAS has %s',
+                      label, host, size, expected, output)
+
+    finish = (f'mv -f {shlex.quote(part)} {shlex.quote(remote_path)}' if verified
+              else f'rm -f {shlex.quote(part)}')
+    with timing.stage(timing.SSH_COMMAND):
+        result = subprocess.run(ssh + [finish], capture_output=True)
+    if verified and result.returncode != 0:
+        logging.error('Could not move [%s] into place on [%s]\n%s', part, host, result.stderr.decode(errors='replace'))
+        return None
+    return (size, expected) if verified else None
+
+
+def _send_file(host, src, remote_path):
+    """Send one file over the host's SSH connection with _send_verified. Returns (size, sha256) or None."""
+    with open(src, 'rb') as f:
+        return _send_verified(host, f, remote_path, src, timing.SSH_SEND)
+
+
+def stream_verified(command, dest):
+    """Run command and send its stdout to the remote file dest (user@host:/path), verified end to end.
+
+    Like stream, but the data passes through here to be hashed (see _send_verified), and the file is
+    only put in place if command succeeded as well. Returns (size, sha256) of the delivered file, or
+    None on failure."""
+
+    m = _REMOTE_HOST_PATH.match(dest)
+    if not m:
+        raise ValueError('Not a remote destination: %s' % dest)
+    host, path = m.group(1), m.group(2)
+
+    with tempfile.TemporaryFile() as err:
+        producer = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=err)
+
+        def produced():
+            # Closed first, so a producer still writing after a failed send exits instead of blocking.
+            producer.stdout.close()
+            status = producer.wait()
+            if status != 0:
+                err.seek(0)
+                logging.error('Streaming to [%s] failed [exit %d]\n%s', dest, status,
+                              err.read().decode(errors='replace'))
+            return status == 0
+
+        return _send_verified(host, producer.stdout, path, dest, timing.FFMPEG, produced)
+
+
+def send_verified(src, dest, keep_source=False, drop_cache=False):
+    """Copy src (a file or directory tree) to the remote dest (user@host:/path), verifying each file end to end.
+
+    Used instead of rsync when transfers are verified. Every file goes through _send_file on the
+    host's multiplexed SSH connection. The local src is deleted only once all of its files arrived
+    intact, and kept regardless with keep_source. Returns {remote user@host:/file: (size, sha256)}
+    for the delivered files, or None if any of them failed."""
+
+    m = _REMOTE_HOST_PATH.match(dest)
+    if not m:
+        raise ValueError('Not a remote destination: %s' % dest)
+    host, path = m.group(1), m.group(2).rstrip('/')
+
+    if os.path.isdir(src):
+        files = [(os.path.join(root, name), posixpath.join(path, os.path.relpath(os.path.join(root, name), src)))
+                 for root, dirs, names in os.walk(src) for name in sorted(names)]
+    else:
+        files = [(src, path)]
+
+    hashes = {}
+    for local_path, remote_path in files:
+        result = _send_file(host, local_path, remote_path)
+        if result is None:
+            logging.error('Verified transfer failed: [%s] -> [%s]', src, dest)
+            return None
+        hashes[f'{host}:{remote_path}'] = result
+
+    if keep_source:
+        _release(src, drop_cache)
+        logging.info('Transfer verified, kept local copy: [%s] -> [%s]', src, dest)
+        return hashes
+    if os.path.isdir(src):
+        shutil.rmtree(src)
+    else:
+        os.remove(src)
+    logging.info('Transfer verified, removed local copy: [%s] -> [%s]', src, dest)
+    return hashes
+
+
+def _stage(src, staged):
+    """Hard-link src (a file or a directory tree) to the staged path."""
+    os.makedirs(os.path.dirname(staged), exist_ok=True)
+    if not os.path.isdir(src):
+        os.link(src, staged)
+        return
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(staged, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.link(os.path.join(root, name), os.path.join(target, name))
+
+
+def _arrived(staged):
+    """rsync --remove-source-files deletes every staged file that reached the remote side."""
+    if not os.path.isdir(staged):
+        return not os.path.lexists(staged)
+    return not any(files for _, _, files in os.walk(staged))
+
+
+def _rsync_host(host, items, resume=False, keep_source=False, drop_cache=False):
+    """Transfer [(src, remote_path)] to one host in a single rsync run. Returns {src: success}."""
+
+    results = {}
+    root = posixpath.commonpath([posixpath.dirname(p.rstrip('/')) for _, p in items])
+    stage = tempfile.mkdtemp(prefix='.rsync-stage-', dir=os.path.dirname(os.path.abspath(items[0][0])))
+    staged = {}
+    fallback = []
+    try:
+        for src, remote_path in items:
+            target = os.path.join(stage, posixpath.relpath(remote_path.rstrip('/'), root))
+            if os.path.lexists(target):
+                fallback.append((src, remote_path))
+                continue
+            try:
+                _stage(src, target)
+                staged[src] = (target, remote_path)
+            except OSError:
+                # Hard links need the stage on the same file system; send this one on its own.
+                logging.debug('Could not stage [%s] for batch transfer', src, exc_info=True)
+                if os.path.isdir(target):
+                    shutil.rmtree(target, ignore_errors=True)
+                fallback.append((src, remote_path))
+
+        if staged:
+            logging.info('Sending %d item(s) to [%s:%s] in one rsync run', len(staged), host, root)
+            _mkdir_remote(f'{host}:{root}', True)
+            dest_root = f"{host}:{root.rstrip('/')}/"
+            with timing.stage(timing.RSYNC):
+                result = subprocess.run(_rsync_command(resume, drop_cache)
+                                        + BATCH_OPTIONS
+                                        + _rsync_shell(dest_root) + [stage + '/', dest_root], capture_output=True)
+            if result.returncode != 0:
+                logging.error('rsync batch to [%s:%s] exited with [%d]\n%s', host, root, result.returncode,
+                              result.stderr.decode(errors='replace'))
+
+            for src, (target, remote_path) in staged.items():
+                dest = f'{host}:{remote_path}'
+                if not _arrived(target):
+                    logging.error('rsync failed: [%s] -> [%s]', src, dest)
+                    results[src] = False
+                    continue
+                results[src] = True
+                if keep_source:
+                    _release(src, drop_cache)
+                    logging.info('rsync succeeded, kept local copy: [%s] -> [%s]', src, dest)
+                    continue
+                if os.path.isdir(src):
+                    shutil.rmtree(src)
+                else:
+                    os.remove(src)
+                logging.info('rsync succeeded, removed local copy: [%s] -> [%s]', src, dest)
+    finally:
+        shutil.rmtree(stage, ignore_errors=True)
+
+    for src, remote_path in fallback:
+        results[src] = rsync(src, f'{host}:{remote_path}', resume, keep_source, drop_cache)
+
+    return results
+
+
+def rsync_batch(moves, resume=False, keep_source=False, drop_cache=False):
+    """Copy many (src, dest) pairs using one rsync invocation per remote host.
+
+    Sources are hard-linked into a staging tree that mirrors the remote layout, so renamed
+    destinations work, and the whole tree is sent at once with --remove-source-files. Whatever
+    is left in the stage afterwards didn't arrive. Local sources are deleted only for the items
+    that arrived, and not at all with keep_source. resume and drop_cache are passed on to rsync.
+    Returns a dict of src -> True/False in the order of moves."""
+
+    by_host = {}
+    results = {}
+    for src, dest in moves:
+        m = _REMOTE_HOST_PATH.match(dest)
+        if m:
+            by_host.setdefault(m.group(1), []).append((src, m.group(2)))
+        else:
+            results[src] = rsync(src, dest, resume, keep_source, drop_cache)
+
+    for host, items in by_host.items():
+        if len(items) == 1:
+            src, remote_path = items[0]
+            results[src] = rsync(src, f'{host}:{remote_path}', resume, keep_source, drop_cache)
+        else:
+            results.update(_rsync_host(host, items, resume, keep_source, drop_cache))
+
+    return {src: results[src] for src, _ in moves}
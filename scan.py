@@ -0,0 +1,113 @@
+import logging
+import os
+
+
+class ScanEntry:
+    """One entry of a scanned directory.
+
+    The file type comes from the directory listing itself. The size is read with a single
+    stat on first use and cached by the DirEntry."""
+
+    __slots__ = ('name', 'path', 'is_dir', '_entry')
+
+    def __init__(self, entry):
+        self.name = entry.name
+        self.path = entry.path
+        self.is_dir = entry.is_dir()
+        self._entry = entry
+
+    @property
+    def size(self):
+        return self._entry.stat().st_size
+
+    def __repr__(self):
+        return 'ScanEntry(%r, is_dir=%s)' % (self.path, self.is_dir)
+
+
+class ScanResult:
+    """Files and directories found by a single pass over a directory, in listing order."""
+
+    def __init__(self, directory, files, dirs):
+        self.directory = directory
+        self.files = files
+        self.dirs = dirs
+
+    def file_names(self):
+        return [e.name for e in self.files]
+
+    def dir_names(self):
+        return [e.name for e in self.dirs]
+
+
+def scan_dir(directory):
+    """List directory once with os.scandir, splitting the entries into files and directories.
+
+    Entries that are neither (sockets, broken links, ...) are ignored, as isfile/isdir would."""
+
+    files = []
+    dirs = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    files.append(ScanEntry(entry))
+                elif entry.is_dir():
+                    dirs.append(ScanEntry(entry))
+            except OSError:
+                logging.debug('Skipping unreadable entry [%s]', entry.path, exc_info=True)
+    return ScanResult(directory, files, dirs)
+
+
+def walk(base_dir, skip_dirs=None, skipped=None):
+    """Yield a ScanEntry for every file and directory below base_dir, parents before their children.
+
+    Each directory is listed once with os.scandir. Directories whose name matches skip_dirs (a
+    compiled pattern) are neither yielded nor descended into, only appended to the skipped list if
+    one is given; symbolic links to directories are
+    not followed, as with os.walk. Being a generator, callers that stop early never list the rest
+    of the tree."""
+
+    stack = [base_dir]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            logging.warning('Could not list directory [%s]', directory, exc_info=True)
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if skip_dirs is not None and skip_dirs.search(entry.name):
+                            logging.debug('Skipping directory [%s]', entry.path)
+                            if skipped is not None:
+                                skipped.append(entry.path)
+                            continue
+                        subdirs.append(entry.path)
+                        yield ScanEntry(entry)
+                    elif entry.is_file():
+                        yield ScanEntry(entry)
+                except OSError:
+                    logging.debug('Skipping unreadable entry [%s]', entry.path, exc_info=True)
+        # Pop subdirectories in listing order.
+        stack.extend(reversed(subdirs))
+
+
+def largest_file(entries, feature_size=None):
+    """Return the path of the largest file among entries, or None if there are no files.
+
+    Keeps a running maximum instead of sorting; ties go to the later path. If feature_size is
+    given, the first file at least that big is taken to be the feature and the search stops."""
+
+    best = None
+    for entry in entries:
+        if entry.is_dir:
+            continue
+        size = entry.size
+        if feature_size and size >= feature_size:
+            return entry.path
+        if best is None or (size, entry.path) > best:
+            best = (size, entry.path)
+    return best[1] if best else None
@@ -0,0 +1,76 @@
+import logging
+
+LOCAL = 'local'
+REMOTE = 'remote'
+DEFAULT_LIMITS = {LOCAL: 1, REMOTE: 1}
+
+
+def parse_limits(setting):
+    """Turn the maxParallelTransfers config value into {'local': n, 'remote': n}.
+
+    The setting may be a single number applied to both kinds of destination, or an object
+    with separate 'local' and/or 'remote' entries."""
+
+    limits = dict(DEFAULT_LIMITS)
+    if setting is None:
+        return limits
+    if isinstance(setting, dict):
+        limits.update(setting)
+    else:
+        limits = {LOCAL: setting, REMOTE: setting}
+
+    for kind, value in limits.items():
+        if int(value) < 1:
+            raise ValueError('maxParallelTransfers for %s destinations must be at least 1' % kind)
+        limits[kind] = int(value)
+    return limits
+
+
+class TransferScheduler:
+    """Run transfer jobs on worker pools with separate concurrency limits for local and remote
+    destinations.
+
+    Each submitted job runs to completion on one worker, so anything that has to stay in order
+    (e.g. the files of one series folder) should be submitted as a single job."""
+
+    def __init__(self, limits=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.limits = limits or dict(DEFAULT_LIMITS)
+        self._pools = {kind: ThreadPoolExecutor(max_workers=limit, thread_name_prefix='transfer-' + kind)
+                       for kind, limit in self.limits.items()}
+        self._futures = []
+
+    def submit(self, kind, job, *args):
+        """Queue job(*args) against the pool for the given kind of destination."""
+        future = self._pools[kind].submit(job, *args)
+        self._futures.append(future)
+        return future
+
+    def chunks(self, kind, groups):
+        """Spread ordered groups over as many chunks as the kind allows, keeping each group whole."""
+        chunks = [[] for _ in range(min(self.limits[kind], len(groups)))]
+        for index, group in enumerate(groups):
+            chunks[index % len(chunks)].extend(group)
+        return chunks
+
+    def wait(self):
+        """Wait for every submitted job and merge the dicts they return."""
+        results = {}
+        for future in self._futures:
+            try:
+                results.update(future.result())
+            except Exception:
+                logging.exception('Transfer job failed')
+        self._futures = []
+        return results
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+import argparse
+import random
+import unittest
+
+import benchmark
+import logger
+
+logger.config()
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_pipeline(self):
+        args = argparse.Namespace(files=20, series=10, releases=2, movie_gb=0.01, seed=1)
+        results = benchmark.bench_pipeline(args, random.Random(args.seed))
+
+        for run in ('local', 'nas'):
+            self.assertEqual((10, 2, 2), (results[run]['episodes'], results[run]['releases'],
+                                          results[run]['tmdb_queries']))
+        self.assertIn('rsync', results['nas']['stages'])
+        self.assertNotIn('rsync', results['local']['stages'])
+
+    def test_parse(self):
+        args = argparse.Namespace(files=1000, repeat=1, seed=1)
+        results = benchmark.bench_parse(args, random.Random(args.seed))
+        self.assertGreater(results['fast_path_share'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+import json
+import os
+import pickle
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import config_cache
+import logger
+from copy_files import CopyMedia
+from exceptions import ConfigurationError
+
+logger.config()
+
+SERIES = [{'name': 'World Trigger', 'regex': '(.*)(World Trigger)( - )(\\d{1,})(.*)',
+           'replace': '\\1World Trigger\\3S03E\\4\\5'},
+          {'name': 'Anything', 'regex': '.*\\.mkv'}]
+
+
+class TestConfigCache(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.config_file = os.path.join(self._tmpdir.name, 'CopyMedia.json')
+        self.write_config(SERIES)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def write_config(self, series):
+        with open(self.config_file, 'w') as f:
+            json.dump({'scanDir': '/tmp', 'series': series}, f)
+
+    def load(self):
+        return config_cache.load(self.config_file, CopyMedia.compile_series)
+
+    def test_cached(self):
+        config, matcher = self.load()
+        self.assertEqual(SERIES, config['series'])
+
+        with patch.object(CopyMedia, 'compile_series') as compile_series:
+            config, matcher = self.load()
+            # Touching the file without changing it doesn't recompile either.
+            os.utime(self.config_file, ns=(0, 0))
+            self.load()
+        compile_series.assert_not_called()
+
+        # Regexes are compiled only once they are needed.
+        self.assertEqual([None, None], matcher._patterns)
+        show, m, _ = matcher.match('[Sub] World Trigger - 05.mkv')
+        self.assertEqual('World Trigger', show['name'])
+        self.assertEqual((1, 'World Trigger', 3, 'S03E', 4, 5), matcher.renamers[0].template)
+
+    def test_changed(self):
+        self.load()
+        self.write_config(SERIES[:1])
+        os.utime(self.config_file, ns=(0, 1))
+
+        config, matcher = self.load()
+        self.assertEqual(1, len(matcher.series))
+
+    def test_invalid(self):
+        self.write_config(SERIES + [{'name': 'Broken', 'regex': '(a)', 'replace': '\\1\\2'}])
+        with self.assertRaisesRegex(ConfigurationError, 'Series entry 3 \\(Broken\\).*group 2'):
+            self.load()
+        self.write_config([{'regex': '(a'}])
+        with self.assertRaisesRegex(ConfigurationError, 'Series entry 1 .* no \'name\''):
+            self.load()
+        self.write_config([{'name': 'Broken', 'regex': '(a'}])
+        with self.assertRaisesRegex(ConfigurationError, 'Series entry 1 \\(Broken\\) is invalid'):
+            self.load()
+
+    def test_corrupt_cache(self):
+        self.load()
+        cache_file = os.path.join(config_cache.default_cache_dir(self.config_file), 'CopyMedia.json.pickle')
+        with open(cache_file, 'wb') as f:
+            f.write(pickle.dumps({'version': config_cache.CACHE_VERSION})[:5])
+
+        config, matcher = self.load()
+        self.assertEqual(2, len(matcher.series))
+
+
+if __name__ == '__main__':
+    unittest.main()
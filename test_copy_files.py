@@ -1,10 +1,19 @@
 #!/usr/bin/python3
+import hashlib
 import os
 import pathlib
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest.mock import MagicMock, patch
 
+import dedup
+import fakes
 import ifttt
+import journal
 import logger
+import remote
 import tmdb
 from copy_files import CopyMedia
 from exceptions import ConfigurationError
@@ -12,6 +21,9 @@ from exceptions import ConfigurationError
 CURRENT_DIR = pathlib.Path(__file__).parent.resolve()
 TEST_RESOURCES = os.path.join(CURRENT_DIR, 'test_resources')
 TEST_CONFIG = os.path.join(TEST_RESOURCES, 'test_CopyMedia.json')
+# Importing copy_files must stay cheap: it runs for every finished torrent on a low-power box. Its import time
+# is measured by `benchmark.py startup`.
+LAZY_MODULES = {'requests', 'urllib3', 'PTN', 'sqlite3', 'concurrent.futures', 'ctypes', 'cProfile'}
 IFTTT_CONTEXT_VAR = 'IFTTT_CONTEXT'
 TMDB_CONTEXT_VAR = 'TMDB_CONTEXT'
 
@@ -31,10 +43,32 @@ class TestCopyMedia(unittest.TestCase):
 
         self.assertEqual(r.status_code, 200)
 
+    def test_startup_imports(self):
+        # A fresh interpreter, so nothing this test run already imported counts.
+        result = subprocess.run([sys.executable, '-c', 'import sys, copy_files; print("\\n".join(sys.modules))'],
+                                capture_output=True, text=True, check=True, cwd=CURRENT_DIR)
+
+        self.assertEqual(set(), LAZY_MODULES & set(result.stdout.split()),
+                         'modules that should only load when needed were imported at start-up')
+
     def test_find_largest_file(self):
         largest = CopyMedia.find_largest_file(TEST_RESOURCES)
         self.assertEqual(os.path.basename(largest), 'big_file.mp4')
 
+    def test_find_largest_file_nested(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, size in [('Movie.2020/Sample/sample.mkv', 300), ('Movie.2020/CD1/movie.mkv', 200),
+                               ('Movie.2020/movie.nfo', 10), ('Movie.2020/Extras/Making.Of.mkv', 250)]:
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, name)), exist_ok=True)
+                with open(os.path.join(tmpdir, name), 'wb') as f:
+                    f.truncate(size)
+            base_dir = os.path.join(tmpdir, 'Movie.2020')
+
+            self.assertEqual(os.path.join(base_dir, 'CD1', 'movie.mkv'), CopyMedia.find_largest_file(base_dir))
+            # Past the feature size the search stops at the first big enough file.
+            self.assertEqual(os.path.join(base_dir, 'movie.nfo'),
+                             CopyMedia.find_largest_file(base_dir, feature_size=5))
+
     def test_find_english_subtitles(self):
         test_sub_dir = 'subtitle_test'
 
@@ -78,6 +112,65 @@ class TestCopyMedia(unittest.TestCase):
 
         self.assertEqual(expected.sort(), ignored_files.sort())
 
+    def test_clean_dir_nested(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name in ['Brave.2012.mp4', 'Brave.2012.en.srt', 'junk.txt', 'Subs/a/b/French.srt']:
+                os.makedirs(os.path.dirname(os.path.join(tmpdir, name)), exist_ok=True)
+                open(os.path.join(tmpdir, name), 'w').close()
+            movie = os.path.join(tmpdir, 'Brave.2012.mp4')
+            subtitle = os.path.join(tmpdir, 'Brave.2012.en.srt')
+
+            ignored_files = CopyMedia.clean_dir(tmpdir, movie, [subtitle])
+
+            self.assertEqual({movie, subtitle}, set(ignored_files))
+            self.assertEqual(['Brave.2012.en.srt', 'Brave.2012.mp4'], sorted(os.listdir(tmpdir)))
+
+    def test_strip_metadata_stream(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            movie = os.path.join(tmpdir, 'Brave.2012.mkv')
+            open(movie, 'w').close()
+            dest = os.path.join(tmpdir, 'movies', 'Brave.2012', 'Brave.2012.mkv')
+
+            def fake_ffmpeg(cmd, **kwargs):
+                # ffmpeg writes straight into a partial file beside the destination.
+                self.assertEqual(os.path.dirname(dest), os.path.dirname(cmd[-1]))
+                open(cmd[-1], 'w').close()
+                return MagicMock(returncode=0)
+
+            with patch('subprocess.run', side_effect=fake_ffmpeg) as mock_run, \
+                    patch('metadata.needs_strip', return_value=True):
+                self.assertTrue(CopyMedia.strip_metadata(movie, dest=dest))
+                self.assertEqual(1, mock_run.call_count)
+
+            self.assertTrue(os.path.isfile(dest))
+            self.assertFalse(os.path.exists(movie))
+            self.assertEqual(['Brave.2012.mkv'], os.listdir(os.path.dirname(dest)))
+
+            # A failed stream leaves nothing behind at the destination and keeps the original.
+            open(movie, 'w').close()
+            os.remove(dest)
+            with patch('subprocess.run', return_value=MagicMock(returncode=1)), \
+                    patch('metadata.needs_strip', return_value=True):
+                self.assertFalse(CopyMedia.strip_metadata(movie, dest=dest, in_place=False))
+            self.assertTrue(os.path.exists(movie))
+            self.assertEqual([], os.listdir(os.path.dirname(dest)))
+
+            # Nothing to strip: ffmpeg never runs and the movie stays where it is.
+            with patch('subprocess.run') as mock_run, patch('metadata.needs_strip', return_value=False):
+                self.assertFalse(CopyMedia.strip_metadata(movie, dest=dest))
+                mock_run.assert_not_called()
+            self.assertTrue(os.path.exists(movie))
+
+            # MP4 isn't piped to a remote host (it would arrive fragmented); it is stripped here and sent as is.
+            movie = os.path.join(tmpdir, 'Brave.2012.mp4')
+            open(movie, 'w').close()
+            with patch('remote.stream') as mock_stream, patch('metadata.needs_strip', return_value=True), \
+                    patch('metadata.strip_in_place', return_value=True) as strip_in_place:
+                self.assertFalse(CopyMedia.strip_metadata(movie, dest='user@nas:/Movies/Brave.2012/Brave.2012.mp4'))
+                mock_stream.assert_not_called()
+                strip_in_place.assert_called_once_with(movie)
+            self.assertTrue(os.path.exists(movie))
+
     def test_rename_movie(self):
         starting_dir_name = 'Toy.Story.4.2019.1080p.BluRay.H264.AAC-RARBG'
         new_dir_name = 'Toy_Story_4.2019'
@@ -114,6 +207,67 @@ class TestCopyMedia(unittest.TestCase):
                                        'Mid-town.1080p.AMZN.WEB-DL.DDP5.1.H.264-NTb', tmdb_key))
         self.assertFalse(tmdb.is_movie('sherlock.3x02.the_sign_of_three.720p_hdtv_x264-fov', tmdb_key))
 
+    def test_is_movie_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = tmdb.LookupCache(os.path.join(tmpdir, 'cache.sqlite'), negative_ttl=0)
+
+            with patch('tmdb.get_session') as mock_session:
+                mock_get = mock_session.return_value.get
+                mock_get.return_value = MagicMock(status_code=200, text='{"total_results": 1}')
+                self.assertTrue(tmdb.is_movie('Brave.2012.1080p.BluRay.x264.AC3-HDChina', 'key', cache))
+                self.assertTrue(tmdb.is_movie('Brave (2012) [720p]', 'key', cache))
+                self.assertEqual(1, mock_get.call_count)
+
+                # Negative answers expire on their own (zero) TTL, so this one is looked up twice.
+                mock_get.return_value = MagicMock(status_code=200, text='{"total_results": 0}')
+                self.assertFalse(tmdb.is_movie('Not.A.Real.Movie.2011.1080p', 'key', cache))
+                self.assertFalse(tmdb.is_movie('Not.A.Real.Movie.2011.1080p', 'key', cache))
+                self.assertEqual(3, mock_get.call_count)
+
+            self.assertEqual(1, cache.hits)
+            self.assertEqual(3, cache.misses)
+            cache.close()
+
+            # Entries survive between runs.
+            cache = tmdb.LookupCache(os.path.join(tmpdir, 'cache.sqlite'), max_entries=1)
+            self.assertTrue(cache.get('brave|2012'))
+            cache.put('another|2020', False)
+            self.assertIsNone(cache.get('brave|2012'))
+            cache.close()
+
+    def test_is_movie_error(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = tmdb.LookupCache(os.path.join(tmpdir, 'cache.sqlite'))
+
+            # TMDB's error bodies have no total_results, and the answer isn't worth remembering.
+            with patch('tmdb.get_session') as mock_session:
+                mock_session.return_value.get.return_value = MagicMock(
+                    status_code=401, text='{"status_code": 7, "status_message": "Invalid API key"}')
+                self.assertFalse(tmdb.is_movie('Brave.2012.1080p.BluRay.x264.AC3-HDChina', 'key', cache))
+
+            self.assertIsNone(cache.get('brave|2012'))
+            cache.close()
+
+    def test_classify_many(self):
+        def fake_get(url, timeout=None):
+            found = 'Brave' in url or 'Toy%20Story' in url
+            return MagicMock(status_code=200, text='{"total_results": %d}' % found)
+
+        names = ['Toy.Story.4.2019.1080p.BluRay.H264.AAC-RARBG',
+                 'Planet.Earth.II.S01E06',
+                 'Not.A.Real.Movie.2011.1080p',
+                 'Brave.2012.1080p.BluRay.x264.AC3-HDChina',
+                 'Brave (2012) [720p]']
+
+        with patch('tmdb.get_session') as mock_session:
+            mock_session.return_value.get.side_effect = fake_get
+            results = tmdb.classify_many(names, 'key')
+            # The episode is never queried and both Brave releases share a single query.
+            self.assertEqual(3, mock_session.return_value.get.call_count)
+
+        self.assertEqual([True, False, False, True, True], results)
+        self.assertEqual([False] * len(names), tmdb.classify_many(names, None))
+
     def test_clean_name(self):
 
         meta = tmdb.clean_name('22 Jump Street 2014 1080p BluRay x265 HEVC 10bit AAC 5.1-LordVako')
@@ -149,6 +303,27 @@ class TestCopyMedia(unittest.TestCase):
         self.assertEqual(3, meta['season'])
         self.assertEqual(2, meta['episode'])
 
+    def test_clean_name_fast_path(self):
+        fields = ('title', 'year', 'season', 'episode')
+        for name in ['22 Jump Street 2014 1080p BluRay x265 HEVC 10bit AAC 5.1-LordVako',
+                     'Brave.2021.1080p.BluRay.x264.AC3-HDChina', 'Mr. Robot 2015 720p', 'Who (1970)-SPARKS',
+                     'The.Marvelous.Mrs.Maisel.S02E02.Mid-way.to.Mid-town.1080p.AMZN.WEB-DL.DDP5.1.H.264-NTb']:
+            meta = tmdb.fast_parse(name)
+            self.assertIsNotNone(meta, name)
+            self.assertEqual({k: v for k, v in tmdb.ptn_parse(name).items() if k in fields}, meta)
+
+        # Names PTN reads in its own way are left to it.
+        for name in ['Se7en.1995.1080p', 'Dune.2021.Part.One.1080p', 'Dune (2021) 1080p',
+                     'Blade.Runner.2049.2017.1080p', 'sherlock.3x02.the_sign_of_three.720p_hdtv_x264-fov',
+                     'Show.2019.S01E01.720p', '[SubsPlease] Jujutsu Kaisen - 13 (1080p)']:
+            self.assertIsNone(tmdb.fast_parse(name), name)
+
+        tmdb._parse.cache_clear()
+        meta = tmdb.clean_name('Brave.2012.1080p.BluRay.x264.AC3-HDChina')
+        meta['title'] = 'changed'
+        self.assertEqual('Brave', tmdb.clean_name('Brave.2012.1080p.BluRay.x264.AC3-HDChina')['title'])
+        self.assertEqual((1, 1), tmdb._parse.cache_info()[:2])
+
     def test_process_configs(self):
         with self.assertRaises(ConfigurationError):
             CopyMedia(config_file=TEST_CONFIG)
@@ -175,6 +350,15 @@ class TestCopyMedia(unittest.TestCase):
 
         self.assertEqual(scan_path, c.scandir)
 
+    def test_without_notifier(self):
+        # Set up before the configuration is processed: nothing to notify through yet.
+        c = CopyMedia.__new__(CopyMedia)
+        c.ntfy_url, c.ntfy_token = 'https://ntfy.sh/topic', 'mytoken'
+
+        self.assertIsNone(c.notifier)
+        c._notify_error('CopyMedia error')
+        c.finish()
+
     def test_process_configs_ntfy(self):
         series_path = '/remote/test/series'
         movie_path = '/remote/test/movies'
@@ -212,6 +396,137 @@ class TestCopyMedia(unittest.TestCase):
         self.assertEqual('[SubsPlease] That Time I Got Reincarnated as a Slime - S02E14 (1080p) [CAF0A4D1].mkv',
                          new_name)
 
+    def test_series_file_rename_pipeline(self):
+        series = [{'name': 'Jujutsu Kaisen', 'regex': '(.*)(Jujutsu Kaisen)( - )(\\d{1,})(.*)',
+                   'replace': '\\1\\2\\3S02E\\4\\5', 'episode_num_sub': '12', 'season': '3'}]
+        file_name = '[S02E13 Subs] Jujutsu Kaisen - 13 (1080p).mkv'
+
+        matches, _ = CopyMedia.match_files([file_name], series)
+        with patch('re.compile') as compile_regex:
+            new_name = CopyMedia.build_new_name(*matches[0], matches[0].series_match)
+        compile_regex.assert_not_called()
+
+        # Only the last SxxEyy is renumbered and the padding is kept.
+        self.assertEqual('[S02E13 Subs] Jujutsu Kaisen - S03E01 (1080p).mkv', new_name)
+        self.assertEqual(new_name, CopyMedia.build_new_name(file_name, series[0]))
+
+    def test_move_series_parallel(self):
+        with tempfile.TemporaryDirectory() as scan, tempfile.TemporaryDirectory() as series_dir:
+            c = CopyMedia(config_file=TEST_CONFIG, scandir=scan, seriesdir=series_dir, moviedir=series_dir)
+            c.transfer_limits = {'local': 2, 'remote': 1}
+            c.journal_file = None
+            c.dedup_index_file = None
+
+            files = ['[SubsPlease] World Trigger - %02d (1080p).mkv' % i for i in range(1, 4)]
+            files.append('[SubsPlease] One-Punch Man - 01 (1080p).mkv')
+            for f in files:
+                open(os.path.join(scan, f), 'w').close()
+
+            matches, _ = CopyMedia.match_files(files + ['[SubsPlease] World Trigger - 04 (1080p).mkv'], c.series)
+            results = c.move_series(matches, series_dir, scan)
+
+            self.assertEqual([True] * 4 + [False], [results[f] for f, _ in matches])
+            self.assertEqual(3, len(os.listdir(os.path.join(series_dir, 'World Trigger'))))
+            self.assertEqual(['[SubsPlease] One-Punch Man - 01 (1080p).mkv'],
+                             os.listdir(os.path.join(series_dir, 'One Punch Man')))
+
+    def test_process_movie_hardlink(self):
+        with tempfile.TemporaryDirectory() as scan, tempfile.TemporaryDirectory() as movie_dir:
+            c = CopyMedia(config_file=TEST_CONFIG, scandir=scan, seriesdir=movie_dir, moviedir=movie_dir)
+            c.journal_file = None
+            c.dedup_index_file = None
+            c.delivery_modes = {'series': 'move', 'movies': 'hardlink'}
+
+            release = os.path.join(scan, 'Movie.Title.2020.1080p.WEB-DL')
+            os.makedirs(os.path.join(release, 'Subs'))
+            fakes.sparse_movie(os.path.join(release, 'Movie.Title.2020.1080p.WEB-DL.mp4'), 1024 * 1024)
+            for name in ('Subs/English.srt', 'Subs/French.srt', 'release.nfo'):
+                open(os.path.join(release, name), 'w').close()
+            before = sorted(os.path.relpath(os.path.join(d, f), release) for d, _, files in os.walk(release)
+                            for f in files)
+
+            c.process_movie('Movie.Title.2020.1080p.WEB-DL')
+
+            # The seeding release is untouched and the library copy shares its data.
+            self.assertEqual(before, sorted(os.path.relpath(os.path.join(d, f), release)
+                                            for d, _, files in os.walk(release) for f in files))
+            delivered = os.path.join(movie_dir, 'Movie_Title.2020')
+            self.assertEqual(['Movie_Title.2020.en.srt', 'Movie_Title.2020.mp4'], sorted(os.listdir(delivered)))
+            self.assertTrue(os.path.samefile(os.path.join(release, 'Movie.Title.2020.1080p.WEB-DL.mp4'),
+                                             os.path.join(delivered, 'Movie_Title.2020.mp4')))
+            self.assertEqual([], os.listdir(os.path.join(scan, 'tmp')))
+
+    def test_process_movie_stream(self):
+        with tempfile.TemporaryDirectory() as scan, tempfile.TemporaryDirectory() as movie_dir:
+            c = CopyMedia(config_file=TEST_CONFIG, scandir=scan, seriesdir=movie_dir, moviedir=movie_dir)
+            c.journal_file = os.path.join(scan, journal.JOURNAL_FILE)
+            c.dedup_index_file = os.path.join(scan, dedup.INDEX_FILE)
+
+            release = os.path.join(scan, 'Movie.Title.2020.1080p.WEB-DL')
+            os.makedirs(release)
+            with open(os.path.join(release, 'Movie.Title.2020.1080p.WEB-DL.mkv'), 'wb') as f:
+                f.write(b'movie with meta-data')
+            open(os.path.join(release, 'English.srt'), 'w').close()
+            movie = os.path.join(scan, 'Movie_Title.2020', 'Movie_Title.2020.mkv')
+            dest = os.path.join(movie_dir, 'Movie_Title.2020', 'Movie_Title.2020.mkv')
+            key = dedup.partial_hash(os.path.join(release, 'Movie.Title.2020.1080p.WEB-DL.mkv'))
+
+            def fake_ffmpeg(cmd, **kwargs):
+                # The stream is in the journal before it starts, so a crash leaves it to resume.
+                self.assertEqual([(movie, dest, True)], [(r['src'], r['dest'], r['stream'])
+                                                         for r in c.journal.unfinished() if r['src'] == movie])
+                with open(cmd[-1], 'wb') as f:
+                    f.write(b'movie')
+                return MagicMock(returncode=0)
+
+            with patch('subprocess.run', side_effect=fake_ffmpeg) as mock_run, \
+                    patch('metadata.needs_strip', return_value=True):
+                c.process_movie('Movie.Title.2020.1080p.WEB-DL')
+                self.assertEqual(1, mock_run.call_count)
+            c.finish()
+
+            self.assertEqual(['Movie_Title.2020.en.srt', 'Movie_Title.2020.mkv'],
+                             sorted(os.listdir(os.path.dirname(dest))))
+            self.assertEqual(['dedup_index.sqlite', journal.JOURNAL_FILE], sorted(os.listdir(scan)))
+            # Recorded under the download's fingerprint, so the same download is recognised later.
+            index = dedup.DedupIndex(c.dedup_index_file)
+            self.assertEqual([dest], index.lookup(key))
+            index.close()
+
+    def test_process_movie_stream_verified(self):
+        with tempfile.TemporaryDirectory() as scan, tempfile.TemporaryDirectory() as tmpdir:
+            nas = fakes.FakeNAS(os.path.join(tmpdir, 'nas'))
+            c = CopyMedia(config_file=TEST_CONFIG, scandir=scan, seriesdir=scan, moviedir=nas.remote('Movies'))
+            c.journal_file = None
+            c.dedup_index_file = os.path.join(tmpdir, dedup.INDEX_FILE)
+            c.verify_transfers = True
+
+            release = os.path.join(scan, 'Movie.Title.2020.1080p.WEB-DL')
+            os.makedirs(release)
+            with open(os.path.join(release, 'Movie.Title.2020.1080p.WEB-DL.mkv'), 'wb') as f:
+                f.write(b'movie with meta-data')
+            # ffmpeg writing the stripped movie to its stdout
+            ffmpeg = os.path.join(tmpdir, 'bin', 'ffmpeg')
+            os.makedirs(os.path.dirname(ffmpeg))
+            with open(ffmpeg, 'w') as f:
+                f.write('#!%s\nimport sys\nsys.stdout.buffer.write(b"stripped movie")\n' % sys.executable)
+            os.chmod(ffmpeg, 0o755)
+
+            with nas, patch.object(remote, 'MULTIPLEX', False), patch('metadata.needs_strip', return_value=True), \
+                    patch.dict(os.environ, {'PATH': os.path.dirname(ffmpeg) + os.pathsep + os.environ['PATH']}):
+                c.process_movie('Movie.Title.2020.1080p.WEB-DL')
+                c.finish()
+
+            # The streamed bytes were checked on the NAS before the source went.
+            delivered = os.path.join(nas.root, 'Movies', 'Movie_Title.2020', 'Movie_Title.2020.mkv')
+            with open(delivered, 'rb') as f:
+                self.assertEqual(b'stripped movie', f.read())
+            self.assertEqual([], os.listdir(scan))
+            index = dedup.DedupIndex(c.dedup_index_file)
+            self.assertEqual((14, hashlib.sha256(b'stripped movie').hexdigest()),
+                             index.verified_hash(nas.remote('Movies/Movie_Title.2020/Movie_Title.2020.mkv')))
+            index.close()
+
     def test_match_files(self):
         c = CopyMedia()
 
@@ -0,0 +1,186 @@
+#!/usr/bin/python3
+import hashlib
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import dedup
+import logger
+from copy_files import CopyMedia
+
+logger.config()
+
+TEST_CONFIG = os.path.join(pathlib.Path(__file__).parent.resolve(), 'test_resources', 'test_CopyMedia.json')
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = self._tmpdir.name
+        self.scan_dir = os.path.join(self.tmpdir, 'scan')
+        self.library = os.path.join(self.tmpdir, 'library')
+        os.makedirs(self.scan_dir)
+        os.makedirs(self.library)
+        self.index_file = os.path.join(self.tmpdir, dedup.INDEX_FILE)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def make_file(self, full_path, data):
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(data)
+        return full_path
+
+    def copy_media(self, mode):
+        c = CopyMedia(config_file=TEST_CONFIG, scandir=self.scan_dir, seriesdir=self.library, moviedir=self.library)
+        c.journal_file = None
+        c.dedup_index_file = self.index_file
+        c.dedup_mode = mode
+        return c
+
+    def test_partial_hash(self):
+        small = self.make_file(os.path.join(self.tmpdir, 'small'), b'abc')
+        # Only the ends of big files are read, so a change in the middle goes unnoticed...
+        data = bytearray(os.urandom(3 * dedup.HASH_SPAN))
+        big = self.make_file(os.path.join(self.tmpdir, 'big'), bytes(data))
+        data[dedup.HASH_SPAN + 10] ^= 0xff
+        middle = self.make_file(os.path.join(self.tmpdir, 'middle'), bytes(data))
+        # ...but one in the last MiB or in the size doesn't.
+        data[-1] ^= 0xff
+        end = self.make_file(os.path.join(self.tmpdir, 'end'), bytes(data))
+
+        self.assertEqual(3, dedup.partial_hash(small)[0])
+        self.assertEqual(dedup.partial_hash(big), dedup.partial_hash(middle))
+        self.assertNotEqual(dedup.partial_hash(big), dedup.partial_hash(end))
+        self.assertNotEqual(dedup.partial_hash(small), dedup.partial_hash(self.make_file(small + '2', b'abcd')))
+
+    def test_index(self):
+        index = dedup.DedupIndex(self.index_file)
+        index.record({'/library/a.mkv': (10, 'aa'), 'nas:/library/b.mkv': (10, 'aa'), '/library/c.mkv': (20, 'cc')})
+        index.forget(['/library/a.mkv'])
+        index.close()
+
+        index = dedup.DedupIndex(self.index_file)
+        self.assertEqual(['nas:/library/b.mkv'], index.lookup((10, 'aa')))
+        self.assertEqual([], index.lookup((20, 'aa')))
+        index.close()
+
+    def test_records_delivered_files(self):
+        episode = self.make_file(os.path.join(self.scan_dir, 'episode.mkv'), b'episode')
+        release = os.path.join(self.scan_dir, 'Movie (2020)')
+        self.make_file(os.path.join(release, 'Movie (2020).mkv'), b'movie')
+        dest_release = os.path.join(self.library, 'Movies', 'Movie (2020)')
+
+        c = self.copy_media(dedup.MODE_OFF)
+        results = c._transfer([[(episode, os.path.join(self.library, 'Show', 'episode.mkv'))],
+                               [(release, dest_release)]])
+        self.assertEqual({episode: True, release: True}, results)
+        for delivered in (os.path.join(self.library, 'Show', 'episode.mkv'),
+                          os.path.join(dest_release, 'Movie (2020).mkv')):
+            self.assertEqual([delivered], c.dedup_index.lookup(dedup.partial_hash(delivered)))
+
+        # With dedup off the same content is transferred again.
+        again = self.make_file(os.path.join(self.scan_dir, 'again.mkv'), b'episode')
+        self.assertEqual({again: True}, c._transfer([[(again, os.path.join(self.library, 'Show', 'again.mkv'))]]))
+        self.assertTrue(os.path.exists(os.path.join(self.library, 'Show', 'again.mkv')))
+        c.finish()
+
+    def test_skip(self):
+        delivered = self.make_file(os.path.join(self.library, 'Show', 'S01E01.mkv'), b'episode')
+        c = self.copy_media(dedup.MODE_SKIP)
+        c._get_dedup_index().record({delivered: dedup.partial_hash(delivered)})
+
+        download = self.make_file(os.path.join(self.scan_dir, 'Show.S01E01.REPACK.mkv'), b'episode')
+        other = self.make_file(os.path.join(self.scan_dir, 'Show.S01E02.mkv'), b'other episode')
+        dest = os.path.join(self.library, 'Show')
+        results = c._transfer([[(download, os.path.join(dest, 'Show.S01E01.REPACK.mkv')),
+                                (other, os.path.join(dest, 'Show.S01E02.mkv'))]])
+
+        self.assertEqual({download: True, other: True}, results)
+        self.assertFalse(os.path.exists(download))
+        self.assertEqual(['S01E01.mkv', 'Show.S01E02.mkv'], sorted(os.listdir(dest)))
+        self.assertEqual((1, 7), (c.dedup_index.skipped, c.dedup_index.bytes_saved))
+        c.finish()
+
+    def test_replace(self):
+        delivered = self.make_file(os.path.join(self.library, 'Old Name', 'S01E01.mkv'), b'episode')
+        c = self.copy_media(dedup.MODE_REPLACE)
+        c._get_dedup_index().record({delivered: dedup.partial_hash(delivered)})
+
+        download = self.make_file(os.path.join(self.scan_dir, 'S01E01.mkv'), b'episode')
+        new_path = os.path.join(self.library, 'New Name', 'S01E01.mkv')
+        self.assertEqual({download: True}, c._transfer([[(download, new_path)]]))
+
+        self.assertFalse(os.path.exists(download))
+        self.assertFalse(os.path.exists(delivered))
+        self.assertTrue(os.path.exists(new_path))
+        self.assertEqual([new_path], c.dedup_index.lookup(dedup.partial_hash(new_path)))
+        c.finish()
+
+    def test_stale_entry_is_transferred(self):
+        gone = os.path.join(self.library, 'Show', 'S01E01.mkv')
+        c = self.copy_media(dedup.MODE_SKIP)
+        c._get_dedup_index().record({gone: (7, dedup.partial_hash(
+            self.make_file(os.path.join(self.tmpdir, 'tmp.mkv'), b'episode'))[1])})
+
+        download = self.make_file(os.path.join(self.scan_dir, 'S01E01.mkv'), b'episode')
+        self.assertEqual({download: True}, c._transfer([[(download, gone)]]))
+        self.assertTrue(os.path.exists(gone))
+        c.finish()
+
+    def test_rebuild(self):
+        episode = self.make_file(os.path.join(self.library, 'Show', 'S01E01.mkv'), b'episode')
+        self.make_file(os.path.join(self.library, 'Show', 'S01E02.mkv.part'), b'partial')
+        self.make_file(os.path.join(self.library, '.hidden', 'file'), b'hidden')
+
+        c = self.copy_media(dedup.MODE_SKIP)
+        c._get_dedup_index().record({'/elsewhere/old.mkv': (1, 'x')})
+        self.assertEqual(1, c.rebuild_dedup_index())
+        self.assertEqual([episode], c.dedup_index.lookup(dedup.partial_hash(episode)))
+        self.assertEqual([], c.dedup_index.lookup((1, 'x')))
+        c.finish()
+
+    def test_seeding_sources_are_delivered_once(self):
+        c = self.copy_media(dedup.MODE_OFF)
+        c.delivery_modes = {'series': 'hardlink', 'movies': 'hardlink'}
+        name = '[SubsPlease] World Trigger - 01 (1080p).mkv'
+        src = self.make_file(os.path.join(self.scan_dir, name), b'episode')
+
+        c.execute()
+
+        delivered = os.path.join(self.library, 'World Trigger', name)
+        self.assertTrue(os.path.samefile(src, delivered))
+        # Still seeding: the next scan leaves it alone, even once the library copy is gone...
+        os.remove(delivered)
+        c = self.copy_media(dedup.MODE_OFF)
+        c.delivery_modes = {'series': 'hardlink', 'movies': 'hardlink'}
+        c.execute()
+        self.assertFalse(os.path.exists(delivered))
+        # ...until the download changes.
+        self.make_file(src, b'episode v2')
+        c.execute()
+        self.assertTrue(os.path.samefile(src, delivered))
+
+    def test_verified_hashes_are_stored(self):
+        c = self.copy_media(dedup.MODE_OFF)
+        c.verify_transfers = True
+        name = '[SubsPlease] World Trigger - 01 (1080p).mkv'
+        self.make_file(os.path.join(self.scan_dir, name), b'episode')
+
+        # Renames move no data; only copies across file systems are verified.
+        with patch('transfer._device', side_effect=lambda p: hash(p.startswith(self.library))):
+            c.execute()
+
+        index = dedup.DedupIndex(self.index_file)
+        delivered = os.path.join(self.library, 'World Trigger', name)
+        self.assertEqual((7, hashlib.sha256(b'episode').hexdigest()), index.verified_hash(delivered))
+        self.assertIsNone(index.verified_hash(os.path.join(self.scan_dir, name)))
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
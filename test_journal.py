@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+import json
+import os
+import pathlib
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import journal
+import logger
+from copy_files import CopyMedia
+
+logger.config()
+
+TEST_CONFIG = os.path.join(pathlib.Path(__file__).parent.resolve(), 'test_resources', 'test_CopyMedia.json')
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = self._tmpdir.name
+        self.journal_file = os.path.join(self.tmpdir, journal.JOURNAL_FILE)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def make_file(self, name, data=b'data'):
+        full_path = os.path.join(self.tmpdir, name)
+        with open(full_path, 'wb') as f:
+            f.write(data)
+        return full_path
+
+    def test_state_transitions(self):
+        one, two, three = (self.make_file(n) for n in ('one.mkv', 'two.mkv', 'three.mkv'))
+
+        j = journal.TransferJournal(self.journal_file)
+        j.plan([(one, '/dest/one.mkv'), (two, '/dest/two.mkv'), (three, '/dest/three.mkv')])
+        j.mark(one, journal.STARTED)
+        j.mark(one, journal.DONE)
+        j.mark(two, journal.STARTED)
+        # Simulate a crash: no close, plus a torn last line.
+        with open(self.journal_file, 'a') as f:
+            f.write('{"src": "/tmp/x", "sta')
+
+        j = journal.TransferJournal(self.journal_file)
+        unfinished = j.unfinished()
+        self.assertEqual([(two, journal.STARTED), (three, journal.PLANNED)],
+                         [(r['src'], r['state']) for r in unfinished])
+        self.assertEqual(journal.checksum(two), unfinished[0]['checksum'])
+
+        # Opening compacts the file down to the unfinished moves.
+        with open(self.journal_file) as f:
+            self.assertEqual(2, len(f.readlines()))
+
+    def test_checksum(self):
+        movie = self.make_file('movie.mkv', b'x' * 100)
+        before = journal.checksum(movie)
+        self.assertEqual(before, journal.checksum(movie))
+        with open(movie, 'r+b') as f:
+            f.write(b'y')
+        os.utime(movie, ns=(0, os.stat(movie).st_mtime_ns))
+        self.assertNotEqual(before, journal.checksum(movie))
+
+    def test_resume_transfers(self):
+        dest_dir = os.path.join(self.tmpdir, 'series', 'Show')
+        done = self.make_file('done.mkv')
+        pending = self.make_file('pending.mkv')
+        changed = self.make_file('changed.mkv')
+
+        j = journal.TransferJournal(self.journal_file)
+        j.plan([(f, os.path.join(dest_dir, os.path.basename(f))) for f in (done, pending, changed)])
+        j.mark(done, journal.DONE)
+        j.close()
+        with open(changed, 'ab') as f:
+            f.write(b' and more')
+
+        c = CopyMedia(config_file=TEST_CONFIG, scandir=self.tmpdir, seriesdir=self.tmpdir, moviedir=self.tmpdir)
+        c.journal_file = self.journal_file
+        c.dedup_index_file = None
+        results = c.resume_transfers()
+        c.finish()
+
+        self.assertEqual({pending: True}, results)
+        self.assertEqual(['pending.mkv'], os.listdir(dest_dir))
+        self.assertTrue(os.path.exists(changed))
+        with open(self.journal_file) as f:
+            self.assertEqual([], [json.loads(line) for line in f])
+
+    def test_resume_stream(self):
+        movie = self.make_file('Movie.2020.mkv')
+        dest = os.path.join(self.tmpdir, 'movies', 'Movie.2020', 'Movie.2020.mkv')
+
+        j = journal.TransferJournal(self.journal_file)
+        j.plan([(movie, dest)], streams={movie})
+        j.mark(movie, journal.STARTED)
+        j.close()
+
+        c = CopyMedia(config_file=TEST_CONFIG, scandir=self.tmpdir, seriesdir=self.tmpdir, moviedir=self.tmpdir)
+        c.journal_file = self.journal_file
+        c.dedup_index_file = None
+
+        def fake_ffmpeg(cmd, **kwargs):
+            with open(cmd[-1], 'wb') as f:
+                f.write(b'stripped')
+            return MagicMock(returncode=0)
+
+        # The interrupted stream is run again, so the library still gets the stripped movie.
+        with patch('subprocess.run', side_effect=fake_ffmpeg) as mock_run, \
+                patch('metadata.needs_strip', return_value=True):
+            self.assertEqual({movie: True}, c.resume_transfers())
+            self.assertEqual(1, mock_run.call_count)
+        c.finish()
+
+        with open(dest, 'rb') as f:
+            self.assertEqual(b'stripped', f.read())
+        self.assertFalse(os.path.exists(movie))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+import unittest
+
+import logger
+import re
+
+from matcher import AhoCorasick, Renamer, SeriesMatcher, expand_template, parse_template, required_literal
+
+logger.config()
+
+
+class TestMatcher(unittest.TestCase):
+
+    def test_required_literal(self):
+        self.assertEqual('World Trigger - ', required_literal('(.*)(World Trigger)( - )(\\d{1,})(.*)'))
+        self.assertEqual(' 2nd Season - ',
+                         required_literal('(.*)(Jujutsu)(.*)( 2nd Season)( - )(\\d{1,})(.*)'))
+        # Nothing is guaranteed when the literal is optional, alternated or case-insensitive.
+        self.assertIsNone(required_literal('(.*)(Gate|GATE)?(.*)'))
+        self.assertIsNone(required_literal('(?i)(.*)(World Trigger)(.*)'))
+
+    def test_parse_template(self):
+        pattern = re.compile('(.*)(Jujutsu)( - )(?P<ep>\\d{1,})(x)?(.*)')
+        m = pattern.match('[Sub] Jujutsu - 05 [1080p].mkv')
+        for template in ['\\1Jujutsu Kaisen\\3S02E\\4\\6', '\\g<ep>\\5\\n\\-', 'no groups']:
+            self.assertEqual(m.expand(template), expand_template(parse_template(template, pattern), m))
+        with self.assertRaises(ValueError):
+            parse_template('\\7', pattern)
+        with self.assertRaises(ValueError):
+            parse_template('\\q', pattern)
+
+    def test_aho_corasick(self):
+        index = AhoCorasick(['he', 'she', 'his', 'hers'])
+        self.assertEqual({0, 1, 3}, index.search('ushers'))
+        self.assertEqual(set(), index.search('nothing to see'))
+
+    def test_first_match_wins(self):
+        series = [{'name': 'Test Series', 'regex': '(.*)(Test Series)(.*)'},
+                  {'name': 'Test Series S2', 'regex': '(.*)(Test Series S2)( - )(\\d{1,})(.*)'},
+                  {'name': 'Anything', 'regex': '.*\\.mkv'}]
+        matcher = SeriesMatcher(series)
+
+        show, m, _ = matcher.match('[Sub] Test Series S2 - 03.mkv')
+        self.assertEqual('Test Series', show['name'])
+        self.assertEqual('[Sub] ', m.group(1))
+
+        show, m, _ = matcher.match('Other Show - 01.mkv')
+        self.assertEqual('Anything', show['name'])
+
+        self.assertIsNone(matcher.match('Other Show - 01.mp4'))
+
+    def test_renumber(self):
+        pattern = re.compile('(.*)(Show)(.*)')
+        renamer = Renamer({'name': 'Show', 'regex': pattern.pattern, 'episode_num_sub': 12, 'season': 2}, pattern)
+        self.assertEqual('Show S02E01 [1080p].mkv', renamer.renumber('Show S01E13 [1080p].mkv'))
+        self.assertEqual('Show - 13.mkv', renamer.renumber('Show - 13.mkv'))
+        self.assertEqual('Show S01E13.mkv', Renamer({'name': 'Show'}, pattern).renumber('Show S01E13.mkv'))
+
+
+if __name__ == '__main__':
+    unittest.main()
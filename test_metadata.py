@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+import os
+import struct
+import tempfile
+import unittest
+
+import logger
+import metadata
+
+logger.config()
+
+
+def box(box_type, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def element(element_id, payload=b''):
+    # 8 byte size field, as written by most muxers for master elements
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + \
+        (len(payload) | (1 << 56)).to_bytes(8, 'big') + payload
+
+
+def itunes_tag(atom, value):
+    return box(atom, box(b'data', bytes(8) + value))
+
+
+def build_mp4(title=b'Some.Release.Title', extra=b''):
+    udta = box(b'udta', box(b'\xa9nam', b'\0\x12\x55\xc4' + title)) if title else b''
+    return (box(b'ftyp', b'isom\0\0\x02\0isomiso2')
+            + box(b'moov', box(b'mvhd', bytes(100)) + box(b'trak', box(b'tkhd', bytes(84))) + udta + extra)
+            + box(b'mdat', b'\x42' * 4096))
+
+
+def build_mkv(title=b'Some.Release.Title', tags=True, extra=b''):
+    info = element(metadata.MKV_TITLE, title) if title else b''
+    info += element(0x4D80, b'Lavf')
+    segment = element(metadata.MKV_INFO, info)
+    if tags:
+        simple_tag = element(metadata.MKV_TAG_NAME, b'ENCODER') + element(metadata.MKV_TAG_STRING, b'rarbg')
+        segment += element(metadata.MKV_TAGS, element(metadata.MKV_TAG, element(metadata.MKV_SIMPLE_TAG, simple_tag)))
+    segment += extra + element(metadata.MKV_CLUSTER, b'\x42' * 4096)
+    return element(metadata.EBML_HEADER, element(0x4282, b'matroska')) + element(metadata.MKV_SEGMENT, segment)
+
+
+class TestMetadata(unittest.TestCase):
+
+    def _write(self, tmpdir, name, data):
+        movie = os.path.join(tmpdir, name)
+        with open(movie, 'wb') as f:
+            f.write(data)
+        return movie
+
+    def test_find_metadata(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mp4 = self._write(tmpdir, 'movie.mp4', build_mp4())
+            self.assertEqual([b'udta'], [r.kind for r in metadata.find_metadata(mp4)])
+            self.assertEqual([], metadata.find_metadata(self._write(tmpdir, 'clean.mp4', build_mp4(title=None))))
+
+            mkv = self._write(tmpdir, 'movie.mkv', build_mkv())
+            self.assertEqual(['Title', 'Tags'], [r.kind for r in metadata.find_metadata(mkv)])
+            self.assertEqual([], metadata.find_metadata(
+                self._write(tmpdir, 'clean.mkv', build_mkv(title=None, tags=False))))
+
+            self.assertIsNone(metadata.find_metadata(self._write(tmpdir, 'movie.avi', b'RIFF' + bytes(100))))
+
+    def test_strip_in_place(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, data in (('movie.mp4', build_mp4()), ('movie.mkv', build_mkv())):
+                movie = self._write(tmpdir, name, data)
+
+                self.assertTrue(metadata.strip_in_place(movie))
+
+                with open(movie, 'rb') as f:
+                    stripped = f.read()
+                self.assertEqual(len(data), len(stripped))
+                self.assertNotIn(b'Some.Release.Title', stripped)
+                self.assertNotIn(b'rarbg', stripped)
+                # The media payload doesn't move.
+                self.assertTrue(stripped.endswith(b'\x42' * 4096))
+                self.assertEqual([], metadata.find_metadata(movie))
+
+            self.assertFalse(metadata.strip_in_place(self._write(tmpdir, 'movie.avi', b'RIFF' + bytes(100))))
+
+    def test_needs_strip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertTrue(metadata.needs_strip(self._write(tmpdir, 'movie.mp4', build_mp4())))
+            self.assertTrue(metadata.needs_strip(self._write(tmpdir, 'movie.mkv', build_mkv())))
+            self.assertEqual({'title': 'Some.Release.Title', 'encoder': 'rarbg'},
+                             metadata.read_tags(os.path.join(tmpdir, 'movie.mkv')))
+
+            self.assertFalse(metadata.needs_strip(self._write(tmpdir, 'clean.mp4', build_mp4(title=None))))
+            self.assertFalse(metadata.needs_strip(self._write(tmpdir, 'ffmpeg.mkv', build_mkv(title=None, tags=False))))
+
+            self.assertEqual({'title': 'Some.Release.Title'}, metadata.read_tags(os.path.join(tmpdir, 'movie.mp4')))
+
+            # Nothing but ffmpeg's own encoder stamp, as left behind by an earlier strip.
+            lavf = box(b'udta', box(b'meta', bytes(4) + box(b'hdlr', bytes(25))
+                                    + box(b'ilst', itunes_tag(b'\xa9too', b'Lavf61.1.100'))))
+            movie = self._write(tmpdir, 'stripped.mp4', build_mp4(title=None, extra=lavf))
+            self.assertEqual({'encoder': 'Lavf61.1.100'}, metadata.read_tags(movie))
+            self.assertFalse(metadata.needs_strip(movie))
+
+            commented = box(b'udta', box(b'meta', bytes(4) + box(b'ilst', itunes_tag(b'\xa9cmt', b'rarbg'))))
+            self.assertTrue(metadata.needs_strip(self._write(tmpdir, 'c.mp4', build_mp4(title=None, extra=commented))))
+
+            # Too big to read (e.g. cover art next to the title), so assumed to need stripping.
+            covered = build_mp4(title=None, extra=box(b'udta', box(b'\xa9nam', b'\0\x12\x55\xc4Title')
+                                                        + box(b'covr', bytes(metadata.MAX_ELEMENT_READ))))
+            movie = self._write(tmpdir, 'covr.mp4', covered)
+            self.assertEqual([metadata.OVERSIZED], list(metadata.read_tags(movie)))
+            self.assertTrue(metadata.needs_strip(movie))
+            tags = element(metadata.MKV_TAGS, bytes(metadata.MAX_ELEMENT_READ + 1))
+            movie = self._write(tmpdir, 'tags.mkv', build_mkv(title=None, tags=False, extra=tags))
+            self.assertEqual([metadata.OVERSIZED], list(metadata.read_tags(movie)))
+            self.assertTrue(metadata.needs_strip(movie))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+import time
+import unittest
+from unittest.mock import patch
+
+import logger
+import notify
+
+logger.config()
+
+
+class RecordingChannel(str):
+    """A channel that remembers what it delivered, optionally taking its time about it."""
+
+    def __new__(cls, name, delay=0):
+        channel = super().__new__(cls, name)
+        channel.delay = delay
+        channel.delivered = []
+        return channel
+
+    def deliver(self, items, timeout):
+        time.sleep(self.delay)
+        self.delivered.append(list(items))
+
+
+class TestNotify(unittest.TestCase):
+
+    def test_digest(self):
+        errors, other = RecordingChannel('errors'), RecordingChannel('other')
+        dispatcher = notify.Dispatcher(window=0.2)
+        for i in range(10):
+            dispatcher.post(errors, 'rsync failed %d' % i)
+        dispatcher.post(other, 'hello')
+        self.assertEqual([], errors.delivered)
+
+        time.sleep(0.5)
+        self.assertEqual([['rsync failed %d' % i for i in range(10)]], errors.delivered)
+        self.assertEqual([['hello']], other.delivered)
+        self.assertTrue(dispatcher.flush())
+        self.assertEqual((2, 9), (dispatcher.sent, dispatcher.coalesced))
+
+    def test_flush(self):
+        channel = RecordingChannel('errors')
+        dispatcher = notify.Dispatcher(window=60)
+        dispatcher.post(channel, 'one')
+        dispatcher.post(channel, 'two')
+        self.assertTrue(dispatcher.flush())
+        self.assertEqual([['one', 'two']], channel.delivered)
+
+        # Usable again after a flush.
+        dispatcher.post(channel, 'three')
+        self.assertTrue(dispatcher.flush())
+        self.assertEqual([['one', 'two'], ['three']], channel.delivered)
+
+    def test_slow_server(self):
+        slow = RecordingChannel('slow', delay=1)
+        dispatcher = notify.Dispatcher(window=0)
+        started = time.monotonic()
+        dispatcher.post(slow, 'one')
+        time.sleep(0.05)
+        dispatcher.post(slow, 'two')
+        self.assertLess(time.monotonic() - started, 0.5)
+
+        self.assertFalse(dispatcher.flush(deadline=0.1))
+        self.assertTrue(dispatcher.flush())
+        self.assertEqual([['one'], ['two']], slow.delivered)
+
+    def test_channels(self):
+        with patch('ntfy.send_notification') as send_ntfy, patch('ifttt.send_notification') as send_ifttt:
+            notify.NtfyChannel('https://ntfy.sh/topic', 'token').deliver(['one', 'two'], 5)
+            notify.IftttChannel('https://maker.ifttt.com/trigger/x').deliver(
+                [[('a.mkv', {'name': 'A'})], [('b.mkv', {'name': 'B'})]], 5)
+
+        self.assertEqual(('https://ntfy.sh/topic', 'token', 'CopyMedia: 2 notifications\none\ntwo'),
+                         send_ntfy.call_args[0])
+        self.assertEqual(5, send_ntfy.call_args[1]['timeout'])
+        self.assertEqual([('a.mkv', {'name': 'A'}), ('b.mkv', {'name': 'B'})], send_ifttt.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+import os
+import tempfile
+import unittest
+
+import logger
+import planner
+from copy_files import SKIP_DIRS, CopyMedia
+
+logger.config()
+
+TREE = {
+    'CD1/Brave.2012.1080p.mkv': 300,
+    'Brave.2012.nfo': 10,
+    'Subs/2_English.srt': 1,
+    'Subs/French.srt': 1,
+    'Brave.en.srt': 1,
+    '.hidden/eng.srt': 1,
+    'Sample/sample.mkv': 500,
+    'Sample/frames/0001.jpg': 1,
+}
+
+
+class TestPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.base_dir = os.path.join(self._tmpdir.name, 'Brave.2012.1080p')
+        for name, size in TREE.items():
+            full_path = os.path.join(self.base_dir, name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'wb') as f:
+                f.truncate(size)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def full(self, *names):
+        return [os.path.join(self.base_dir, name) for name in names]
+
+    def test_is_english_subtitle(self):
+        self.assertTrue(planner.is_english_subtitle('movie.en.srt'))
+        self.assertTrue(planner.is_english_subtitle('3_Eng.srt'))
+        self.assertFalse(planner.is_english_subtitle('other_sub_2.srt'))
+        self.assertFalse(planner.is_english_subtitle('english.txt'))
+
+    def test_plan_movie(self):
+        plan = planner.plan_movie(self.base_dir, skip_dirs=SKIP_DIRS)
+
+        self.assertEqual(self.full('CD1/Brave.2012.1080p.mkv')[0], plan.movie)
+        self.assertEqual(tuple(self.full('Brave.en.srt', 'Subs/2_English.srt')), plan.subtitles)
+        self.assertEqual(frozenset(self.full('Brave.2012.nfo', 'Subs/French.srt', '.hidden/eng.srt')),
+                         plan.delete_files)
+        self.assertEqual(set(self.full('CD1', 'Subs', '.hidden')), set(plan.delete_dirs))
+        self.assertEqual(tuple(self.full('Sample')), plan.prune_dirs)
+
+        moved = plan.moved_to('/elsewhere')
+        self.assertEqual('/elsewhere/CD1/Brave.2012.1080p.mkv', moved.movie)
+        self.assertIn('/elsewhere/Sample', moved.prune_dirs)
+
+    def test_simulate_plan(self):
+        plan = planner.plan_movie(self.base_dir, skip_dirs=SKIP_DIRS)
+
+        subtitles = CopyMedia.process_subtitles(self.base_dir, 'Brave.2012', simulate=True, plan=plan)
+        kept = CopyMedia.clean_dir(self.base_dir, plan.movie, subtitles, simulate=True, plan=plan)
+
+        self.assertEqual(set(self.full('Brave.2012.en.srt', 'Brave.2012_1.en.srt')), subtitles)
+        self.assertEqual({plan.movie, *subtitles}, set(kept))
+        # Nothing was touched.
+        for name in TREE:
+            self.assertTrue(os.path.exists(os.path.join(self.base_dir, name)), name)
+
+    def test_apply_plan(self):
+        plan = planner.plan_movie(self.base_dir, skip_dirs=SKIP_DIRS)
+
+        subtitles = CopyMedia.process_subtitles(self.base_dir, 'Brave.2012', plan=plan)
+        CopyMedia.clean_dir(self.base_dir, plan.movie, subtitles, plan=plan)
+
+        self.assertEqual(['Brave.2012.en.srt', 'Brave.2012_1.en.srt', 'CD1'], sorted(os.listdir(self.base_dir)))
+        self.assertEqual(['Brave.2012.1080p.mkv'], os.listdir(os.path.join(self.base_dir, 'CD1')))
+
+
+if __name__ == '__main__':
+    unittest.main()
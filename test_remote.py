@@ -3,11 +3,14 @@ import os
 import unittest
 from unittest.mock import MagicMock, patch
 
+import fakes
+import hashlib
 import logger
 import ntfy
+import remote
 import shutil
 import tempfile
-from remote import is_remote, rsync
+from remote import is_remote, rsync, rsync_batch
 
 logger.config()
 
@@ -27,7 +30,8 @@ class TestNtfy(unittest.TestCase):
             mock_post.assert_called_once_with(
                 'https://ntfy.sh/topic',
                 data='test message',
-                headers={'Authorization': 'Bearer mytoken'}
+                headers={'Authorization': 'Bearer mytoken'},
+                timeout=None
             )
             self.assertEqual(result.status_code, 200)
 
@@ -43,6 +47,11 @@ class TestNtfy(unittest.TestCase):
 
 class TestRemote(unittest.TestCase):
 
+    def tearDown(self):
+        # Forget any (mocked) control masters so every test starts from a clean slate.
+        with patch('subprocess.run'):
+            remote.close_masters()
+
     def test_is_remote_true(self):
         self.assertTrue(is_remote('david@nas:/volume1/plex'))
         self.assertTrue(is_remote('user@192.168.1.1:/path/to/dir'))
@@ -91,8 +100,8 @@ class TestRemote(unittest.TestCase):
             self.assertTrue(result)
             self.assertFalse(os.path.exists(src))
             # Trailing slash must be added to both src and dest for directory rsync
-            self.assertTrue(cmd[3].endswith('/'))
-            self.assertTrue(cmd[4].endswith('/'))
+            self.assertTrue(cmd[-2].endswith('/'))
+            self.assertTrue(cmd[-1].endswith('/'))
 
     def test_rsync_failure_dir(self):
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -106,6 +115,225 @@ class TestRemote(unittest.TestCase):
             self.assertFalse(result)
             self.assertTrue(os.path.exists(src))
 
+    def test_rsync_batch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            good = os.path.join(tmpdir, 'good.mkv')
+            bad = os.path.join(tmpdir, 'bad.mkv')
+            movie = os.path.join(tmpdir, 'Brave.2012')
+            os.makedirs(movie)
+            for f in (good, bad, os.path.join(movie, 'Brave.2012.mkv')):
+                open(f, 'w').close()
+
+            def fake_rsync(cmd, **kwargs):
+                if cmd[0] == 'rsync':
+                    # Pretend everything except bad.mkv made it across.
+                    for root, _, files in os.walk(cmd[-2]):
+                        for name in files:
+                            if name != 'bad.mkv':
+                                os.remove(os.path.join(root, name))
+                    return MagicMock(returncode=23, stderr=b'some files could not be transferred')
+                return MagicMock(returncode=0)
+
+            moves = [(good, 'user@nas:/series/Show A/Show A - 01.mkv'),
+                     (bad, 'user@nas:/series/Show B/bad.mkv'),
+                     (movie, 'user@nas:/movies/Brave.2012')]
+
+            with patch('subprocess.run', side_effect=fake_rsync) as mock_run:
+                results = rsync_batch(moves)
+                cmds = [c[0][0] for c in mock_run.call_args_list]
+
+            self.assertEqual({good: True, bad: False, movie: True}, results)
+            # One control master, one ssh mkdir and one rsync for the whole batch, rooted at the common parent.
+            self.assertEqual(['ssh', 'ssh', 'rsync'], [c[0] for c in cmds])
+            self.assertEqual('user@nas:/', cmds[-1][-1])
+            self.assertFalse(os.path.exists(good))
+            self.assertTrue(os.path.exists(bad))
+            self.assertFalse(os.path.exists(movie))
+            # The staging tree is always cleaned up.
+            self.assertEqual(['bad.mkv'], os.listdir(tmpdir))
+
+    def test_rsync_batch_keeps_directory_attributes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            moves = []
+            for name in ('one.mkv', 'two.mkv'):
+                src = os.path.join(tmpdir, name)
+                open(src, 'w').close()
+                moves.append((src, 'user@nas:/series/Show %s/%s' % (name[0], name)))
+
+            with patch('subprocess.run') as mock_run, patch.object(remote, 'MULTIPLEX', False):
+                mock_run.return_value = MagicMock(returncode=0)
+                rsync_batch(moves)
+                cmd = mock_run.call_args[0][0]
+
+            # The stage is a private 0700 directory; -a must not carry its modes or owners to the NAS.
+            self.assertEqual('rsync', cmd[0])
+            self.assertIn('-a', cmd)
+            for option in ('--no-perms', '--no-owner', '--no-group'):
+                self.assertIn(option, cmd)
+            self.assertLess(cmd.index('-a'), cmd.index('--no-perms'))
+
+    def test_ssh_multiplexing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sources = [os.path.join(tmpdir, name) for name in ('one.mkv', 'two.mkv')]
+            for src in sources:
+                open(src, 'w').close()
+
+            with patch('subprocess.run') as mock_run:
+                mock_run.return_value = MagicMock(returncode=0)
+                for src in sources:
+                    self.assertTrue(rsync(src, 'user@nas:/series/Show/' + os.path.basename(src)))
+                remote.close_masters()
+                cmds = [c[0][0] for c in mock_run.call_args_list]
+
+            masters = [c for c in cmds if 'ControlMaster=yes' in c]
+            self.assertEqual(1, len(masters))
+            control_path = masters[0][masters[0].index('-o', 4) + 1]
+            self.assertTrue(control_path.startswith('ControlPath='))
+
+            # Every ssh mkdir and rsync afterwards goes through the master...
+            for cmd in cmds[1:-1]:
+                self.assertTrue(control_path in cmd or 'ssh -o ' + control_path in cmd, cmd)
+            # ...which is shut down at the end.
+            self.assertEqual(['-O', 'exit'], cmds[-1][3:5])
+
+    def test_ssh_multiplexing_unavailable(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'one.mkv')
+            open(src, 'w').close()
+
+            with patch('subprocess.run') as mock_run:
+                mock_run.side_effect = lambda cmd, **kwargs: MagicMock(
+                    returncode=255 if 'ControlMaster=yes' in cmd else 0)
+                self.assertTrue(rsync(src, 'user@nas:/series/Show/one.mkv'))
+                cmd = mock_run.call_args[0][0]
+
+            # Falls back to a direct connection.
+            self.assertEqual(['rsync', '-a', '--partial', src, 'user@nas:/series/Show/one.mkv'], cmd)
+
+    def test_rsync_resume(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'one.mkv')
+            open(src, 'w').close()
+
+            with patch('subprocess.run') as mock_run, patch.object(remote, 'MULTIPLEX', False):
+                mock_run.return_value = MagicMock(returncode=0)
+                self.assertTrue(rsync(src, 'user@nas:/series/Show/one.mkv', resume=True))
+                cmd = mock_run.call_args[0][0]
+
+            self.assertIn('--partial', cmd)
+            self.assertIn('--append-verify', cmd)
+
+    def test_rsync_drop_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'one.mkv')
+            open(src, 'w').close()
+
+            with patch('subprocess.run') as mock_run, patch.object(remote, 'MULTIPLEX', False), \
+                    patch('shutil.which', return_value='/usr/bin/nocache'):
+                mock_run.return_value = MagicMock(returncode=0)
+                self.assertTrue(rsync(src, 'user@nas:/series/Show/one.mkv', keep_source=True, drop_cache=True))
+                self.assertEqual(['nocache', 'rsync'], mock_run.call_args[0][0][:2])
+            self.assertTrue(os.path.exists(src))
+
+            # Without nocache the kept source's pages are dropped once it has been sent.
+            with patch('subprocess.run') as mock_run, patch.object(remote, 'MULTIPLEX', False), \
+                    patch('shutil.which', return_value=None), patch('transfer.drop_cache') as drop_cache:
+                mock_run.return_value = MagicMock(returncode=0)
+                self.assertTrue(rsync(src, 'user@nas:/series/Show/one.mkv', keep_source=True, drop_cache=True))
+                self.assertEqual('rsync', mock_run.call_args[0][0][0])
+
+            drop_cache.assert_called_once_with(src)
+
+    def test_stream_shell_characters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            name = 'Movie "$HOME" $(echo x) `echo y`.mkv'
+            nas = fakes.FakeNAS(os.path.join(tmpdir, 'nas'))
+
+            with nas, patch.object(remote, 'MULTIPLEX', False):
+                self.assertTrue(remote.stream(['printf', 'movie'], nas.remote('Movies/$(echo z)/' + name)))
+
+            # Every path reaches the NAS shell literally.
+            delivered = os.path.join(nas.root, 'Movies', '$(echo z)')
+            self.assertEqual([name], os.listdir(delivered))
+            with open(os.path.join(delivered, name), 'rb') as f:
+                self.assertEqual(b'movie', f.read())
+
+    def test_rename_shell_characters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            name = 'Show "$HOME" - $(echo 01) `echo y`.mkv'
+            nas = fakes.FakeNAS(os.path.join(tmpdir, 'nas'))
+            os.makedirs(os.path.join(nas.root, 'Old'))
+            open(os.path.join(nas.root, 'Old', name), 'w').close()
+
+            with nas, patch.object(remote, 'MULTIPLEX', False):
+                self.assertTrue(remote.rename(nas.remote('Old/' + name), nas.remote('$(echo z)/' + name)))
+
+            self.assertEqual([], os.listdir(os.path.join(nas.root, 'Old')))
+            self.assertEqual([name], os.listdir(os.path.join(nas.root, '$(echo z)')))
+
+    def test_send_verified(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'Movie.2020')
+            os.makedirs(os.path.join(src, 'Subs'))
+            data = os.urandom(remote.VERIFY_CHUNK + 100)
+            with open(os.path.join(src, 'Movie.2020.mkv'), 'wb') as f:
+                f.write(data)
+            open(os.path.join(src, 'Subs', 'Movie.2020.en.srt'), 'w').close()
+            nas = fakes.FakeNAS(os.path.join(tmpdir, 'nas'))
+
+            with nas, patch.object(remote, 'MULTIPLEX', False):
+                hashes = remote.send_verified(src, nas.remote('Movies/Movie.2020'), keep_source=True)
+
+            delivered = os.path.join(nas.root, 'Movies', 'Movie.2020')
+            self.assertEqual((len(data), hashlib.sha256(data).hexdigest()),
+                             hashes[nas.remote('Movies/Movie.2020/Movie.2020.mkv')])
+            self.assertEqual((0, hashlib.sha256(b'').hexdigest()),
+                             hashes[nas.remote('Movies/Movie.2020/Subs/Movie.2020.en.srt')])
+            with open(os.path.join(delivered, 'Movie.2020.mkv'), 'rb') as f:
+                self.assertEqual(data, f.read())
+            self.assertTrue(os.path.exists(src))
+
+    def test_send_verified_shell_characters(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            name = 'Movie "$HOME" $(echo x) `echo y`.mkv'
+            src = os.path.join(tmpdir, name)
+            with open(src, 'wb') as f:
+                f.write(b'movie')
+            nas = fakes.FakeNAS(os.path.join(tmpdir, 'nas'))
+
+            with nas, patch.object(remote, 'MULTIPLEX', False):
+                self.assertIsNotNone(remote.send_verified(src, nas.remote('Movies/$(echo z)/' + name)))
+
+            # Every path reaches the NAS shell literally.
+            self.assertEqual([name], os.listdir(os.path.join(nas.root, 'Movies', '$(echo z)')))
+            self.assertFalse(os.path.exists(src))
+
+    def test_stream_verified(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            nas = fakes.FakeNAS(os.path.join(tmpdir, 'nas'))
+            with nas, patch.object(remote, 'MULTIPLEX', False):
+                self.assertEqual((5, hashlib.sha256(b'movie').hexdigest()),
+                                 remote.stream_verified(['printf', 'movie'], nas.remote('Movies/one.mkv')))
+                # Whatever a failed command wrote is not kept, even though it arrived intact.
+                self.assertIsNone(remote.stream_verified(['sh', '-c', 'printf cut; exit 1'],
+                                                         nas.remote('Movies/two.mkv')))
+
+            self.assertEqual(['one.mkv'], os.listdir(os.path.join(nas.root, 'Movies')))
+
+    def test_send_verified_mismatch(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'one.mkv')
+            with open(src, 'wb') as f:
+                f.write(b'episode')
+            nas = fakes.FakeNAS(os.path.join(tmpdir, 'nas'))
+            # A NAS that stores something other than what was sent
+            with nas, patch.object(remote, 'MULTIPLEX', False), \
+                    patch('hashlib.sha256', return_value=MagicMock(hexdigest=lambda: '0' * 64)):
+                self.assertIsNone(remote.send_verified(src, nas.remote('Show/one.mkv')))
+
+            self.assertTrue(os.path.exists(src))
+            self.assertEqual([], os.listdir(os.path.join(nas.root, 'Show')))
+
 
 if __name__ == '__main__':
     unittest.main()
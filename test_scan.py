@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import logger
+import scan
+
+logger.config()
+
+
+class TestScan(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'Movie (2020)'))
+        os.mkdir(os.path.join(self.root, 'tmp'))
+        with open(os.path.join(self.root, 'episode.mkv'), 'wb') as f:
+            f.write(b'x' * 10)
+        os.symlink('missing', os.path.join(self.root, 'broken'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_scan_dir(self):
+        result = scan.scan_dir(self.root)
+        self.assertEqual(['episode.mkv'], result.file_names())
+        self.assertEqual(['Movie (2020)', 'tmp'], sorted(result.dir_names()))
+        self.assertTrue(all(e.is_dir for e in result.dirs))
+        self.assertNotIn('broken', result.file_names() + result.dir_names())
+
+    def test_stat_once(self):
+        entry, = scan.scan_dir(self.root).files
+        with mock.patch('os.stat', side_effect=AssertionError('stat called')), \
+                mock.patch('os.path.isfile', side_effect=AssertionError('isfile called')):
+            # DirEntry stats through its own syscall and caches the result.
+            self.assertEqual(10, entry.size)
+            self.assertEqual(10, entry.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
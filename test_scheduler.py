@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+import threading
+import time
+import unittest
+
+import logger
+import scheduler
+from scheduler import TransferScheduler
+
+logger.config()
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_parse_limits(self):
+        self.assertEqual({'local': 1, 'remote': 1}, scheduler.parse_limits(None))
+        self.assertEqual({'local': 3, 'remote': 3}, scheduler.parse_limits(3))
+        self.assertEqual({'local': 1, 'remote': 4}, scheduler.parse_limits({'remote': 4}))
+        with self.assertRaises(ValueError):
+            scheduler.parse_limits({'local': 0})
+
+    def test_limits_and_ordering(self):
+        lock = threading.Lock()
+        running = {'local': 0, 'remote': 0}
+        peak = {'local': 0, 'remote': 0}
+        order = []
+
+        def job(kind, items):
+            with lock:
+                running[kind] += 1
+                peak[kind] = max(peak[kind], running[kind])
+            for item in items:
+                time.sleep(0.01)
+                with lock:
+                    order.append(item)
+            with lock:
+                running[kind] -= 1
+            return {item: True for item in items}
+
+        groups = [['a1', 'a2', 'a3'], ['b1', 'b2'], ['c1'], ['d1', 'd2']]
+        with TransferScheduler({'local': 2, 'remote': 3}) as transfers:
+            for group in groups:
+                transfers.submit(scheduler.LOCAL, job, 'local', group)
+            for chunk in transfers.chunks(scheduler.REMOTE, [['r1'], ['r2'], ['r3', 'r4'], ['r5']]):
+                transfers.submit(scheduler.REMOTE, job, 'remote', chunk)
+            results = transfers.wait()
+
+        self.assertEqual(13, len(results))
+        self.assertEqual(2, peak['local'])
+        self.assertEqual(3, peak['remote'])
+        # Items of one group keep their relative order.
+        for group in groups:
+            self.assertEqual(group, [item for item in order if item in group])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import logger
+import timing
+
+logger.config()
+
+
+class TestTiming(unittest.TestCase):
+
+    def setUp(self):
+        timing.reset()
+        patcher = patch.object(timing, 'enabled', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(timing.reset)
+
+    def test_stage(self):
+        @timing.stage('decorated')
+        def work(x):
+            return x * 2
+
+        with timing.stage('block'):
+            self.assertEqual(4, work(2))
+        with self.assertRaises(ValueError), timing.stage('block'):
+            raise ValueError()
+
+        stats = timing.summary()
+        self.assertEqual(2, stats['block']['count'])
+        self.assertEqual(1, stats['decorated']['count'])
+        self.assertGreaterEqual(stats['block']['max'], stats['decorated']['max'])
+
+    def test_disabled(self):
+        timing.enabled = False
+        with timing.stage('block'):
+            pass
+        timing.record('recorded', 1.0)
+        self.assertEqual({}, timing.summary())
+
+    def test_summary(self):
+        for seconds in range(1, 101):
+            timing.record('rsync', seconds / 100)
+        timing.record('ssh.mkdir', 0.5)
+
+        stats = timing.summary()
+        self.assertEqual(['rsync', 'ssh.mkdir'], list(stats))
+        self.assertEqual({'count': 100, 'p50': 0.5, 'p95': 0.95, 'max': 1.0},
+                         {k: stats['rsync'][k] for k in ('count', 'p50', 'p95', 'max')})
+        self.assertAlmostEqual(50.5, stats['rsync']['total'])
+        self.assertEqual(0.5, stats['ssh.mkdir']['p95'])
+        self.assertIn('rsync', timing.report(stats).splitlines()[1])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_file = os.path.join(tmpdir, 'profile.json')
+            timing.write_json(json_file, stats)
+            with open(json_file) as f:
+                self.assertEqual(stats, json.load(f)['stages'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import logger
+import transfer
+
+logger.config()
+
+
+class TestTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.tmpdir = self._tmpdir.name
+        self.dest_dir = os.path.join(self.tmpdir, 'dest')
+        os.mkdir(self.dest_dir)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def make_file(self, name, data):
+        full_path = os.path.join(self.tmpdir, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(data)
+        return full_path
+
+    def cross_device(self):
+        # Pretend everything under dest is another file system.
+        real_device = transfer._device
+        return patch('transfer._device', side_effect=lambda p: -1 if p.startswith(self.dest_dir)
+                     else real_device(p))
+
+    def test_rename_same_device(self):
+        src = self.make_file('one.mkv', b'one')
+        dest = os.path.join(self.dest_dir, 'one.mkv')
+
+        with patch('transfer.copy_data') as copy_data, transfer.Mover() as mover:
+            mover.move(src, dest)
+
+        copy_data.assert_not_called()
+        self.assertEqual({src: True}, mover.results)
+        self.assertEqual(1, mover.stats[transfer.RENAME])
+        self.assertFalse(os.path.exists(src))
+
+    def test_copy_cross_device(self):
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        src = self.make_file('one.mkv', data)
+        dest = os.path.join(self.dest_dir, 'one.mkv')
+
+        with self.cross_device(), patch.object(transfer, 'FSYNC_BATCH_FILES', 2), transfer.Mover() as mover:
+            mover.move(src, dest)
+            # Not synced yet, so the source is still there and nothing is under the final name.
+            self.assertTrue(os.path.exists(src))
+            self.assertFalse(os.path.exists(dest))
+
+        self.assertEqual({src: True}, mover.results)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(['one.mkv'], os.listdir(self.dest_dir))
+        with open(dest, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_copy_fallbacks(self):
+        data = os.urandom(100000)
+        src = self.make_file('one.mkv', data)
+        dest = os.path.join(self.dest_dir, 'one.mkv')
+        unsupported = OSError(transfer.errno.EXDEV, 'cross-device')
+
+        with patch('os.copy_file_range', side_effect=unsupported), patch('os.sendfile', side_effect=unsupported):
+            with open(src, 'rb') as s, open(dest, 'wb') as d:
+                self.assertEqual(transfer.READ_WRITE, transfer.copy_data(s.fileno(), d.fileno(), len(data)))
+        with open(dest, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_copy_cache_modes(self):
+        data = os.urandom(2 * transfer.WRITE_BEHIND_CHUNK + 12345)
+        src = self.make_file('one.mkv', data)
+        dest = os.path.join(self.dest_dir, 'one.mkv')
+        unsupported = OSError(transfer.errno.EXDEV, 'cross-device')
+
+        for cache in transfer.CACHE_MODES:
+            for fallback in (False, True):
+                with self.subTest(cache=cache, fallback=fallback), \
+                        patch('os.copy_file_range', side_effect=unsupported if fallback else os.copy_file_range), \
+                        patch('transfer._fadvise', wraps=transfer._fadvise) as fadvise:
+                    with open(src, 'rb') as s, open(dest, 'wb') as d:
+                        method = transfer.copy_data(s.fileno(), d.fileno(), len(data), cache)
+                    with open(dest, 'rb') as f:
+                        self.assertEqual(data, f.read())
+                    if cache == transfer.CACHE_NORMAL:
+                        fadvise.assert_not_called()
+                    elif method != transfer.DIRECT_IO:
+                        # Every chunk's pages are dropped behind the copy, on both sides.
+                        dropped = [call.args[1:3] for call in fadvise.call_args_list
+                                   if call.args[3] == os.POSIX_FADV_DONTNEED]
+                        self.assertEqual(len(data), sum(length for _, length in dropped) // 2)
+
+    def test_verify(self):
+        data = os.urandom(100000)
+        src = self.make_file('one.mkv', data)
+        dest = os.path.join(self.dest_dir, 'one.mkv')
+
+        with self.cross_device(), transfer.Mover(verify=True) as mover:
+            mover.move(src, dest)
+
+        self.assertEqual({src: True}, mover.results)
+        self.assertEqual({dest: (len(data), hashlib.sha256(data).hexdigest())}, mover.hashes)
+
+        # A source that changes while it is being copied fails the move and stays.
+        src = self.make_file('two.mkv', data)
+        real_copy_data = transfer.copy_data
+
+        def copy_while_downloading(*args):
+            method = real_copy_data(*args)
+            with open(src, 'ab') as f:
+                f.write(b'more')
+            return method
+
+        with self.cross_device(), patch('transfer.copy_data', side_effect=copy_while_downloading), \
+                transfer.Mover(verify=True) as mover:
+            with self.assertRaises(OSError):
+                mover.move(src, os.path.join(self.dest_dir, 'two.mkv'))
+
+        self.assertEqual({}, mover.hashes)
+        self.assertTrue(os.path.exists(src))
+        self.assertFalse(os.path.exists(os.path.join(self.dest_dir, 'two.mkv.part')))
+
+    def test_copy_tree_cross_device(self):
+        self.make_file('Movie.2020/Movie.2020.mkv', b'movie')
+        self.make_file('Movie.2020/Subs/Movie.2020.en.srt', b'subs')
+        src = os.path.join(self.tmpdir, 'Movie.2020')
+        dest = os.path.join(self.dest_dir, 'Movie.2020')
+
+        with self.cross_device(), transfer.Mover() as mover:
+            mover.move(src, dest)
+
+        self.assertEqual({src: True}, mover.results)
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(['Movie.2020.en.srt'], os.listdir(os.path.join(dest, 'Subs')))
+
+    def test_copy_tree_fails_part_way(self):
+        self.make_file('Movie.2020/Movie.2020.mkv', b'movie')
+        self.make_file('Movie.2020/Subs/Movie.2020.en.srt', b'subs')
+        src = os.path.join(self.tmpdir, 'Movie.2020')
+        dest = os.path.join(self.dest_dir, 'Movie.2020')
+        real_fsync = os.fsync
+        calls = []
+
+        def fsync_full_disk(fd):
+            # The first file of the tree is synced in a batch of its own and doesn't fit.
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError(transfer.errno.ENOSPC, 'No space left on device')
+            real_fsync(fd)
+
+        with self.cross_device(), patch.object(transfer, 'FSYNC_BATCH_FILES', 1), \
+                patch('os.fsync', side_effect=fsync_full_disk), transfer.Mover() as mover:
+            mover.move(src, dest)
+
+        # A later batch of the same tree doesn't make up for the failed one.
+        self.assertEqual({src: False}, mover.results)
+        self.assertTrue(os.path.exists(os.path.join(src, 'Movie.2020.mkv')))
+        self.assertTrue(os.path.exists(os.path.join(src, 'Subs', 'Movie.2020.en.srt')))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'Movie.2020.mkv')))
+
+    def test_parse_modes(self):
+        self.assertEqual({'series': 'move', 'movies': 'move'}, transfer.parse_modes(None))
+        self.assertEqual({'series': 'hardlink', 'movies': 'hardlink'}, transfer.parse_modes('hardlink'))
+        self.assertEqual({'series': 'move', 'movies': 'reflink'}, transfer.parse_modes({'movies': 'reflink'}))
+        for invalid in ('symlink', {'music': 'copy'}, {'series': None}):
+            with self.assertRaises(ValueError):
+                transfer.parse_modes(invalid)
+
+    def test_hardlink_keeps_source(self):
+        src = self.make_file('one.mkv', b'one')
+        dest = os.path.join(self.dest_dir, 'one.mkv')
+
+        with transfer.Mover(transfer.HARDLINK) as mover:
+            mover.move(src, dest)
+
+        self.assertEqual({src: True}, mover.results)
+        self.assertEqual(1, mover.stats[transfer.LINK])
+        self.assertTrue(os.path.samefile(src, dest))
+        self.assertEqual(['one.mkv'], os.listdir(self.dest_dir))
+
+    def test_hardlink_falls_back_to_copy(self):
+        first = self.make_file('one.mkv', b'one')
+        second = self.make_file('two.mkv', b'two')
+        unsupported = OSError(transfer.errno.EXDEV, 'cross-device')
+
+        with patch('os.link', side_effect=unsupported) as link, \
+                patch('transfer.reflink', side_effect=unsupported) as clone, transfer.Mover(transfer.HARDLINK) as mover:
+            mover.move(first, os.path.join(self.dest_dir, 'one.mkv'))
+            mover.move(second, os.path.join(self.dest_dir, 'two.mkv'))
+
+        # What didn't work for the first file isn't tried again for the second.
+        self.assertEqual(1, link.call_count)
+        self.assertEqual(1, clone.call_count)
+        self.assertEqual({first: True, second: True}, mover.results)
+        self.assertEqual(2, mover.stats['copied'])
+        self.assertTrue(os.path.exists(first) and os.path.exists(second))
+        with open(os.path.join(self.dest_dir, 'two.mkv'), 'rb') as f:
+            self.assertEqual(b'two', f.read())
+        self.assertFalse(os.path.samefile(first, os.path.join(self.dest_dir, 'one.mkv')))
+
+    def test_reflink_tree(self):
+        self.make_file('Movie.2020/Movie.2020.mkv', b'movie')
+        self.make_file('Movie.2020/Subs/Movie.2020.en.srt', b'subs')
+        src = os.path.join(self.tmpdir, 'Movie.2020')
+        dest = os.path.join(self.dest_dir, 'Movie.2020')
+
+        with self.cross_device(), patch('transfer.reflink') as clone, transfer.Mover(transfer.REFLINK) as mover:
+            mover.move(src, dest)
+
+        self.assertEqual(2, clone.call_count)
+        self.assertEqual({src: True}, mover.results)
+        self.assertEqual(2, mover.stats[transfer.CLONE])
+        self.assertTrue(os.path.exists(os.path.join(src, 'Subs', 'Movie.2020.en.srt')))
+        self.assertEqual(['Movie.2020.en.srt'], os.listdir(os.path.join(dest, 'Subs')))
+
+
+if __name__ == '__main__':
+    unittest.main()
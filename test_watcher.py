@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import logger
+import watcher
+
+logger.config()
+
+
+class TestWatcher(unittest.TestCase):
+
+    def _watcher(self, scan, spool, **kwargs):
+        copy_media = MagicMock(scandir=scan)
+        seen = []
+        copy_media.process_files.side_effect = lambda files: seen.append((copy_media.scandir, 'files', files))
+        copy_media.process_dirs.side_effect = lambda dirs: seen.append((copy_media.scandir, 'dirs', dirs))
+        return watcher.Watcher(copy_media, spool, settle=0, poll_interval=0, **kwargs), copy_media, seen
+
+    def test_enqueue(self):
+        with tempfile.TemporaryDirectory() as spool:
+            entry = watcher.enqueue(spool, 'relative/name.mkv')
+            self.assertEqual([os.path.basename(entry)], os.listdir(spool))
+
+    def test_polling_debounce_and_spool(self):
+        with tempfile.TemporaryDirectory() as scan, tempfile.TemporaryDirectory() as other, \
+                tempfile.TemporaryDirectory() as spool:
+            w, copy_media, seen = self._watcher(scan, spool, use_inotify=False)
+
+            episode = os.path.join(scan, 'Show - 01.mkv')
+            with open(episode, 'w') as f:
+                f.write('partial')
+            os.makedirs(os.path.join(scan, 'tmp'))
+
+            # First sighting only records the entry; it has to look the same twice in a row.
+            self.assertEqual([], w.run_once())
+            with open(episode, 'a') as f:
+                f.write(' more data')
+            self.assertEqual([], w.run_once())
+            self.assertEqual([episode], w.run_once())
+            self.assertEqual([(scan, 'files', ['Show - 01.mkv'])], seen)
+            self.assertEqual(scan, copy_media.scandir)
+            copy_media.finish.assert_called_once()
+
+            # The file wasn't moved, so it is ignored until it changes.
+            self.assertEqual([], w.run_once())
+            self.assertEqual([], w.run_once())
+
+            # A movie directory outside the scan directory, handed over through the spool.
+            movie = os.path.join(other, 'Brave.2012')
+            os.makedirs(movie)
+            open(os.path.join(movie, 'Brave.2012.mkv'), 'w').close()
+            watcher.enqueue(spool, movie)
+            w.run_once()
+            self.assertEqual([movie], w.run_once())
+            self.assertEqual((other, 'dirs', ['Brave.2012']), seen[-1])
+            self.assertEqual([], os.listdir(spool))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_inotify(self):
+        with tempfile.TemporaryDirectory() as scan, tempfile.TemporaryDirectory() as spool:
+            w, copy_media, seen = self._watcher(scan, spool)
+            self.assertIsNotNone(w._inotify)
+
+            open(os.path.join(scan, 'Show - 02.mkv'), 'w').close()
+            self.assertEqual([], w.run_once(timeout=1))
+            self.assertEqual([os.path.join(scan, 'Show - 02.mkv')], w.run_once())
+            self.assertEqual([(scan, 'files', ['Show - 02.mkv'])], seen)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import functools
+import logging
+import math
+import threading
+import time
+
+# Stage names used across CopyMedia, so reports line up from run to run.
+CONFIG = 'config'
+SCAN = 'scan'
+MATCH = 'match'
+PTN_PARSE = 'ptn'
+TMDB_HTTP = 'tmdb.http'
+FFMPEG = 'ffmpeg'
+FFPROBE = 'ffprobe'
+SSH_CONNECT = 'ssh.connect'
+SSH_MKDIR = 'ssh.mkdir'
+SSH_COMMAND = 'ssh.command'
+SSH_SEND = 'ssh.send'
+RSYNC = 'rsync'
+LOCAL_MOVE = 'move.local'
+NOTIFY = 'notify'
+TOTAL = 'total'
+
+# Samples are only kept while enabled (--profile), so a long-running daemon doesn't accumulate them.
+enabled = False
+
+_lock = threading.Lock()
+# stage name -> [seconds, ...]
+_samples = {}
+
+
+class stage:
+    """Time a block, or every call of a function, as one sample of the named stage.
+
+    Use as a context manager (with timing.stage(timing.RSYNC): ...) or a decorator
+    (@timing.stage(timing.PTN_PARSE)). When timing is disabled only the enabled flag is checked."""
+
+    __slots__ = ('name', '_started')
+
+    def __init__(self, name):
+        self.name = name
+        self._started = None
+
+    def __enter__(self):
+        if enabled:
+            self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._started is not None:
+            record(self.name, time.perf_counter() - self._started)
+            self._started = None
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - started)
+        return timed
+
+
+def record(name, seconds):
+    """Add one sample of seconds to the named stage. Safe to call from transfer worker threads."""
+    if enabled:
+        with _lock:
+            _samples.setdefault(name, []).append(seconds)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def reset():
+    with _lock:
+        _samples.clear()
+
+
+def _percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summary():
+    """Return {stage: {count, total, mean, p50, p95, max}} with times in seconds, slowest total first."""
+
+    with _lock:
+        samples = {name: sorted(times) for name, times in _samples.items()}
+    stats = {}
+    for name, ordered in sorted(samples.items(), key=lambda item: -sum(item[1])):
+        total = sum(ordered)
+        stats[name] = {'count': len(ordered), 'total': total, 'mean': total / len(ordered),
+                       'p50': _percentile(ordered, 0.5), 'p95': _percentile(ordered, 0.95), 'max': ordered[-1]}
+    return stats
+
+
+def report(stats=None):
+    """Format summary() as a table, one line per stage."""
+
+    stats = summary() if stats is None else stats
+    lines = ['%-14s %7s %10s %10s %10s %10s' % ('stage', 'count', 'total s', 'p50 ms', 'p95 ms', 'max ms')]
+    for name, s in stats.items():
+        lines.append('%-14s %7d %10.3f %10.1f %10.1f %10.1f' % (name, s['count'], s['total'], s['p50'] * 1000,
+                                                                s['p95'] * 1000, s['max'] * 1000))
+    return '\n'.join(lines)
+
+
+def write_json(json_file, stats=None):
+    import json
+
+    stats = summary() if stats is None else stats
+    with open(json_file, 'w') as f:
+        json.dump({'created': time.time(), 'stages': stats}, f, indent=2)
+    logging.info('Wrote stage timings to [%s]', json_file)
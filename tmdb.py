@@ -1,12 +1,16 @@
+import functools
 import json
 import logging
 import re
-import urllib
-import PTN
-
-import requests
+import threading
+import time
+import urllib.parse
 
 import logger
+import timing
+
+# PTN, requests, sqlite3 and concurrent.futures are imported where they are used. Most runs only
+# handle series files matched by regex, and those should not pay for loading them.
 
 URL_CONTEXT = '/3/search/movie?api_key=API_KEY&include_adult=false&query=QUERY_STRING'
 YEAR_BASE = '&year='
@@ -14,14 +18,181 @@ DNS_NAME = 'api.themoviedb.org'
 PROTOCOL = 'https://'
 BASE_URL = PROTOCOL + DNS_NAME + URL_CONTEXT
 
+CACHE_FILE = 'tmdb_cache.sqlite'
+DAY = 24 * 60 * 60
+POSITIVE_TTL = 180 * DAY
+NEGATIVE_TTL = 14 * DAY
+MAX_CACHE_ENTRIES = 10000
 
-def clean_name(name):
-    """Used to parse the name of the media so that the title and year can be sent in an API query"""
+# TMDB allows roughly 50 requests per second per IP; stay comfortably below that.
+RATE_LIMIT = 40
+RATE_BURST = 10
+MAX_WORKERS = 8
+TIMEOUT = 10
 
-    logging.log(logger.TRACE, 'Raw name: [%s]', name)
+
+class RateLimiter:
+    """Thread-safe token bucket allowing rate calls per second with bursts of up to burst calls."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_rate_limiter = RateLimiter(RATE_LIMIT, RATE_BURST)
+_session = None
+_session_lock = threading.Lock()
+
+
+class LookupCache:
+    """Persistent SQLite cache of TMDB lookups keyed by cleaned title and year.
+
+    Both positive and negative results are stored, each with its own time-to-live. Once the cache
+    holds more than max_entries rows the least recently used entries are evicted."""
+
+    def __init__(self, cache_file=CACHE_FILE, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL,
+                 max_entries=MAX_CACHE_ENTRIES):
+        self.cache_file = cache_file
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        import sqlite3
+
+        logging.debug('Opening TMDB lookup cache [%s]', cache_file)
+        self._conn = sqlite3.connect(cache_file)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS lookups ('
+                           'key TEXT PRIMARY KEY, is_movie INTEGER NOT NULL, '
+                           'stored REAL NOT NULL, accessed REAL NOT NULL)')
+        self._conn.commit()
+
+    @staticmethod
+    def key(meta):
+        """Build the cache key from the meta-data returned by clean_name."""
+        return '%s|%s' % (meta['title'].strip().lower(), meta.get('year', ''))
+
+    def get(self, key):
+        """Return the cached result for key, or None if there is no fresh entry."""
+
+        row = self._conn.execute('SELECT is_movie, stored FROM lookups WHERE key = ?', (key,)).fetchone()
+        now = time.time()
+        if row is not None:
+            result, stored = bool(row[0]), row[1]
+            ttl = self.positive_ttl if result else self.negative_ttl
+            if now - stored < ttl:
+                self.hits += 1
+                self._conn.execute('UPDATE lookups SET accessed = ? WHERE key = ?', (now, key))
+                self._conn.commit()
+                logging.debug('TMDB cache hit for [%s]: [%s]', key, result)
+                return result
+            logging.debug('TMDB cache entry for [%s] has expired', key)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        """Store the result of a lookup, evicting the least recently used entries if needed."""
+
+        now = time.time()
+        self._conn.execute('INSERT OR REPLACE INTO lookups (key, is_movie, stored, accessed) VALUES (?, ?, ?, ?)',
+                           (key, int(bool(result)), now, now))
+        self._conn.execute('DELETE FROM lookups WHERE key IN (SELECT key FROM lookups '
+                           'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+        self._conn.commit()
+
+    def log_stats(self):
+        logging.info('TMDB cache [%s]: %d hits, %d misses', self.cache_file, self.hits, self.misses)
+
+    def close(self):
+        self._conn.close()
+
+
+# Parsed names are kept for the whole process: is_movie and rename_movie parse the same release
+# names, and the daemon sees the same names again and again.
+PARSE_CACHE_SIZE = 4096
+
+# The common "Title.Year..." and "Title.S01E02..." release names: a plain title (no digits runs that
+# could be a year, no brackets, dashes or underscores), then the year or the SxxEyy marker.
+_FAST_NAME = re.compile(r"(?P<title>[A-Za-z0-9][A-Za-z0-9'&!,]*(?:[ .]+[A-Za-z0-9'&!,]+)*?)[ .]+"
+                        r"(?P<marker>\(?(?P<year>(?:19|20)\d\d)\)?|S(?P<season>\d\d)E(?P<episode>\d\d))(?=[ .-]|$)",
+                        re.IGNORECASE)
+# Anything PTN would take as the end of the title (its patterns, with the same word boundaries). If the
+# title holds one, or anything that looks like a year, PTN cuts it somewhere else and the fast path isn't sure.
+_PTN_MARKERS = re.compile(r"s?\d{1,2}[ex]|[ex]\d{2}(?:\D|$)|\b(?:\d{3,4}p|(?:PPV\.)?[HP]DTV|(?:HD)?CAM"
+                          r"|B[DR]Rip|TS|(?:PPV )?WEB-?DL(?: DVDRip)?|HDRip|DVDRip|DVDRIP|CamRip|W[EB]BRip|BluRay"
+                          r"|DvDScr|hdtv|xvid|[hx]\.?26[45]|MP3|DD5\.?1|Dual[\- ]Audio|LiNE|H?DTS|AAC(?:\.?2\.0)?"
+                          r"|AC3(?:\.5\.1)?|R\d|EXTENDED(?::?.CUT)?|HC|PROPER|REPACK|MKV|AVI|WS|rus\.eng"
+                          r"|(?:Half-)?SBS)\b", re.IGNORECASE)
+# PTN's own year (it stops at 2019) and season/episode patterns.
+_PTN_YEAR = re.compile(r'\b[\[(]?(?:19\d|20[01])\d[\])]?\b')
+_PTN_EPISODE = re.compile(r's?\d{1,2}[ex]|[ex]\d{2}(?:\D|$)', re.IGNORECASE)
+_ANY_YEAR = re.compile(r'\b(?:19|20)\d\d\b')
+
+
+def fast_parse(name):
+    """Parse the title and year, or the title, season and episode, of a common release name with one regex.
+
+    Returns None whenever PTN could read the name differently, so the caller falls back to it.
+    Unlike PTN the result holds only those keys."""
+
+    match = _FAST_NAME.match(name)
+    if match is None:
+        return None
+    marker = match.start('marker')
+    rest = name[match.end('marker'):]
+    # The marker must be the first thing PTN recognises, and found where PTN's str.find() looks.
+    if _PTN_MARKERS.search(name, 0, marker) or _ANY_YEAR.search(name, 0, marker) \
+            or name.find(match.group('marker')) != marker:
+        return None
+
+    # PTN's title clean-up, applied to the same slice of the name.
+    title = name[:marker]
+    if ' ' not in title:
+        title = title.replace('.', ' ')
+    title = title.strip()
+
+    if match.group('year'):
+        year = int(match.group('year'))
+        if _PTN_EPISODE.search(rest) or _PTN_YEAR.search(rest):
+            return None
+        if year >= 2020:
+            # PTN doesn't see these; clean_name takes them off the end of PTN's title, which only
+            # works when nothing but the year separates the title from what PTN recognises next.
+            next_marker = _PTN_MARKERS.search(rest)
+            if match.group('marker')[0] == '(' or rest[:next_marker.start() if next_marker else len(rest)].strip(' .'):
+                return None
+        return {'title': title, 'year': year}
+
+    if _PTN_YEAR.search(rest) or name.find(match.group('marker')[:3]) != marker:
+        return None
+    return {'title': title, 'season': int(match.group('season')), 'episode': int(match.group('episode'))}
+
+
+def ptn_parse(name):
+    """Parse name with PTN, picking up the years from 2020 on that PTN's year pattern misses."""
+
+    import PTN
 
     meta = PTN.parse(name)
-    logging.log(logger.TRACE, 'Parsed meta-data: [%s]', meta)
 
     # PTN's year regex only covers up to 2019; strip trailing years >= 2020 from title
     if 'year' not in meta:
@@ -29,59 +200,167 @@ def clean_name(name):
         if match:
             meta['year'] = int(match.group(1))
             meta['title'] = meta['title'][:match.start()].rstrip()
+    return meta
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+@timing.stage(timing.PTN_PARSE)
+def _parse(name):
+    meta = fast_parse(name)
+    if meta is None:
+        logging.log(logger.TRACE, 'Falling back to PTN for [%s]', name)
+        meta = ptn_parse(name)
+    return meta
+
+
+def clean_name(name):
+    """Used to parse the name of the media so that the title and year can be sent in an API query"""
+
+    logging.log(logger.TRACE, 'Raw name: [%s]', name)
+
+    # A copy, so callers can't change what is cached.
+    meta = dict(_parse(name))
+    logging.log(logger.TRACE, 'Parsed meta-data: [%s]', meta)
 
     logging.debug('Parsed title: [%s]', meta['title'])
     return meta
 
 
-def is_movie(name, api_key):
-    """Look up the name of the media in question in The Movie DB to determine if this media
-       is a movie or not."""
+def get_session():
+    """Return the shared keep-alive session used for all TMDB queries."""
 
-    if api_key is None:
-        logging.warning("Can't query tmdb because no api key was specified.")
-        return False
+    import requests
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+            _session.mount(PROTOCOL, adapter)
+    return _session
+
+
+def _prepare_query(name):
+    """Parse a media name into its cache key and query URL (without API key).
+
+    Returns None when the name can't be a movie, so no query needs to be sent."""
 
     if name is None:
         logging.warning("Can't query because file name was not provided.")
 
-    # Only send query if the media name and api key are provided
-    if name:
+    # Only send query if the media name is provided
+    if not name:
+        return None
+
+    logging.debug('Performing query to the movie DB with media name [%s]', name)
+
+    meta = clean_name(name)
+    enc_name = urllib.parse.quote(meta['title'])
+    logging.log(logger.TRACE, 'URL encoded name: [%s]', enc_name)
+    url = BASE_URL.replace('QUERY_STRING', enc_name)
+
+    if 'year' in meta:
+        url = url + YEAR_BASE + str(meta['year'])
+    else:
+        logging.debug('No year found in file name. Skipping search.')
+        return None
+
+    if 'season' in meta and 'episode' in meta:
+        logging.debug('meta-data indicates season [%s] and episode [%s] in name. '
+                      'Movies can\'t have seasons and episodes, so skipping search',
+                      meta['season'], meta['episode'])
+        return None
+
+    return LookupCache.key(meta), url
 
-        logging.debug('Performing query to the movie DB with media name [%s]', name)
 
-        meta = clean_name(name)
-        enc_name = urllib.parse.quote(meta['title'])
-        logging.log(logger.TRACE, 'URL encoded name: [%s]', enc_name)
-        url = BASE_URL.replace('QUERY_STRING', enc_name)
+@timing.stage(timing.TMDB_HTTP)
+def _query(url, api_key):
+    """Send a single search query. Returns (found, ok) where ok is False for errors that
+    shouldn't be cached."""
 
-        if 'year' in meta:
-            url = url + YEAR_BASE + str(meta['year'])
-        else:
-            logging.debug('No year found in file name. Skipping search.')
-            return False
+    logging.debug('Sending query to [%s] TMDB with URL: [%s]', DNS_NAME, url)
 
-        if 'season' in meta and 'episode' in meta:
-            logging.debug('meta-data indicates season [%s] and episode [%s] in name. '
-                          'Movies can\'t have seasons and episodes, so skipping search',
-                          meta['season'], meta['episode'])
-            return False
+    url = url.replace('API_KEY', api_key)
 
-        logging.debug('Sending query to [%s] TMDB with URL: [%s]', DNS_NAME, url)
+    import requests
 
-        url = url.replace('API_KEY', api_key)
+    _rate_limiter.acquire()
+    try:
+        r = get_session().get(url, timeout=TIMEOUT)
+    except requests.RequestException:
+        logging.exception('TMDB query failed for [%s]', url.replace(api_key, '<key>'))
+        return False, False
 
-        r = requests.get(url)
+    logging.debug('TMDB GET status: [%s] with reason: [%s]',
+                  r.status_code, r.reason)
+    logging.log(logger.TRACE, 'Results: [%s]', r.text)
 
-        logging.debug('TMDB GET status: [%s] with reason: [%s]',
-                      r.status_code, r.reason)
-        logging.log(logger.TRACE, 'Results: [%s]', r.text)
+    # Only remember real answers; errors (bad key, rate limited, ...) should be retried next time.
+    if r.status_code != 200:
+        return False, False
+
+    found = False
+    if r.text:
+        num_results = json.loads(r.text).get('total_results', 0)
+        logging.debug('Number of results found: [%d]', num_results)
+        found = num_results > 0
+
+    return found, True
+
+
+def classify_many(names, api_key, cache=None, max_workers=MAX_WORKERS):
+    """Determine for each name whether it is a movie. Returns a list of booleans in the same order.
+
+    Names that parse to the same title and year are only looked up once. Lookups that aren't
+    answered by the cache run concurrently on a bounded thread pool sharing one keep-alive
+    session, and are throttled to TMDB's rate limit. The cache is only touched from the
+    calling thread."""
+
+    results = [False] * len(names)
+
+    if api_key is None:
+        logging.warning("Can't query tmdb because no api key was specified.")
+        return results
+
+    pending = {}
+    for index, name in enumerate(names):
+        prepared = _prepare_query(name)
+        if prepared is None:
+            continue
+        key, url = prepared
+
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                results[index] = cached
+                continue
+
+        pending.setdefault(key, (url, []))[1].append(index)
+
+    if not pending:
+        return results
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = max(1, min(max_workers, len(pending)))
+    logging.debug('Sending %d TMDB queries using %d workers', len(pending), workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tmdb') as pool:
+        answers = pool.map(lambda url: _query(url, api_key), [url for url, _ in pending.values()])
+
+        for (key, (url, indices)), (found, ok) in zip(pending.items(), answers):
+            for index in indices:
+                results[index] = found
+            if cache is not None and ok:
+                cache.put(key, found)
+
+    return results
+
+
+def is_movie(name, api_key, cache=None):
+    """Look up the name of the media in question in The Movie DB to determine if this media
+       is a movie or not.
 
-        if r.text:
-            result = json.loads(r.text)
-            num_results = result['total_results']
-            logging.debug('Number of results found: [%d]', num_results)
-            if result['total_results'] > 0:
-                return True
+       If a LookupCache is provided it is consulted before, and updated after, any network query."""
 
-        return False
+    return classify_many([name], api_key, cache)[0]
@@ -0,0 +1,589 @@
+import errno
+import logging
+import os
+import shutil
+import time
+
+# Bytes handed to the kernel per copy_file_range/sendfile call (and buffer size for the read/write fallback)
+COPY_CHUNK = 64 * 1024 * 1024
+# Copied files are synced to disk together, once this much data or this many files are waiting
+FSYNC_BATCH_BYTES = 1024 * 1024 * 1024
+FSYNC_BATCH_FILES = 32
+
+RENAME = 'rename'
+LINK = 'hardlink'
+CLONE = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+READ_WRITE = 'read/write'
+DIRECT_IO = 'O_DIRECT'
+
+MIB = 1024 * 1024
+
+# Delivery modes (deliveryMode config setting). move takes the download away; the others leave it in
+# place, e.g. so the torrent keeps seeding, and fall back along hardlink -> reflink -> copy as needed.
+MOVE = 'move'
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY = 'copy'
+MODES = (MOVE, HARDLINK, REFLINK, COPY)
+SERIES = 'series'
+MOVIES = 'movies'
+
+# ioctl asking the file system to share src's extents with dst (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# What a copy does to the page cache (copyCache config setting). normal leaves it to the kernel.
+# drop writes each chunk back as soon as it is copied and evicts both files' pages behind the copy.
+# direct writes (and where possible reads) with O_DIRECT, bypassing the cache altogether.
+CACHE_NORMAL = 'normal'
+CACHE_DROP = 'drop'
+CACHE_DIRECT = 'direct'
+CACHE_MODES = (CACHE_NORMAL, CACHE_DROP, CACHE_DIRECT)
+# Bytes copied between write-behind steps, and the O_DIRECT buffer size (a multiple of DIRECT_ALIGN)
+WRITE_BEHIND_CHUNK = 8 * 1024 * 1024
+DIRECT_ALIGN = 4096
+
+# sync_file_range flags (linux/fs.h)
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+_sync_file_range = None
+
+# errnos meaning "this copy primitive doesn't work for these files"; try the next one
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def _device(full_path):
+    """st_dev of full_path, or of its closest existing parent if it doesn't exist yet."""
+    while True:
+        try:
+            return os.stat(full_path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(full_path)
+            if parent == full_path:
+                raise
+            full_path = parent
+
+
+def _preallocate(fd, size):
+    """Reserve size bytes up front so the file isn't fragmented. Best effort."""
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            logging.debug('Preallocation not supported here', exc_info=True)
+
+
+def parse_modes(setting):
+    """Turn the deliveryMode config value into {'series': mode, 'movies': mode}.
+
+    The setting may be a single mode for both destinations, or an object with separate 'series'
+    and/or 'movies' entries."""
+
+    modes = {SERIES: MOVE, MOVIES: MOVE}
+    if setting is None:
+        return modes
+    if isinstance(setting, dict):
+        modes.update(setting)
+    else:
+        modes = {SERIES: setting, MOVIES: setting}
+
+    for kind, mode in modes.items():
+        if kind not in (SERIES, MOVIES) or mode not in MODES:
+            raise ValueError('deliveryMode for %s must be one of %s, not %r' % (kind, MODES, mode))
+    return modes
+
+
+def reflink(src_fd, dst_fd):
+    """Make dst_fd share src_fd's data blocks (copy-on-write). Raises OSError where not supported."""
+
+    import fcntl
+
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _fadvise(fd, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            logging.debug('posix_fadvise not supported here', exc_info=True)
+
+
+def _sync_range(fd, offset, length, flags):
+    """sync_file_range(2) through libc. Does nothing where it isn't available."""
+
+    global _sync_file_range
+    if _sync_file_range is None:
+        import ctypes
+        import ctypes.util
+
+        try:
+            func = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).sync_file_range
+            func.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint)
+            _sync_file_range = func
+        except (OSError, AttributeError):
+            _sync_file_range = False
+    if _sync_file_range and length > 0:
+        _sync_file_range(fd, offset, length, flags)
+
+
+def drop_cache(src):
+    """Evict the cached pages of src (a file or directory tree), e.g. after rsync read them. Best effort."""
+
+    paths = [src]
+    if os.path.isdir(src):
+        paths = [os.path.join(root, name) for root, dirs, files in os.walk(src) for name in files]
+    for full_path in paths:
+        try:
+            fd = os.open(full_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            _fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def page_cache_bytes():
+    """Size of the page cache from /proc/meminfo, or None where that isn't available."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('Cached:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class _WriteBehind:
+    """Keep a copy out of the page cache as it goes.
+
+    After every chunk, writeback of that chunk is started, the previous chunk is waited for, and
+    then both files' pages for it are dropped. Dirty data never exceeds two chunks, and the final
+    fsync has next to nothing left to do."""
+
+    def __init__(self, src_fd, dst_fd):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        # [dropped, started) is being written back; [started, copied) has just been copied
+        self.dropped = 0
+        self.started = 0
+        _fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def advance(self, copied):
+        _sync_range(self.dst_fd, self.started, copied - self.started, SYNC_FILE_RANGE_WRITE)
+        self._drop(self.started)
+        self.started = copied
+
+    def finish(self, copied):
+        self.advance(copied)
+        self._drop(copied)
+
+    def _drop(self, end):
+        length = end - self.dropped
+        if length <= 0:
+            return
+        _sync_range(self.dst_fd, self.dropped, length,
+                    SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+        _fadvise(self.dst_fd, self.dropped, length, os.POSIX_FADV_DONTNEED)
+        _fadvise(self.src_fd, self.dropped, length, os.POSIX_FADV_DONTNEED)
+        self.dropped = end
+
+
+def _set_direct(fd, direct):
+    """Switch O_DIRECT on or off for an open file. Returns False if the file system doesn't allow it."""
+
+    import fcntl
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT if direct else flags & ~os.O_DIRECT)
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return False
+    return True
+
+
+def _copy_direct(src_fd, dst_fd, size, digest=None):
+    """Copy with O_DIRECT through one page-aligned buffer. Returns False if O_DIRECT can't be used here."""
+
+    import mmap
+
+    if not hasattr(os, 'O_DIRECT') or not _set_direct(dst_fd, True):
+        return False
+    src_direct = _set_direct(src_fd, True)
+    buffer = mmap.mmap(-1, WRITE_BEHIND_CHUNK)
+    view = memoryview(buffer)
+    copied = 0
+    try:
+        while copied < size:
+            n = os.readv(src_fd, [view])
+            if n == 0:
+                break
+            if digest is not None:
+                digest.update(view[:n])
+            if not src_direct:
+                _fadvise(src_fd, copied, n, os.POSIX_FADV_DONTNEED)
+            # O_DIRECT writes whole blocks; the padding of the last one is truncated away below.
+            aligned = -(-n // DIRECT_ALIGN) * DIRECT_ALIGN
+            written = 0
+            while written < aligned:
+                written += os.write(dst_fd, view[written:aligned])
+            copied += n
+    finally:
+        view.release()
+        buffer.close()
+        _set_direct(dst_fd, False)
+        if src_direct:
+            _set_direct(src_fd, False)
+    os.ftruncate(dst_fd, copied)
+    return True
+
+
+def copy_data(src_fd, dst_fd, size, cache=CACHE_NORMAL, digest=None):
+    """Copy size bytes from src_fd to dst_fd, letting the kernel move the data where it can.
+
+    Tries copy_file_range (which may reflink or copy server-side), then sendfile, then a plain
+    read/write loop with COPY_CHUNK buffers. Returns the name of the method that did the copy.
+
+    With cache=CACHE_DROP the copy goes in WRITE_BEHIND_CHUNK steps through _WriteBehind. With
+    CACHE_DIRECT it uses O_DIRECT instead, falling back to CACHE_DROP where that isn't supported.
+    If a digest (anything with an update() method) is given, every byte is fed to it on its way
+    through: the kernel copies are skipped, since their data never passes through here."""
+
+    if cache == CACHE_DIRECT:
+        if _copy_direct(src_fd, dst_fd, size, digest):
+            return DIRECT_IO
+        logging.debug('O_DIRECT not supported here; dropping the cache behind the copy instead')
+        cache = CACHE_DROP
+
+    chunk_size = COPY_CHUNK
+    write_behind = None
+    if cache == CACHE_DROP:
+        chunk_size = WRITE_BEHIND_CHUNK
+        write_behind = _WriteBehind(src_fd, dst_fd)
+
+    copied = 0
+    method = None
+    if digest is None and hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, min(chunk_size, size - copied))
+                if n == 0:
+                    break
+                copied += n
+                if write_behind:
+                    write_behind.advance(copied)
+            method = COPY_FILE_RANGE
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copied:
+                raise
+
+    if method is None and digest is None and hasattr(os, 'sendfile'):
+        try:
+            while copied < size:
+                n = os.sendfile(dst_fd, src_fd, copied, min(chunk_size, size - copied))
+                if n == 0:
+                    break
+                copied += n
+                if write_behind:
+                    write_behind.advance(copied)
+            method = SENDFILE
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copied:
+                raise
+
+    if method is None:
+        while True:
+            chunk = os.read(src_fd, chunk_size)
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(dst_fd, view):]
+            copied += len(chunk)
+            if write_behind:
+                write_behind.advance(copied)
+        method = READ_WRITE
+
+    if write_behind:
+        write_behind.finish(copied)
+    return method
+
+
+class _CopyDigest:
+    """SHA-256 of the data passed through a copy, and how many bytes that was."""
+
+    def __init__(self):
+        import hashlib
+
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class Mover:
+    """Move files and directories on the local file system, picking the cheapest way per move.
+
+    When the source and the destination's file system are the same device the move is a single
+    os.rename. Otherwise each file is copied into a .part file next to its destination with
+    copy_data. Copies are fsync'ed in batches; only then are they renamed into place and their
+    sources deleted, so a crash never leaves a half-written file under the final name or loses a
+    source. Use as a context manager, or call flush() when done; results maps every source to
+    whether it was moved.
+
+    With a mode other than MOVE the sources are left where they are. Each file is hard-linked,
+    reflinked or copied, whichever is the first that works from the mode down; what a pair of
+    file systems doesn't support is remembered, so it is only tried once. cache is passed on to
+    copy_data for every copy.
+
+    With verify, copies are SHA-256 hashed as the data goes through (the source is still read only
+    once), and a source that changed while it was copied fails the move. hashes maps every copied
+    destination to its (size, sha256) once it is in place. Renames and links move no data, so
+    they have nothing to verify."""
+
+    def __init__(self, mode=MOVE, cache=CACHE_NORMAL, verify=False):
+        self.mode = mode
+        self.cache = cache
+        self.verify = verify
+        self.results = {}
+        self.hashes = {}
+        self.stats = {RENAME: 0, LINK: 0, CLONE: 0, 'copied': 0, 'bytes': 0, 'seconds': 0.0, 'cache': 0}
+        # [(owner, src, part, dest, fd)] copied but not yet synced; owner is the tree a file belongs to
+        self._pending = []
+        self._pending_bytes = 0
+        # sources that are whole directory trees, deleted once everything in them is committed
+        self._trees = []
+        # trees and files that failed; kept across flushes, since a tree may be committed over several
+        self._failed = set()
+        # (method, src device, dest device) found not to work
+        self._unsupported = set()
+
+    def move(self, src, dest):
+        """Move src (a file or directory) to dest. Raises OSError if the move fails right away."""
+
+        if self.mode != MOVE:
+            self._deliver(src, dest)
+        elif _device(src) == _device(os.path.dirname(dest)):
+            if os.path.isdir(src) and os.path.isdir(dest):
+                self._merge(src, dest)
+            else:
+                os.rename(src, dest)
+                logging.info('Renamed [%s] to [%s] (same file system)', src, dest)
+                self.stats[RENAME] += 1
+            self.results[src] = True
+        elif os.path.isdir(src):
+            self._copy_tree(src, dest)
+        else:
+            self._copy(src, dest)
+
+    def _merge(self, src, dest):
+        """Rename the contents of src into the existing directory dest, then remove src."""
+        for entry in os.scandir(src):
+            target = os.path.join(dest, entry.name)
+            if entry.is_dir(follow_symlinks=False) and os.path.isdir(target):
+                self._merge(entry.path, target)
+            else:
+                os.replace(entry.path, target)
+        os.rmdir(src)
+        logging.info('Merged [%s] into [%s] (same file system)', src, dest)
+        self.stats[RENAME] += 1
+
+    def _deliver(self, src, dest):
+        """Put a copy of src (a file or directory) at dest in the cheapest way the mode allows."""
+
+        if not os.path.isdir(src):
+            if self._deliver_file(src, dest):
+                self.results[src] = True
+            return
+        try:
+            for root, dirs, files in os.walk(src):
+                target = os.path.join(dest, os.path.relpath(root, src))
+                os.makedirs(target, exist_ok=True)
+                for name in files:
+                    self._deliver_file(os.path.join(root, name), os.path.join(target, name), owner=src)
+        except OSError:
+            self._discard(src)
+            raise
+        self._trees.append(src)
+        self.flush()
+
+    def _deliver_file(self, src, dest, owner=None):
+        """Hard-link, reflink or (queue a) copy of the file src at dest. Returns True if already in place."""
+
+        devices = (_device(src), _device(os.path.dirname(dest)))
+        if self.mode == HARDLINK and (LINK, *devices) not in self._unsupported:
+            part = dest + '.part'
+            try:
+                if os.path.lexists(part):
+                    os.remove(part)
+                os.link(src, part)
+            except OSError as e:
+                logging.debug('Cannot hard-link [%s] to [%s]: %s', src, dest, e)
+                self._unsupported.add((LINK, *devices))
+            else:
+                os.replace(part, dest)
+                logging.info('Hard-linked [%s] to [%s]', src, dest)
+                self.stats[LINK] += 1
+                return True
+
+        use_reflink = self.mode in (HARDLINK, REFLINK) and (CLONE, *devices) not in self._unsupported
+        self._copy(src, dest, owner, use_reflink)
+        return False
+
+    def _copy_tree(self, src, dest):
+        try:
+            for root, dirs, files in os.walk(src):
+                target = os.path.join(dest, os.path.relpath(root, src))
+                os.makedirs(target, exist_ok=True)
+                for name in files:
+                    self._copy(os.path.join(root, name), os.path.join(target, name), owner=src)
+        except OSError:
+            self._discard(src)
+            raise
+        self._trees.append(src)
+        self.flush()
+
+    def _discard(self, owner):
+        """Drop the uncommitted copies made for owner; its source stays where it is."""
+        keep = []
+        for item in self._pending:
+            if item[0] == owner:
+                os.close(item[4])
+                os.remove(item[2])
+            else:
+                keep.append(item)
+        self._pending = keep
+
+    def _copy(self, src, dest, owner=None, use_reflink=False):
+        part = dest + '.part'
+        started = time.monotonic()
+        cached = page_cache_bytes()
+        with open(src, 'rb') as src_file:
+            size = os.fstat(src_file.fileno()).st_size
+            fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                method = None
+                if use_reflink:
+                    try:
+                        reflink(src_file.fileno(), fd)
+                        method = CLONE
+                    except OSError as e:
+                        logging.debug('Cannot reflink [%s] to [%s]: %s', src, dest, e)
+                        self._unsupported.add((CLONE, _device(src), _device(os.path.dirname(dest))))
+                if method is None:
+                    digest = _CopyDigest() if self.verify else None
+                    before = os.fstat(src_file.fileno())
+                    _preallocate(fd, size)
+                    method = copy_data(src_file.fileno(), fd, size, self.cache, digest)
+                    if digest is not None:
+                        self._check_copy(src, before, os.fstat(src_file.fileno()), digest.size)
+                        self.hashes[dest] = (digest.size, digest.hexdigest())
+                shutil.copystat(src, part)
+            except BaseException:
+                os.close(fd)
+                os.remove(part)
+                raise
+        elapsed = time.monotonic() - started
+        if method == CLONE:
+            logging.info('Reflinked [%s] to [%s]', src, dest)
+            self.stats[CLONE] += 1
+        else:
+            # The whole system's page cache, so only indicative: it shows whether a copy flooded it.
+            cache_growth = page_cache_bytes() - cached if cached is not None else 0
+            logging.info('Copied [%s] to [%s] via %s: %.1f MiB in %.2fs (%.1f MiB/s), page cache %+.1f MiB',
+                         src, dest, method, size / MIB, elapsed, size / MIB / elapsed if elapsed else 0,
+                         cache_growth / MIB)
+            self.stats['cache'] += cache_growth
+            self.stats['copied'] += 1
+            self.stats['bytes'] += size
+            self.stats['seconds'] += elapsed
+
+        self._pending.append((owner or src, src, part, dest, fd))
+        self._pending_bytes += size
+        if self._pending_bytes >= FSYNC_BATCH_BYTES or len(self._pending) >= FSYNC_BATCH_FILES:
+            self.flush()
+
+    @staticmethod
+    def _check_copy(src, before, after, copied):
+        """Raise OSError unless all of a source that didn't change while it was read was copied."""
+        if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns):
+            raise OSError(errno.EIO, '%s changed while it was being copied' % src)
+        if copied != after.st_size:
+            raise OSError(errno.EIO, 'copied %d bytes of %s, not %d' % (copied, src, after.st_size))
+
+    def flush(self):
+        """Sync every pending copy to disk, put it in place and delete its source."""
+
+        pending, self._pending, self._pending_bytes = self._pending, [], 0
+        synced_dirs = set()
+        for owner, src, part, dest, fd in pending:
+            try:
+                if owner in self._failed:
+                    raise OSError('an earlier file of [%s] failed' % owner)
+                os.fsync(fd)
+                os.close(fd)
+                fd = None
+                os.replace(part, dest)
+                synced_dirs.add(os.path.dirname(dest))
+                if owner == src:
+                    if self.mode == MOVE:
+                        os.remove(src)
+                    self.results[src] = True
+            except OSError:
+                logging.exception('Failed moving [%s] to [%s]', src, dest)
+                self.hashes.pop(dest, None)
+                if fd is not None:
+                    os.close(fd)
+                if os.path.exists(part):
+                    os.remove(part)
+                self._failed.add(owner)
+                self.results[owner] = False
+
+        for directory in synced_dirs:
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError:
+                logging.debug('Could not sync directory [%s]', directory, exc_info=True)
+
+        trees, self._trees = self._trees, []
+        for tree in trees:
+            if tree in self._failed:
+                continue
+            if self.mode == MOVE:
+                shutil.rmtree(tree)
+            self.results[tree] = True
+
+    def log_stats(self):
+        if self.stats['copied'] or self.stats[LINK] or self.stats[CLONE]:
+            seconds = self.stats['seconds']
+            logging.info('Local %s: %d renamed, %d hard-linked, %d reflinked, %d copied (%.1f MiB at %.1f MiB/s, '
+                         '%s cache, page cache %+.1f MiB)',
+                         'moves' if self.mode == MOVE else 'deliveries (%s)' % self.mode, self.stats[RENAME],
+                         self.stats[LINK], self.stats[CLONE], self.stats['copied'], self.stats['bytes'] / MIB,
+                         self.stats['bytes'] / MIB / seconds if seconds else 0, self.cache,
+                         self.stats['cache'] / MIB)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        self.log_stats()
@@ -0,0 +1,267 @@
+import json
+import logging
+import os
+import select
+import struct
+import tempfile
+import time
+from os.path import abspath, dirname, isdir, join, split
+
+SPOOL_DIR = 'spool'
+SETTLE_SECONDS = 30
+POLL_INTERVAL = 10
+
+# inotify event masks (see inotify(7))
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def default_spool_dir(config_file):
+    """The spool directory lives beside the configuration file unless spoolDir says otherwise."""
+    return join(dirname(abspath(config_file)), SPOOL_DIR)
+
+
+def spool_dir_from_config(config_file):
+    """Read just the spool directory from the config, without the full CopyMedia start-up."""
+    with open(config_file) as configfile:
+        return json.load(configfile).get('spoolDir') or default_spool_dir(config_file)
+
+
+def enqueue(spool_dir, media_path):
+    """Hand a finished download to a running daemon and return immediately.
+
+    The request is written to a temporary file and renamed into place, so the daemon never
+    sees a half-written entry."""
+
+    os.makedirs(spool_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=spool_dir)
+    with os.fdopen(fd, 'w') as entry:
+        json.dump({'path': abspath(media_path), 'queued': time.time()}, entry)
+    final_path = join(spool_dir, '%.6f-%d.json' % (time.time(), os.getpid()))
+    os.rename(tmp_path, final_path)
+    logging.info('Queued [%s] for the daemon in [%s]', media_path, final_path)
+    return final_path
+
+
+class Inotify:
+    """Minimal ctypes wrapper around Linux inotify for watching directory entries."""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+
+    def add_watch(self, directory, mask=IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO):
+        import ctypes
+
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for %s' % directory)
+        self._watches[wd] = directory
+
+    def read(self, timeout):
+        """Wait up to timeout seconds and return the (directory, name) pairs that changed."""
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self._watches and name:
+                events.append((self._watches[wd], os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _signature(full_path):
+    """Cheap fingerprint of a file or directory tree that changes while it is still being written."""
+
+    try:
+        if not isdir(full_path):
+            st = os.stat(full_path)
+            return st.st_size, st.st_mtime_ns
+        total = latest = count = 0
+        for root, dirs, files in os.walk(full_path):
+            for name in files:
+                st = os.stat(join(root, name))
+                total += st.st_size
+                latest = max(latest, st.st_mtime_ns)
+                count += 1
+        return total, latest, count
+    except FileNotFoundError:
+        return None
+
+
+class Watcher:
+    """Long-running replacement for one process per finished torrent.
+
+    Keeps a CopyMedia instance alive, watches the scan directory (inotify where available,
+    polling otherwise) plus a spool directory that the Deluge hook drops requests into, waits
+    until each new entry has stopped changing for settle seconds and then hands it to the
+    existing process_files/process_dirs."""
+
+    def __init__(self, copy_media, spool_dir, settle=SETTLE_SECONDS, poll_interval=POLL_INTERVAL,
+                 use_inotify=True):
+        self.copy_media = copy_media
+        self.scandir = copy_media.scandir
+        self.spool_dir = spool_dir
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.running = False
+
+        # full path -> (signature, time the signature last changed)
+        self._pending = {}
+        # full path -> signature of entries that were processed but left in place (not media)
+        self._ignored = {}
+
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+                self._inotify.add_watch(self.scandir)
+                self._inotify.add_watch(self.spool_dir)
+                logging.info('Watching [%s] and [%s] with inotify', self.scandir, self.spool_dir)
+            except (OSError, AttributeError, TypeError):
+                logging.info('inotify not available; polling [%s] every %ss', self.scandir, poll_interval)
+                self._inotify = None
+
+    def _skip(self, name):
+        return name == 'tmp' or name.startswith('.') or abspath(join(self.scandir, name)) == abspath(self.spool_dir)
+
+    def _scan(self):
+        """Add everything currently in the scan directory and the spool to the pending set."""
+        for name in os.listdir(self.scandir):
+            if not self._skip(name):
+                self._track(join(self.scandir, name))
+        self._read_spool()
+
+    def _read_spool(self):
+        for name in sorted(os.listdir(self.spool_dir)):
+            if name.startswith('.') or not name.endswith('.json'):
+                continue
+            entry_path = join(self.spool_dir, name)
+            try:
+                with open(entry_path) as entry:
+                    media_path = json.load(entry)['path']
+            except (OSError, ValueError, KeyError):
+                logging.exception('Discarding unreadable spool entry [%s]', entry_path)
+                media_path = None
+            os.remove(entry_path)
+            if media_path:
+                logging.info('Received queued path [%s]', media_path)
+                self._ignored.pop(media_path, None)
+                self._track(media_path)
+
+    def _track(self, full_path):
+        if full_path not in self._pending:
+            self._pending[full_path] = (None, time.monotonic())
+
+    def _ready(self):
+        """Return pending entries whose signature hasn't changed for at least settle seconds."""
+
+        now = time.monotonic()
+        ready = []
+        for full_path, (last_sig, changed) in list(self._pending.items()):
+            sig = _signature(full_path)
+            if sig is None:
+                # Gone before we got to it.
+                del self._pending[full_path]
+            elif self._ignored.get(full_path) == sig:
+                del self._pending[full_path]
+            elif sig != last_sig:
+                self._pending[full_path] = (sig, now)
+            elif now - changed >= self.settle:
+                del self._pending[full_path]
+                ready.append(full_path)
+        return ready
+
+    def _process(self, ready):
+        """Group ready entries by parent directory and run them through CopyMedia."""
+
+        by_parent = {}
+        for full_path in ready:
+            parent, name = split(full_path)
+            by_parent.setdefault(parent, ([], []))[1 if isdir(full_path) else 0].append(name)
+
+        scandir = self.copy_media.scandir
+        try:
+            for parent, (files, dirs) in by_parent.items():
+                self.copy_media.scandir = parent
+                try:
+                    if files:
+                        logging.info('Files ready: [%s]', files)
+                        self.copy_media.process_files(files)
+                    if dirs:
+                        logging.info('Directories ready: [%s]', dirs)
+                        self.copy_media.process_dirs(dirs)
+                except Exception:
+                    logging.exception('Error processing [%s] in [%s]', files + dirs, parent)
+                    self.copy_media._notify_error('CopyMedia daemon error processing %s' % (files + dirs))
+        finally:
+            self.copy_media.scandir = scandir
+            self.copy_media.finish()
+
+        # Anything still there wasn't media; don't look at it again until it changes.
+        for full_path in ready:
+            sig = _signature(full_path)
+            if sig is not None:
+                self._ignored[full_path] = sig
+
+    def run_once(self, timeout=0):
+        """Wait up to timeout for changes, then process whatever has settled."""
+
+        if self._inotify is not None:
+            for directory, name in self._inotify.read(timeout):
+                if directory == self.spool_dir:
+                    self._read_spool()
+                elif not self._skip(name):
+                    self._track(join(directory, name))
+        else:
+            if timeout:
+                time.sleep(timeout)
+            self._scan()
+
+        ready = self._ready()
+        if ready:
+            self._process(ready)
+        return ready
+
+    def run(self):
+        logging.info('CopyMedia daemon started; settle time %ss', self.settle)
+        self.running = True
+        self._scan()
+        try:
+            while self.running:
+                # Wake up at least every poll_interval while something is waiting to settle.
+                self.run_once(self.poll_interval)
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+            logging.info('CopyMedia daemon stopped')
+
+    def stop(self, *args):
+        self.running = False